@@ -3,18 +3,22 @@ Client to use fitnessbuddy api with
 """
 
 import json
+import queue
 import threading
-import pathlib
 import tkinter as tk
 from datetime import datetime
 import requests as req
-from pika_listener import STATS, listen_notifications
+from stats_events import listen_stats
 
 API = "http://127.0.0.1:5000/api/users/" #api entrypoint
 API_ADDR = "http://127.0.0.1:5000/" #plain address for use with hypermedia controls
 USER = None
 USER_INFO = None
 HREFS = None
+SCHEMAS = {} #schemas fetched from schemaUrl of controls
+#controls of the user item that are safe to GET when looking for other controls
+LINK_CONTROLS = ("fitnessbuddy:exercises-all", "fitnessbuddy:measurements-all")
+STATS = queue.Queue(1) #allow only one set of stats
 
 class SampleApp(tk.Tk):
     """
@@ -106,7 +110,15 @@ class StatsPage(tk.Frame):
         #Use hypermedia to find hrefs for adding measurements and exercises
         global HREFS
         HREFS = self.find_hrefs(["fitnessbuddy:add-exercise", "fitnessbuddy:add-measurement", 
-                                 "fitnessbuddy:stats", "edit"])
+                                 "fitnessbuddy:stats", "fitnessbuddy:stats-events", "edit"])
+
+        #stats are pushed by the api when the worker has stored them
+        self.bind("<<StatsReceived>>", lambda event: self.draw_stats(statframe))
+        self.stop_listening = threading.Event()
+        threading.Thread(target=listen_stats,
+                         args=(API_ADDR + HREFS.get("fitnessbuddy:stats-events").get("href"),
+                               self.stats_received, self.stop_listening),
+                         daemon=True).start()
 
         #Add buttons for the actions
         aframe = tk.Frame(self)
@@ -126,15 +138,50 @@ class StatsPage(tk.Frame):
                   command=lambda: self.delete_user(statframe)).pack(padx=10, side="bottom")
         bframe.pack()
 
+    def destroy(self):
+        self.stop_listening.set()
+        tk.Frame.destroy(self)
+
+    def stats_received(self, stats):
+        """
+        Called on the listener thread, hands the stats over to the tkinter thread
+        """
+        try:
+            STATS.get_nowait()
+        except queue.Empty:
+            pass
+        STATS.put(stats)
+        self.event_generate("<<StatsReceived>>", when="tail")
+
     def delete_user(self, statframe):
+        """
+        Callback for delete user button. The api deletes the user in a background
+        job, which is polled until it has finished.
+        """
         href = f"{API}{USER}"
         res = req.delete(href)
-        if res.status_code != 204:
+        if res.status_code == 202:
+            tk.Label(statframe, text="Deleting user...").pack(pady=20)
+            job_href = res.json().get("@controls").get("fitnessbuddy:job").get("href")
+            self.poll_job(statframe, API_ADDR + job_href)
+        elif res.status_code == 204:
+            self.master.switch_frame(StartPage)
+        else:
             tk.Label(statframe, text="User already deleted", fg='#ff1100',
                      wraplength=self.winfo_width()).pack(padx=20)
-        else:
+
+    def poll_job(self, statframe, href):
+        """
+        Checks the status of a background job once a second until it is done
+        """
+        job = req.get(href).json().get("job")
+        if job.get("status") == "done":
             self.master.switch_frame(StartPage)
-        #statframe.pack()
+        elif job.get("status") == "failed":
+            tk.Label(statframe, text="Deleting user failed: " + str(job.get("error")),
+                     fg='#ff1100', wraplength=self.winfo_width()).pack(padx=20)
+        else:
+            self.after(1000, lambda: self.poll_job(statframe, href))
 
 
     def update_stats(self, statframe):
@@ -148,52 +195,46 @@ class StatsPage(tk.Frame):
 
         if res.status_code == 202: #need to wait for stats
             tk.Label(statframe, text="Waiting for stats...").pack(pady=20)
-            statframe.after(10, lambda : self.draw_stats(statframe))
         else: #something is wrong
             tk.Label(statframe, text="Stat request failed. Please try again later").pack(pady=20)
 
 
     def draw_stats(self, statframe):
         '''
-        Function to keep calling in the backgroud until stats arrive from pika listener
+        Draws the stats received from the stats events stream
         '''
-        if STATS.qsize() == 0:
-            statframe.after(10, self.draw_stats, statframe)
-        else:
-            stats = STATS.get()
-            for child in statframe.winfo_children():
-                child.destroy()
-            for key, value in stats.items():
-                sframe = tk.Frame(statframe)
-                tk.Label(sframe, text=key, width=20).pack(side="left")
-                tk.Label(sframe, text=value, width=25).pack(side="left")
-                sframe.pack()
+        try:
+            stats = STATS.get_nowait()
+        except queue.Empty:
+            return
+        for child in statframe.winfo_children():
+            child.destroy()
+        for key, value in stats.items():
+            sframe = tk.Frame(statframe)
+            tk.Label(sframe, text=key, width=20).pack(side="left")
+            tk.Label(sframe, text=value, width=25).pack(side="left")
+            sframe.pack()
 
 
     def find_hrefs(self, targets):
         """
-        Loop controls to find desired targets
+        Finds the target controls from the user item, and the ones it doesn't have from
+        the collections it links to. Only LINK_CONTROLS are followed, e.g. a GET on the
+        stats control would start a new stats task.
         """
-        ret = {}
         controls = req.get(f"{API}{USER}/").json().get("@controls")
-        #first find edit user control
-        for control in controls.values():
-            if control.get("title") == "Edit user":
-                res = req.get(API_ADDR + control.get("href")).json().get("@controls")
-                for target in targets:
-                    if target in res.keys():
-                        ret[target] = res.get(target)
-                        targets.remove(target)
-        #then others
-        for control in controls.values():
-            if not control.get("method") or control.get("method") == "GET":
-                res = req.get(API_ADDR + control.get("href")).json().get("@controls")
-                for target in targets:
-                    if target in res.keys():
-                        ret[target] = res.get(target)
-                        targets.remove(target)
-            if not targets:
+        ret = {target: controls[target] for target in targets if target in controls}
+        missing = [target for target in targets if target not in ret]
+        for name in LINK_CONTROLS:
+            if not missing:
                 break
+            if name not in controls:
+                continue
+            res = req.get(API_ADDR + controls[name].get("href")).json().get("@controls", {})
+            for target in list(missing):
+                if target in res:
+                    ret[target] = res[target]
+                    missing.remove(target)
         return ret
 
 
@@ -331,6 +372,18 @@ class EditUser(tk.Frame):
             USER_INFO = req.get(href).json()
 
 
+def get_schema(control):
+    """
+    Returns the schema of a control, fetching it from schemaUrl the first time
+    """
+    if "schema" in control:
+        return control["schema"]
+    url = control["schemaUrl"]
+    if url not in SCHEMAS:
+        SCHEMAS[url] = req.get(API_ADDR + url).json()
+    return SCHEMAS[url]
+
+
 def submit(inputframe, href, method="post"):
     """
     Makes a post or put request to specified href based on stuff in inputframe
@@ -350,7 +403,7 @@ def submit(inputframe, href, method="post"):
                 if not val: #if input is empty string
                     i += 1
                     continue
-                if href.get("schema").get("properties").get(prev_label).get("type") == "number":
+                if get_schema(href).get("properties").get(prev_label).get("type") == "number":
                     try:
                         val = float(val)
                     except ValueError:
@@ -374,9 +427,10 @@ def generate_form(iframe, instr, editing_user=False):
     """
     Generates measurement/exercise adding screen and user editing screen based on stuff in schema
     """
-    labels = list(instr.get("schema").get("properties").keys())
+    schema = get_schema(instr)
+    labels = list(schema.get("properties").keys())
 
-    for item in instr.get("schema").get("required"): #first add required fields
+    for item in schema.get("required"): #first add required fields
         sframe = tk.Frame(iframe)
         label = item + "(*): "
         labels.remove(item)
@@ -401,15 +455,6 @@ def generate_form(iframe, instr, editing_user=False):
 
 
 if __name__ == "__main__":
-    #pika listener
-    credential_path = pathlib.Path(__file__).parent.joinpath("pikacredentials.json")
-    with open(credential_path, "r", encoding="utf-8") as f:
-        cred = json.load(f)
-        pikath = threading.Thread(target=listen_notifications,
-                    args=(cred.get("user"), cred.get("password")), daemon=True)
-        pikath.start()
-
-    #client
     app = SampleApp()
     app.geometry("400x500")
     app.mainloop()
@@ -3,16 +3,19 @@ Pika listener implementation for use with client
 """
 
 import ssl
+import sys
 import json
 import queue
 import pathlib
 import pika
 
 STATS = queue.Queue(1) #allow only one set of stats
+#same exchange and routing keys as the worker
+NOTIFICATIONS_EXCHANGE = "user-notifications"
 
-def listen_notifications(user, pwd):
+def listen_notifications(user, pwd, user_id):
     """
-    Based on course example
+    Based on course example. Receives only the stats of the given user.
     """
     context = ssl.create_default_context()
     context.check_hostname = False
@@ -27,13 +30,14 @@ def listen_notifications(user, pwd):
 
     channel = connection.channel()
     channel.exchange_declare(
-        exchange="notifications",
-        exchange_type="fanout"
+        exchange=NOTIFICATIONS_EXCHANGE,
+        exchange_type="topic"
     )
     result = channel.queue_declare(queue="", exclusive=True)
     channel.queue_bind(
-        exchange="notifications",
-        queue=result.method.queue
+        exchange=NOTIFICATIONS_EXCHANGE,
+        queue=result.method.queue,
+        routing_key=f"user.{user_id}.stats"
     )
     channel.basic_consume(
         queue=result.method.queue,
@@ -54,7 +58,8 @@ def notification_handler(channel, method, properties, body):
     STATS.put(json.loads(body))
 
 if __name__ == "__main__":
+    #usage: python pika_listener.py <user id>
     filepath = pathlib.Path(__file__).parent.joinpath("pikacredentials.json")
     with open(filepath, "r", encoding="utf-8") as f:
         cred = json.load(f)
-        listen_notifications(cred.get("user"), cred.get("password"))
+        listen_notifications(cred.get("user"), cred.get("password"), int(sys.argv[1]))
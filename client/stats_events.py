@@ -0,0 +1,38 @@
+"""
+Server-sent events listener for use with client
+"""
+
+import json
+import requests as req
+
+def listen_stats(url, callback, stop):
+    """
+    Reads the user's stats events stream and calls callback with each new set of
+    stats until stop is set. Reconnects when the server ends the stream, continuing
+    from the last event received.
+    """
+    last_id = None
+    with req.Session() as session:
+        while not stop.is_set():
+            headers = {"Accept": "text/event-stream"}
+            if last_id is not None:
+                headers["Last-Event-ID"] = last_id
+            try:
+                #read timeout well above the server's heartbeat interval
+                with session.get(url, headers=headers, stream=True, timeout=(5, 60)) as resp:
+                    resp.raise_for_status()
+                    event = {}
+                    for line in resp.iter_lines(decode_unicode=True):
+                        if stop.is_set():
+                            return
+                        if not line:
+                            if event.get("event") == "stats":
+                                last_id = event.get("id", last_id)
+                                callback(json.loads(event["data"]))
+                            event = {}
+                        elif not line.startswith(":"):
+                            field, _, value = line.partition(":")
+                            event[field] = value[1:] if value.startswith(" ") else value
+            except req.RequestException as error:
+                print("Stats events:", error)
+                stop.wait(3)
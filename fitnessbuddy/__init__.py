@@ -3,11 +3,56 @@ Implementation for Fitnessbuddy9000
 """
 
 import os
+import functools
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 from flasgger import Swagger, swag_from
+from fitnessbuddy import routing
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": routing.RoutingSession})
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Enforces foreign keys, and with them ON DELETE CASCADE, on SQLite connections
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+def set_sqlite_options(config, dbapi_connection, connection_record):
+    """
+    Applies the journal, synchronous and busy timeout settings of the config on
+    SQLite connections. WAL lets readers work while a writer holds the lock.
+    """
+    cursor = dbapi_connection.cursor()
+    if config["SQLITE_WAL"]:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.close()
+
+def engine_options(config):
+    """
+    Builds the engine options for the configured database. Server databases
+    (e.g. PostgreSQL) get a connection pool that is checked and recycled, file based
+    SQLite a pool of connections shared between threads. In-memory SQLite is left to
+    Flask-SQLAlchemy.
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    pool = {
+        "pool_size": config["DATABASE_POOL_SIZE"],
+        "max_overflow": config["DATABASE_MAX_OVERFLOW"],
+        "pool_timeout": config["DATABASE_POOL_TIMEOUT"]
+    }
+    if url.get_backend_name() != "sqlite":
+        return dict(pool, pool_recycle=config["DATABASE_POOL_RECYCLE"], pool_pre_ping=True)
+    if url.database in (None, "", ":memory:"):
+        return {}
+    #pysqlite defaults to opening a new connection for every checkout
+    return dict(pool, poolclass=QueuePool, connect_args={"check_same_thread": False})
 
 # Based on https://github.com/enkwolf/pwp-course-sensorhub-api-example
 def create_app(test_config=None):
@@ -18,7 +63,34 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        BROKER_HOST="193.167.189.95",
+        BROKER_PORT=5672,
+        BROKER_VHOST="ryhma-jll-vhost",
+        BROKER_USER="",
+        BROKER_PASSWORD="",
+        BROKER_USE_SSL=True,
+        BROKER_BUFFER_SIZE=1000,
+        BROKER_RETRY_INTERVAL=5,
+        RESPONSE_CACHE_SIZE=1024,
+        RESPONSE_CACHE_URL=None,
+        RESPONSE_CACHE_TTL=300,
+        RESPONSE_CACHE_REPLICA_TTL=5,
+        JOBS_SYNC=None,
+        JOBS_WORKERS=1,
+        JOBS_CHUNK_SIZE=1000,
+        JOBS_RETENTION_HOURS=24,
+        DATABASE_POOL_SIZE=5,
+        DATABASE_MAX_OVERFLOW=10,
+        DATABASE_POOL_TIMEOUT=30,
+        DATABASE_POOL_RECYCLE=1800,
+        SQLITE_WAL=True,
+        SQLITE_SYNCHRONOUS="NORMAL",
+        SQLITE_BUSY_TIMEOUT=5000,
+        DATABASE_REPLICAS=[],
+        STATS_EVENTS_HEARTBEAT=15,
+        STATS_EVENTS_TIMEOUT=300,
+        STATS_TASK_TIMEOUT=60
     )
 
     #add API documentation, url: /apidocs/
@@ -39,16 +111,47 @@ def create_app(test_config=None):
     except OSError as error:
         print(error)
 
+    #options set explicitly in the config win over the generated ones, an explicit
+    #pool class replaces them since the pool settings depend on it
+    explicit = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    def options(uri):
+        if "poolclass" in explicit:
+            return {}
+        return engine_options(dict(app.config, SQLALCHEMY_DATABASE_URI=uri))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **options(app.config["SQLALCHEMY_DATABASE_URI"]), **explicit
+    }
     db.init_app(app)
+    #read replicas, see routing.RoutingSession
+    routing.init_app(app, lambda uri: {**options(uri), **explicit})
+    with app.app_context():
+        for engine in [*db.engines.values(), *app.extensions["replicas"]]:
+            if engine.dialect.name == "sqlite":
+                event.listen(engine, "connect", set_sqlite_pragma)
+                event.listen(engine, "connect",
+                             functools.partial(set_sqlite_options, app.config))
 
     from . import models
+    from . import broker
+    broker.init_app(app)
+    from . import notify
+    notify.init_app(app)
+    from . import cache
+    cache.init_app(app)
+    from . import jobs
+    jobs.init_app(app)
     from . import api
-    from fitnessbuddy.utils import UserConverter, MeasurementsConverter, ExerciseConverter
+    from fitnessbuddy.utils import (UserConverter, MeasurementsConverter, ExerciseConverter,
+                                    JobConverter)
     app.url_map.converters["user"] = UserConverter
     app.url_map.converters["exercise"] = ExerciseConverter
     app.url_map.converters["measurements"] = MeasurementsConverter
+    app.url_map.converters["job"] = JobConverter
     app.cli.add_command(models.init_db_command)
+    app.cli.add_command(models.upgrade_db_command)
     app.cli.add_command(models.fill_db_command)
+    from fitnessbuddy.resources.statistics import refresh_stats_command
+    app.cli.add_command(refresh_stats_command)
     app.register_blueprint(api.api_bp)
 
     return app
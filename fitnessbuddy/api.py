@@ -4,10 +4,15 @@ Module for initializing fitnessbuddy api and adding resources
 from flask import Blueprint
 from flask_restful import Api
 
-from fitnessbuddy.resources.exercise import ExerciseCollection, ExerciseItem
-from fitnessbuddy.resources.user import UserCollection, UserItem
-from fitnessbuddy.resources.measurement import MeasurementsCollection, MeasurementsItem
-from fitnessbuddy.resources.statistics import UserStats
+from fitnessbuddy.resources.exercise import ExerciseCollection, ExerciseItem, ExerciseBulk
+from fitnessbuddy.resources.user import UserCollection, UserItem, UserArchive
+from fitnessbuddy.resources.measurement import (MeasurementsCollection, MeasurementsItem,
+                                                 MeasurementsBulk, MeasurementsRollupCollection)
+from fitnessbuddy.resources.statistics import (UserStats, UserStatsEvents, UserAggregateItem,
+                                                StatsBulk, StatsExport)
+from fitnessbuddy.resources.schema import SchemaItem
+from fitnessbuddy.resources.monitoring import CacheStats
+from fitnessbuddy.resources.job import JobItem
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
@@ -15,8 +20,19 @@ api = Api(api_bp)
 #add resources
 api.add_resource(UserCollection, "/users/")
 api.add_resource(UserItem, "/users/<user:user>/")
+api.add_resource(UserArchive, "/users/<user:user>/archive/")
 api.add_resource(ExerciseCollection, "/users/<user:user>/exercises/")
+api.add_resource(ExerciseBulk, "/users/<user:user>/exercises/bulk/")
 api.add_resource(ExerciseItem, "/users/<user:user>/exercises/<exercise:exercise>/")
 api.add_resource(MeasurementsCollection, "/users/<user:user>/measurements/")
+api.add_resource(MeasurementsBulk, "/users/<user:user>/measurements/bulk/")
+api.add_resource(MeasurementsRollupCollection, "/users/<user:user>/measurements/rollup/")
 api.add_resource(MeasurementsItem, "/users/<user:user>/measurements/<measurements:measurements>/")
 api.add_resource(UserStats, "/users/<user:user>/stats/")
+api.add_resource(UserStatsEvents, "/users/<user:user>/stats/events/")
+api.add_resource(UserAggregateItem, "/users/<user:user>/stats/aggregate/")
+api.add_resource(StatsBulk, "/stats/bulk/")
+api.add_resource(StatsExport, "/stats/export/")
+api.add_resource(SchemaItem, "/schemas/<schema>/")
+api.add_resource(CacheStats, "/cache/stats/")
+api.add_resource(JobItem, "/jobs/<job:job>/")
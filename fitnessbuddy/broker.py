@@ -0,0 +1,166 @@
+"""
+Long-lived RabbitMQ publisher for sending tasks to the stats worker
+"""
+import ssl
+import threading
+from collections import deque
+import pika
+from flask import current_app
+
+class PublishError(Exception):
+    """
+    Raised when a message can't be sent and there is no room left to buffer it
+    """
+
+class StatsPublisher:
+    """
+    Per-process publisher that keeps one connection and channel open between
+    requests. Messages are published with publisher confirms; messages that can't
+    be delivered are kept in a bounded buffer and retried every retry_interval
+    seconds (and on the next publish) until the broker takes them.
+    """
+    def __init__(self, parameters, queue="stats", buffer_size=1000,
+                 connection_factory=pika.BlockingConnection, retry_interval=5):
+        self.parameters = parameters
+        self.queue = queue
+        self.buffer_size = buffer_size
+        self.connection_factory = connection_factory
+        self.retry_interval = retry_interval
+        self._buffer = deque()
+        self._connection = None
+        self._channel = None
+        self._timer = None
+        #BlockingConnection is not thread safe
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates a publisher from BROKER_* app config values
+        """
+        ssl_options = None
+        if config["BROKER_USE_SSL"]:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            ssl_options = pika.SSLOptions(context)
+        parameters = pika.ConnectionParameters(
+            host=config["BROKER_HOST"],
+            port=config["BROKER_PORT"],
+            virtual_host=config["BROKER_VHOST"],
+            credentials=pika.PlainCredentials(config["BROKER_USER"], config["BROKER_PASSWORD"]),
+            ssl_options=ssl_options
+        )
+        return cls(parameters, buffer_size=config["BROKER_BUFFER_SIZE"],
+                   connection_factory=config.get("BROKER_CONNECTION_FACTORY",
+                                                 pika.BlockingConnection),
+                   retry_interval=config["BROKER_RETRY_INTERVAL"])
+
+    @property
+    def pending(self):
+        """
+        Number of buffered messages not yet confirmed by the broker
+        """
+        return len(self._buffer)
+
+    def publish(self, body):
+        """
+        Publishes a message to the queue. Returns True if it (and everything buffered
+        before it) was confirmed by the broker and False if it was buffered for later.
+        Raises PublishError if the buffer is full.
+        """
+        with self._lock:
+            if len(self._buffer) >= self.buffer_size and not self._flush():
+                raise PublishError("Broker unavailable and outbound buffer is full")
+            self._buffer.append(body)
+            return self._flush()
+
+    def flush(self):
+        """
+        Tries to send the buffered messages. Returns True if the buffer is empty.
+        Called by the retry timer, which is rescheduled while messages remain.
+        """
+        with self._lock:
+            self._timer = None
+            return self._flush()
+
+    def close(self):
+        """
+        Stops retrying and closes the connection if it is open. Buffered messages
+        are kept for the next publish.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._reset()
+
+    def _flush(self):
+        while self._buffer:
+            if not self._send(self._buffer[0]):
+                self._schedule_retry()
+                return False
+            self._buffer.popleft()
+        return True
+
+    def _schedule_retry(self):
+        if self._timer is not None or not self.retry_interval:
+            return
+        self._timer = threading.Timer(self.retry_interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _send(self, body):
+        #try once on the current connection and once more on a fresh one
+        for _ in range(2):
+            try:
+                channel = self._get_channel()
+                channel.basic_publish(
+                    exchange="",
+                    routing_key=self.queue,
+                    body=body,
+                    properties=pika.BasicProperties(content_type="application/json"),
+                    mandatory=True
+                )
+                return True
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError):
+                #broker is up but refused the message, keep it and retry later
+                return False
+            except pika.exceptions.AMQPError:
+                self._reset()
+        return False
+
+    def _get_channel(self):
+        if self._connection is None or not self._connection.is_open:
+            self._reset()
+            self._connection = self.connection_factory(self.parameters)
+        else:
+            #serve heartbeats that were missed while idle
+            self._connection.process_data_events(0)
+        if self._channel is None or not self._channel.is_open:
+            self._channel = self._connection.channel()
+            self._channel.queue_declare(queue=self.queue)
+            self._channel.confirm_delivery()
+        return self._channel
+
+    def _reset(self):
+        if self._connection is not None and self._connection.is_open:
+            try:
+                self._connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+        self._connection = None
+        self._channel = None
+
+def init_app(app):
+    """
+    Creates the publisher of the app. The connection is opened on first publish,
+    so each worker process started from the app opens its own.
+    """
+    app.extensions["stats_publisher"] = StatsPublisher.from_config(app.config)
+
+def get_publisher():
+    """
+    Returns the publisher of the current app
+    """
+    return current_app.extensions["stats_publisher"]
@@ -0,0 +1,303 @@
+"""
+Response cache for GET requests, invalidated on writes
+"""
+import json
+import time
+import threading
+import functools
+from collections import OrderedDict
+from flask import Response, current_app, has_app_context, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from fitnessbuddy.models import User, UserAggregate, StatsChange
+from fitnessbuddy.routing import replica_reads
+try:
+    import redis
+except ImportError:
+    redis = None
+
+class LocalBackend:
+    """
+    In-process LRU store whose entries expire after ttl seconds. Counts evictions.
+    Invalidations only reach the process that made the write, so this backend is
+    only correct when a single process serves the API. A maxsize of 0 stores nothing.
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns a cached entry or None
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires <= time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl=None):
+        """
+        Stores an entry for ttl seconds (default the backend's ttl), evicting the
+        least recently used one if full
+        """
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + (ttl or self.ttl), entry)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def generation(self, scope):
+        """
+        Returns the current generation of a scope
+        """
+        return self._generations.get(scope, 0)
+
+    def invalidate(self, scope):
+        """
+        Moves a scope to a new generation so that its entries are no longer found.
+        Old entries are dropped right away.
+        """
+        with self._lock:
+            self._generations[scope] = self._generations.get(scope, 0) + 1
+            prefix = scope + "|"
+            for key in [key for key in self._items if key.startswith(prefix)]:
+                del self._items[key]
+
+    def __len__(self):
+        return len(self._items)
+
+class RedisBackend:
+    """
+    Store shared by all processes. Entries expire after ttl seconds, old generations
+    are left to expire.
+    """
+    def __init__(self, url, ttl=300, prefix="fitnessbuddy:cache:"):
+        if redis is None:
+            raise RuntimeError("RESPONSE_CACHE_URL is set but redis is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns a cached entry or None
+        """
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        status, headers, body = json.loads(value)
+        return status, [tuple(header) for header in headers], body
+
+    def set(self, key, entry, ttl=None):
+        """
+        Stores an entry for ttl seconds (default the backend's ttl)
+        """
+        self.client.set(self.prefix + key, json.dumps(entry), ex=ttl or self.ttl)
+
+    def generation(self, scope):
+        """
+        Returns the current generation of a scope
+        """
+        return int(self.client.get(self.prefix + "gen:" + scope) or 0)
+
+    def invalidate(self, scope):
+        """
+        Moves a scope to a new generation so that its entries are no longer found
+        """
+        self.client.incr(self.prefix + "gen:" + scope)
+
+    def __len__(self):
+        #SCAN walks the keyspace in batches without blocking the server like KEYS
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + "*|*", count=1000))
+
+class ResponseCache:
+    """
+    Caches 200 responses of GET requests by scope (the user collection or one user),
+    route and query string. Writes invalidate whole scopes.
+    """
+    def __init__(self, backend, replica_ttl=5):
+        self.backend = backend
+        self.replica_ttl = replica_ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def key(self, scope):
+        """
+        Returns the key of the current request in the current generation of scope
+        """
+        generation = self.backend.generation(scope)
+        return f"{scope}|{generation}|{request.endpoint}|{request.full_path}"
+
+    def get(self, key):
+        """
+        Returns the cached response for a key or None
+        """
+        entry = self.backend.get(key)
+        if entry is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        status, headers, body = entry
+        return Response(body, status, headers=headers)
+
+    def set(self, key, resp, from_replica=False):
+        """
+        Stores a response if it is a complete 200 response. Responses read from a
+        replica may be older than the scope's generation, so they are kept for at
+        most replica_ttl seconds (not at all if it is 0).
+        """
+        if resp.status_code != 200 or resp.is_streamed:
+            return
+        ttl = None
+        if from_replica:
+            if not self.replica_ttl:
+                return
+            ttl = self.replica_ttl
+        self.backend.set(key, (resp.status_code, list(resp.headers.items()),
+                               resp.get_data(as_text=True)), ttl=ttl)
+
+    def invalidate(self, scopes):
+        """
+        Invalidates the given scopes
+        """
+        for scope in scopes:
+            self.backend.invalidate(scope)
+            self._count("invalidations")
+
+    def stats(self):
+        """
+        Returns the cache counters of this process
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self.backend)
+        }
+
+def user_scope(user_id):
+    """
+    Scope of a user and everything the user owns
+    """
+    return f"user:{user_id}"
+
+USERS_SCOPE = "users"
+
+def get_cache():
+    """
+    Returns the response cache of the current app
+    """
+    return current_app.extensions["response_cache"]
+
+def cached(view):
+    """
+    Caches the responses of a GET method. Methods of per-user resources are scoped to
+    the user, others to the user collection. Conditional requests skip the cache since
+    they are answered from row versions already.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.if_none_match or request.if_modified_since:
+            return view(*args, **kwargs)
+        cache = get_cache()
+        user = kwargs.get("user")
+        #the key is taken before the view runs so that anything written meanwhile
+        #moves the scope past the stored entry
+        key = cache.key(USERS_SCOPE if user is None else user_scope(user.id))
+        resp = cache.get(key)
+        if resp is None:
+            reads = replica_reads()
+            resp = view(*args, **kwargs)
+            cache.set(key, resp, from_replica=replica_reads() > reads)
+            resp.headers["X-Cache"] = "MISS"
+        else:
+            resp.headers["X-Cache"] = "HIT"
+        return resp
+    return wrapper
+
+def _scopes_of(instance):
+    #running totals and their journal only change together with an exercise or
+    #measurement, or when they are first built, which doesn't change any response
+    if isinstance(instance, (UserAggregate, StatsChange)):
+        return set()
+    if isinstance(instance, User):
+        return {USERS_SCOPE, user_scope(instance.id)}
+    user_id = getattr(instance, "user_id", None)
+    if user_id is None:
+        return set()
+    return {user_scope(user_id)}
+
+def _collect_scopes(session, flush_context):
+    #after the flush ids are assigned but new/dirty/deleted still list the changes
+    scopes = session.info.setdefault("cache_scopes", set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        scopes.update(_scopes_of(instance))
+
+def _invalidate_committed(session):
+    scopes = session.info.pop("cache_scopes", None)
+    if scopes and has_app_context() and "response_cache" in current_app.extensions:
+        get_cache().invalidate(scopes)
+
+def _discard_scopes(session, previous_transaction=None):
+    session.info.pop("cache_scopes", None)
+
+def invalidate_after_write(resp):
+    """
+    Invalidates the scopes a successful write request may have touched, including
+    writes that bypass the session's unit of work (bulk inserts)
+    """
+    if request.method in ("POST", "PUT", "DELETE") and resp.status_code < 400:
+        scopes = set()
+        user = (request.view_args or {}).get("user")
+        if user is not None:
+            #by identity, the user may have been deleted by now
+            scopes.add(user_scope(inspect(user).identity[0]))
+        if request.endpoint in ("api.usercollection", "api.useritem"):
+            scopes.add(USERS_SCOPE)
+        if scopes:
+            get_cache().invalidate(scopes)
+    return resp
+
+#ORM writes committed anywhere (resources, CLI commands, the worker's stats POST)
+event.listen(Session, "after_flush", _collect_scopes)
+event.listen(Session, "after_commit", _invalidate_committed)
+event.listen(Session, "after_soft_rollback", _discard_scopes)
+
+def init_app(app):
+    """
+    Creates the response cache of the app. RESPONSE_CACHE_URL selects a shared redis
+    backend, otherwise responses are kept in a per-process LRU, which is only valid
+    when the API runs in one process (RESPONSE_CACHE_SIZE = 0 turns it off).
+    Entries of both expire after RESPONSE_CACHE_TTL seconds, responses read from a
+    replica after RESPONSE_CACHE_REPLICA_TTL seconds.
+    """
+    if app.config.get("RESPONSE_CACHE_URL"):
+        backend = RedisBackend(app.config["RESPONSE_CACHE_URL"],
+                               ttl=app.config["RESPONSE_CACHE_TTL"])
+    else:
+        backend = LocalBackend(app.config["RESPONSE_CACHE_SIZE"],
+                               ttl=app.config["RESPONSE_CACHE_TTL"])
+    app.extensions["response_cache"] = ResponseCache(
+        backend, replica_ttl=app.config["RESPONSE_CACHE_REPLICA_TTL"])
+    app.after_request(invalidate_after_write)
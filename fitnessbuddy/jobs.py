@@ -0,0 +1,172 @@
+"""
+Background jobs for large deletions and archiving, run in chunked transactions
+"""
+import json
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, func
+from fitnessbuddy import db
+from fitnessbuddy.cache import get_cache, user_scope, USERS_SCOPE
+from fitnessbuddy.models import (Job, User, Exercise, Measurements, Stats, StatsChange,
+                                 UserAggregate, ExerciseArchive, MeasurementsArchive,
+                                 MeasurementsRollup)
+
+HANDLERS = {}
+
+def handler(kind):
+    """
+    Registers a function as the handler of a job kind. Handlers get the job and its
+    params and must be safe to run again after an interruption.
+    """
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+def submit(kind, user_id=None, **params):
+    """
+    Stores a new job and starts it on the app's pool, or runs it right away if
+    JOBS_SYNC is set. Jobs that finished more than JOBS_RETENTION_HOURS ago are
+    deleted first. Returns the job.
+    """
+    _delete_expired()
+    job = Job(kind=kind, user_id=user_id, params=json.dumps(params), status="queued")
+    db.session.add(job)
+    db.session.commit()
+    if current_app.config["JOBS_SYNC"]:
+        run(job.id)
+    else:
+        app = current_app._get_current_object()
+        current_app.extensions["jobs"].submit(_run_in_context, app, job.id)
+    return job
+
+def _delete_expired():
+    expired = datetime.utcnow() - timedelta(hours=current_app.config["JOBS_RETENTION_HOURS"])
+    db.session.execute(Job.__table__.delete().where(Job.status.in_(["done", "failed"]),
+                                                    Job.finished < expired))
+
+def _run_in_context(app, job_id):
+    with app.app_context():
+        run(job_id)
+
+def run(job_id):
+    """
+    Runs a job and records its outcome
+    """
+    job = db.session.get(Job, job_id)
+    job.status = "running"
+    job.started = datetime.utcnow()
+    db.session.commit()
+    try:
+        HANDLERS[job.kind](job, **json.loads(job.params))
+        job.status = "done"
+    except Exception as exc:  # noqa: W0703
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.status = "failed"
+        job.error = str(exc)
+    job.finished = datetime.utcnow()
+    db.session.commit()
+
+def _commit_chunk(job, count, scopes=()):
+    #Core statements bypass the session events that invalidate cached responses
+    job.processed += count
+    db.session.commit()
+    get_cache().invalidate({user_scope(job.user_id), *scopes})
+
+def _chunk_keys(key, *criteria):
+    chunk_size = current_app.config["JOBS_CHUNK_SIZE"]
+    return select(key).where(*criteria).order_by(key).limit(chunk_size)
+
+def _delete_in_chunks(job, key, *criteria):
+    table = key.table
+    while True:
+        keys = db.session.execute(_chunk_keys(key, *criteria)).scalars().all()
+        if not keys:
+            return
+        db.session.execute(table.delete().where(*criteria, key.in_(keys)))
+        _commit_chunk(job, len(keys))
+
+def _count(*models_and_criteria):
+    return sum(db.session.query(func.count()).select_from(model).filter(*criteria).scalar()
+               for model, criteria in models_and_criteria)
+
+@handler("delete-user")
+def delete_user(job):
+    """
+    Deletes the user's rows table by table and finally the user
+    """
+    uid = job.user_id
+    tables = [(Exercise.id, Exercise.user_id), (Measurements.id, Measurements.user_id),
+              (Stats.id, Stats.user_id), (StatsChange.seq, StatsChange.user_id),
+              (ExerciseArchive.id, ExerciseArchive.user_id),
+              (MeasurementsArchive.id, MeasurementsArchive.user_id),
+              (MeasurementsRollup.id, MeasurementsRollup.user_id)]
+    if job.total is None:
+        job.total = _count(*((column.class_, [user_id == uid]) for column, user_id in tables))
+        db.session.commit()
+    for key, user_id in tables:
+        _delete_in_chunks(job, key, user_id == uid)
+    user = db.session.get(User, uid)
+    if user is not None:
+        db.session.delete(user)
+        _commit_chunk(job, 0, [USERS_SCOPE])
+
+@handler("archive")
+def archive(job, before):
+    """
+    Moves the user's exercises and measurements dated before the given time to the
+    archive tables and rebuilds the user's running totals
+    """
+    before = datetime.fromisoformat(before)
+    models = [(Exercise, ExerciseArchive), (Measurements, MeasurementsArchive)]
+    if job.total is None:
+        job.total = _count(*((model, [model.user_id == job.user_id, model.date < before])
+                             for model, _ in models))
+        db.session.commit()
+    for model, archive_model in models:
+        criteria = [model.user_id == job.user_id, model.date < before]
+        columns = [column.name for column in model.__table__.columns
+                   if column.name in archive_model.__table__.columns and column.default is None]
+        while True:
+            keys = db.session.execute(_chunk_keys(model.id, *criteria)).scalars().all()
+            if not keys:
+                break
+            #an interrupted chunk may have been copied already
+            db.session.execute(archive_model.__table__.delete().where(
+                archive_model.id.in_(keys)))
+            db.session.execute(archive_model.__table__.insert().from_select(
+                columns,
+                select(*(model.__table__.c[name] for name in columns)).where(model.id.in_(keys))
+            ))
+            db.session.execute(model.__table__.delete().where(model.id.in_(keys)))
+            _commit_chunk(job, len(keys))
+    user = db.session.get(User, job.user_id)
+    if user is not None:
+        UserAggregate.for_user(user, lock=True).resync()
+        db.session.commit()
+
+@click.command("run-jobs")
+@with_appcontext
+def run_jobs_command():
+    """
+    Command for running jobs that were queued or interrupted when the server stopped
+    """
+    for job_id in db.session.execute(select(Job.id).where(
+            Job.status.in_(["queued", "running"])).order_by(Job.id)).scalars().all():
+        run(job_id)
+        click.echo(f"Job {job_id}: {db.session.get(Job, job_id).status}")
+
+def init_app(app):
+    """
+    Creates the job pool of the app. Jobs run synchronously when JOBS_SYNC is set,
+    which it is by default when testing.
+    """
+    if app.config["JOBS_SYNC"] is None:
+        app.config["JOBS_SYNC"] = app.testing
+    app.extensions["jobs"] = ThreadPoolExecutor(max_workers=app.config["JOBS_WORKERS"],
+                                                thread_name_prefix="jobs")
+    app.cli.add_command(run_jobs_command)
@@ -3,21 +3,84 @@ Module for initializing database tables, json schemas and serializers
 """
 import os
 import json
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 import click
+from sqlalchemy import inspect, func, text, MetaData
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
+from sqlalchemy.schema import CreateColumn, CreateTable
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 from flask.cli import with_appcontext
 from fitnessbuddy import db
+from fitnessbuddy.routing import stick_to_primary
 
-class Exercise(db.Model):
+def parse_datetime(value):
+    """
+    Parses an ISO 8601 datetime. Datetimes with a UTC offset are converted to naive
+    UTC, the form every datetime is stored and compared in.
+    """
+    parsed = datetime.fromisoformat(str(value))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+class SchemaMixin:
+    """
+    Gives a model with a json_schema a validator that is compiled once and reused
+    """
+    @classmethod
+    def validator(cls):
+        """
+        Returns the compiled validator of the model's json schema
+        """
+        validator = cls.__dict__.get("_validator")
+        if validator is None:
+            schema = cls.json_schema()
+            validator_class = validator_for(schema)
+            validator_class.check_schema(schema)
+            validator = validator_class(schema)
+            cls._validator = validator
+        return validator
+
+    @classmethod
+    def validate(cls, doc):
+        """
+        Validates a document, raising the same ValidationError as jsonschema.validate
+        """
+        error = best_match(cls.validator().iter_errors(doc))
+        if error is not None:
+            raise error
+
+    @classmethod
+    def validate_many(cls, docs):
+        """
+        Validates a batch of documents. Returns a list with the error message of each
+        document, or None for valid ones.
+        """
+        validator = cls.validator()
+        return [
+            next((error.message for error in validator.iter_errors(doc)), None)
+            for doc in docs
+        ]
+
+class Exercise(SchemaMixin, db.Model):
     """
     Database model for exercise information
     (exercise name, duration in minutes, date, user id as foreign key)
     """
+    __table_args__ = (db.Index("ix_exercise_user_id_date", "user_id", "date"),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
     duration = db.Column(db.Float, nullable=True)
     date = db.Column(db.DateTime, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="cascade"), nullable=False)
+    #row version and modification time for conditional GETs
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+    __mapper_args__ = {"version_id_col": version}
 
     #initialize relationship
     user = db.relationship("User", back_populates="exercise")
@@ -39,7 +102,7 @@ class Exercise(db.Model):
         """
         self.name = doc["name"]
         self.duration = doc.get("duration")
-        self.date = datetime.fromisoformat(str(doc["date"]))
+        self.date = parse_datetime(doc["date"])
         self.user_id = doc.get("user_id")
 
     @staticmethod
@@ -70,7 +133,7 @@ class Exercise(db.Model):
         }
         return schema
 
-class User(db.Model):
+class User(SchemaMixin, db.Model):
     """
     Database model for user information (name, email, age, creation date)
     """
@@ -79,12 +142,24 @@ class User(db.Model):
     email = db.Column(db.String(64), nullable=False)
     age = db.Column(db.Float, nullable=False)
     user_creation_date = db.Column(db.DateTime, nullable=False)
+    #row version and modification time for conditional GETs
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+    __mapper_args__ = {"version_id_col": version}
+    #ids of deleted users are never reused, the stats worker keeps state by user id
+    __table_args__ = {"sqlite_autoincrement": True}
 
-    #initialize relationships
+    #initialize relationships. Deleting a user leaves removing the children to the
+    #database's ON DELETE CASCADE instead of loading and deleting them one by one
     measurements = db.relationship("Measurements", cascade="all, delete-orphan",
-                                    back_populates="user")
-    exercise = db.relationship("Exercise", cascade="all, delete-orphan", back_populates="user")
-    stats = db.relationship("Stats", cascade="all, delete-orphan", back_populates="user")
+                                    back_populates="user", passive_deletes=True)
+    exercise = db.relationship("Exercise", cascade="all, delete-orphan", back_populates="user",
+                               passive_deletes=True)
+    stats = db.relationship("Stats", cascade="all, delete-orphan", back_populates="user",
+                            passive_deletes=True)
+    aggregate = db.relationship("UserAggregate", cascade="all, delete-orphan",
+                                back_populates="user", uselist=False, passive_deletes=True)
 
     def serialize(self):
         """
@@ -105,7 +180,7 @@ class User(db.Model):
         self.name = doc["name"]
         self.email = doc["email"]
         self.age = doc["age"]
-        self.user_creation_date = datetime.fromisoformat(str(doc["user_creation_date"]))
+        self.user_creation_date = parse_datetime(doc["user_creation_date"])
 
     @staticmethod
     def json_schema():
@@ -135,17 +210,24 @@ class User(db.Model):
         }
         return schema
 
-class Measurements(db.Model):
+class Measurements(SchemaMixin, db.Model):
     """
     Database model for daily measurements
     (calories in/out, bodyweight, date, user id as foreign key)
     """
+    __table_args__ = (db.Index("ix_measurements_user_id_date", "user_id", "date"),)
+
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, nullable=False)
     weight = db.Column(db.Float, nullable=True)
     calories_in = db.Column(db.Float, nullable=True)
     calories_out = db.Column(db.Float, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="cascade"), nullable=False)
+    #row version and modification time for conditional GETs
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+    __mapper_args__ = {"version_id_col": version}
 
     #initialize relationship
     user = db.relationship("User", back_populates="measurements")
@@ -167,7 +249,7 @@ class Measurements(db.Model):
         """
         Function for deserializing measurements data item
         """
-        self.date = datetime.fromisoformat(str(doc["date"]))
+        self.date = parse_datetime(doc["date"])
         self.weight = doc.get("weight")
         self.calories_in = doc.get("calories_in")
         self.calories_out = doc.get("calories_out")
@@ -205,10 +287,12 @@ class Measurements(db.Model):
         }
         return schema
 
-class Stats(db.Model):
+class Stats(SchemaMixin, db.Model):
     """
     Database model for user stats
     """
+    __table_args__ = (db.Index("ix_stats_user_id_date", "user_id", "date"),)
+
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, nullable=False)
     total_exercises = db.Column(db.Integer, nullable=True)
@@ -238,7 +322,7 @@ class Stats(db.Model):
         """
         Function for deserializing stats data
         """
-        self.date = datetime.fromisoformat(str(doc["date"]))
+        self.date = parse_datetime(doc["date"])
         self.total_exercises = doc["total_exercises"]
         self.daily_exercises = doc["daily_exercises"]
         self.daily_calories_in = doc["daily_calories_in"]
@@ -277,8 +361,703 @@ class Stats(db.Model):
             "description": "Average number of calories burnt per day",
             "type": "number"
         }
+        props["watermark"] = {
+            "description": "Sequence number of the last change included in these stats",
+            "type": "integer"
+        }
+        props["generation"] = {
+            "description": "Generation of the stats request these stats answer",
+            "type": "integer"
+        }
         return schema
 
+    @staticmethod
+    def compute(user):
+        """
+        Computes the user's stats document with one aggregate query over the user's
+        exercises and measurements
+        """
+        exercise_count = db.session.query(func.count(Exercise.id)).filter(
+            Exercise.user_id == user.id).scalar_subquery()
+        totals = db.session.query(
+            exercise_count,
+            func.count(Measurements.id),
+            func.coalesce(func.sum(Measurements.calories_in), 0),
+            func.coalesce(func.sum(Measurements.calories_out), 0)
+        ).filter(Measurements.user_id == user.id).one()
+        return stats_document(user, totals[0], totals[1], float(totals[2]), float(totals[3]))
+
+    @staticmethod
+    def export(user_ids):
+        """
+        Returns what the stats of many users are computed from as columns in user id
+        order: creation dates, exercise and measurement counts, calorie sums (missing
+        calories count as 0) and the change_seq of the running totals (None if not
+        built yet). One grouped query per table. The change_seq is read first so that
+        the totals include at least the changes up to it.
+        """
+        users = db.session.query(User.id, User.user_creation_date, UserAggregate.change_seq) \
+            .outerjoin(UserAggregate, UserAggregate.user_id == User.id) \
+            .filter(User.id.in_(user_ids)).order_by(User.id).all()
+        exercises = dict(db.session.query(Exercise.user_id, func.count(Exercise.id))
+                         .filter(Exercise.user_id.in_(user_ids))
+                         .group_by(Exercise.user_id).all())
+        measurements = {row[0]: row[1:] for row in db.session.query(
+            Measurements.user_id,
+            func.count(Measurements.id),
+            func.coalesce(func.sum(Measurements.calories_in), 0),
+            func.coalesce(func.sum(Measurements.calories_out), 0)
+        ).filter(Measurements.user_id.in_(user_ids)).group_by(Measurements.user_id).all()}
+
+        columns = {key: [] for key in ("id", "user_creation_date", "exercise_count",
+                                       "measurement_count", "calories_in_sum",
+                                       "calories_out_sum", "watermark")}
+        for user_id, created, change_seq in users:
+            count, calories_in, calories_out = measurements.get(user_id, (0, 0, 0))
+            columns["id"].append(user_id)
+            columns["user_creation_date"].append(datetime.isoformat(created))
+            columns["exercise_count"].append(exercises.get(user_id, 0))
+            columns["measurement_count"].append(count)
+            columns["calories_in_sum"].append(float(calories_in))
+            columns["calories_out_sum"].append(float(calories_out))
+            columns["watermark"].append(change_seq)
+        return columns
+
+def stats_document(user, exercise_count, measurement_count, calories_in_sum,
+                   calories_out_sum):
+    """
+    Builds the stats document of the stats worker (worker.compute_stats) from totals.
+    Missing calories count as 0 and averages are per measurement.
+    """
+    days = (datetime.today() - user.user_creation_date).days
+    count = measurement_count
+    return {
+        "date": datetime.isoformat(datetime.now()),
+        "user_id": user.id,
+        "total_exercises": exercise_count,
+        "daily_exercises": round(exercise_count / days, 2) if days else 0,
+        "daily_calories_in": round(calories_in_sum / count, 2) if count else 0,
+        "daily_calories_out": round(calories_out_sum / count, 2) if count else 0
+    }
+
+class UserAggregate(db.Model):
+    """
+    Database model for running per-user totals of exercises and measurements.
+    Updated in the same transaction as every exercise/measurement write so that
+    stats can be computed without reading the user's whole history.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="cascade"),
+                        primary_key=True)
+    exercise_count = db.Column(db.Integer, nullable=False, default=0)
+    measurement_count = db.Column(db.Integer, nullable=False, default=0)
+    measurement_days = db.Column(db.Integer, nullable=False, default=0)
+    calories_in_sum = db.Column(db.Float, nullable=False, default=0)
+    calories_out_sum = db.Column(db.Float, nullable=False, default=0)
+    first_date = db.Column(db.DateTime, nullable=True)
+    last_date = db.Column(db.DateTime, nullable=True)
+    #sequence number of the latest change and of the latest change the stats worker
+    #has acknowledged, see StatsChange
+    change_seq = db.Column(db.Integer, nullable=False, default=0)
+    stats_watermark = db.Column(db.Integer, nullable=False, default=0)
+    #generation of the latest stats task, and when it was sent and the change_seq it
+    #includes while it is pending, see request_stats
+    stats_generation = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    stats_requested = db.Column(db.DateTime, nullable=True)
+    stats_requested_seq = db.Column(db.Integer, nullable=True)
+    #last time the totals changed, used as Last-Modified of the user's collections
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    #initialize relationship
+    user = db.relationship("User", back_populates="aggregate")
+
+    #changes kept for the stats worker at most, see _cap_journal
+    MAX_PENDING_CHANGES = 1000
+
+    @classmethod
+    def for_user(cls, user, lock=False):
+        """
+        Returns the aggregate row of a user. The row is created with the user, for
+        users that existed before (see upgrade-db) writers insert it and build it from
+        the user's current history while readers get totals built without writing
+        anything. Must be called before the change it is going to be updated with is
+        flushed. Writers pass lock so that concurrent writes of the
+        same user wait for each other instead of losing updates.
+        """
+        if lock:
+            inserted = False
+            if not cls._lock(user.id):
+                #whoever inserts the row first holds it until its transaction ends,
+                #the others find it there and lock it once it is committed
+                inserted = cls._insert(user.id)
+                if not inserted:
+                    cls._lock(user.id)
+            aggregate = db.session.get(cls, user.id, populate_existing=True)
+            if inserted:
+                with db.session.no_autoflush:
+                    aggregate.rebuild()
+            return aggregate
+
+        aggregate = db.session.get(cls, user.id)
+        if aggregate is None and not db.session.info.get("primary"):
+            #a replica may lag behind the row's creation
+            stick_to_primary(db.session)
+            aggregate = db.session.get(cls, user.id)
+        if aggregate is None:
+            aggregate = cls(user_id=user.id, change_seq=0, stats_watermark=0, stats_generation=0)
+            #without the backref, which would cascade the aggregate into the session
+            set_committed_value(aggregate, "user", user)
+            with db.session.no_autoflush:
+                aggregate.rebuild(rollups=False)
+        return aggregate
+
+    @classmethod
+    def _lock(cls, user_id):
+        """
+        Takes the row lock (SQLite's write lock) of a user's aggregate with a no-op
+        update. Returns False if the row doesn't exist.
+        """
+        result = db.session.execute(
+            cls.__table__.update().where(cls.user_id == user_id)
+            .values(change_seq=cls.change_seq, updated_at=cls.updated_at)
+        )
+        return result.rowcount > 0
+
+    @classmethod
+    def _insert(cls, user_id):
+        """
+        Inserts an empty aggregate row for a user unless one exists. Returns True if
+        this transaction inserted it.
+        """
+        dialect = postgresql if db.session.get_bind().dialect.name == "postgresql" else sqlite
+        result = db.session.execute(
+            dialect.insert(cls.__table__).values(user_id=user_id)
+            .on_conflict_do_nothing(index_elements=[cls.user_id])
+        )
+        return result.rowcount > 0
+
+    def rebuild(self, rollups=True):
+        """
+        Recomputes all totals, and unless told otherwise the measurement rollups, from
+        the exercise and measurement tables
+        """
+        excr = db.session.query(
+            func.count(Exercise.id), func.min(Exercise.date), func.max(Exercise.date)
+        ).filter(Exercise.user_id == self.user_id).one()
+        meas = db.session.query(
+            func.count(Measurements.id),
+            func.count(func.distinct(func.date(Measurements.date))),
+            func.coalesce(func.sum(Measurements.calories_in), 0),
+            func.coalesce(func.sum(Measurements.calories_out), 0),
+            func.min(Measurements.date),
+            func.max(Measurements.date)
+        ).filter(Measurements.user_id == self.user_id).one()
+        self.exercise_count = excr[0]
+        self.measurement_count, self.measurement_days = meas[0], meas[1]
+        self.calories_in_sum, self.calories_out_sum = float(meas[2]), float(meas[3])
+        self.first_date = min((date for date in (excr[1], meas[4]) if date), default=None)
+        self.last_date = max((date for date in (excr[2], meas[5]) if date), default=None)
+        if rollups:
+            MeasurementsRollup.rebuild(self.user_id)
+
+    def add_exercise(self, exercise):
+        """
+        Adds a new (or updated) exercise to the totals
+        """
+        self.exercise_count += 1
+        self._extend_bounds(exercise.date)
+        self._record_change("exercise", 1, exercise)
+
+    def remove_exercise(self, exercise):
+        """
+        Removes a deleted exercise, or the old values of an updated one, from the totals
+        """
+        self.exercise_count -= 1
+        self._shrink_bounds(exercise)
+        self._record_change("exercise", -1, exercise)
+
+    def add_measurement(self, measurement):
+        """
+        Adds a new (or updated) measurement to the totals
+        """
+        if not self._other_measurements_on_day(measurement):
+            self.measurement_days += 1
+        self.measurement_count += 1
+        self.calories_in_sum += measurement.calories_in or 0
+        self.calories_out_sum += measurement.calories_out or 0
+        self._extend_bounds(measurement.date)
+        self._record_change("measurement", 1, measurement)
+        MeasurementsRollup.apply(self.user_id, [measurement])
+
+    def remove_measurement(self, measurement):
+        """
+        Removes a deleted measurement, or the old values of an updated one, from the totals
+        """
+        if not self._other_measurements_on_day(measurement):
+            self.measurement_days -= 1
+        self.measurement_count -= 1
+        self.calories_in_sum -= measurement.calories_in or 0
+        self.calories_out_sum -= measurement.calories_out or 0
+        self._shrink_bounds(measurement)
+        self._record_change("measurement", -1, measurement)
+        MeasurementsRollup.apply(self.user_id, [measurement], sign=-1)
+
+    def add_exercises(self, rows):
+        """
+        Adds a batch of new exercises, given as column dicts, to the totals
+        """
+        for row in rows:
+            self._extend_bounds(row["date"])
+        self.exercise_count += len(rows)
+        self._record_changes("exercise", rows)
+
+    def add_measurements(self, rows):
+        """
+        Adds a batch of new measurements, given as column dicts, to the totals.
+        Must be called before the rows are inserted.
+        """
+        if not rows:
+            return
+        days = {row["date"].date() for row in rows}
+        first = datetime.combine(min(days), datetime.min.time())
+        last = datetime.combine(max(days), datetime.min.time()) + timedelta(days=1)
+        with db.session.no_autoflush:
+            recorded = db.session.query(func.date(Measurements.date)).filter(
+                Measurements.user_id == self.user_id,
+                Measurements.date >= first,
+                Measurements.date < last
+            ).distinct().all()
+        recorded = {date.fromisoformat(str(row[0])) for row in recorded}
+        self.measurement_days += len(days - recorded)
+        self.measurement_count += len(rows)
+        for row in rows:
+            self.calories_in_sum += row["calories_in"] or 0
+            self.calories_out_sum += row["calories_out"] or 0
+            self._extend_bounds(row["date"])
+        self._record_changes("measurement", rows)
+        MeasurementsRollup.apply(self.user_id, rows)
+
+    def _record_changes(self, kind, rows):
+        changes = []
+        for row in rows:
+            self.change_seq += 1
+            changes.append({
+                "user_id": self.user_id,
+                "seq": self.change_seq,
+                "kind": kind,
+                "sign": 1,
+                "date": row["date"],
+                "calories_in": row.get("calories_in"),
+                "calories_out": row.get("calories_out")
+            })
+        if changes and not self._cap_journal():
+            db.session.execute(StatsChange.__table__.insert(), changes)
+
+    def _record_change(self, kind, sign, item):
+        self.change_seq += 1
+        if self._cap_journal():
+            return
+        change = StatsChange(user_id=self.user_id, seq=self.change_seq, kind=kind, sign=sign,
+                             date=item.date)
+        if kind == "measurement":
+            change.calories_in = item.calories_in
+            change.calories_out = item.calories_out
+        db.session.add(change)
+
+    def _cap_journal(self):
+        #a worker this far behind is better off resyncing from the totals: dropping
+        #the changes moves the watermark, and the base of the next task, past its own
+        if self.change_seq - self.stats_watermark <= self.MAX_PENDING_CHANGES:
+            return False
+        with db.session.no_autoflush:
+            self.acknowledge(self.change_seq)
+        return True
+
+    def resync(self):
+        """
+        Rebuilds the totals after rows were changed without going through the journal
+        (archive jobs) and moves the watermark past all changes so that the stats
+        worker resyncs from the totals instead of merging changes
+        """
+        self.rebuild()
+        self.change_seq += 1
+        self.acknowledge(self.change_seq)
+
+    def pending_changes(self):
+        """
+        Returns the changes the stats worker hasn't acknowledged yet, oldest first
+        """
+        return StatsChange.query.filter(
+            StatsChange.user_id == self.user_id,
+            StatsChange.seq > self.stats_watermark
+        ).order_by(StatsChange.seq)
+
+    def acknowledge(self, watermark):
+        """
+        Marks changes up to watermark as merged by the stats worker and drops them
+        """
+        if watermark <= self.stats_watermark:
+            return
+        self.stats_watermark = min(watermark, self.change_seq)
+        StatsChange.query.filter(
+            StatsChange.user_id == self.user_id,
+            StatsChange.seq <= self.stats_watermark
+        ).delete(synchronize_session=False)
+
+    def request_stats(self, timeout):
+        """
+        Registers a request for new stats. Returns True if a task of a new generation
+        has to be sent, or False if the request can attach to the pending task because
+        it was sent less than timeout seconds ago and includes every change. A timeout
+        of 0 disables coalescing.
+        """
+        now = datetime.utcnow()
+        if (self.stats_requested is not None and self.stats_requested_seq == self.change_seq
+                and now - self.stats_requested < timedelta(seconds=timeout)):
+            return False
+        self.stats_generation += 1
+        self.stats_requested = now
+        self.stats_requested_seq = self.change_seq
+        self._keep_updated_at()
+        return True
+
+    def stats_received(self, generation):
+        """
+        Ends the pending task when the stats of its generation (or a newer one) arrive
+        """
+        if generation is not None and generation >= self.stats_generation:
+            self.stats_requested = None
+            self.stats_requested_seq = None
+            self._keep_updated_at()
+
+    def _keep_updated_at(self):
+        #pending stats don't change the user's collections, keep their Last-Modified
+        if inspect(self).persistent:
+            flag_modified(self, "updated_at")
+
+    def _other_measurements_on_day(self, measurement):
+        day = datetime.combine(measurement.date.date(), datetime.min.time())
+        query = Measurements.query.filter(
+            Measurements.user_id == self.user_id,
+            Measurements.date >= day,
+            Measurements.date < day + timedelta(days=1)
+        )
+        if measurement.id is not None:
+            query = query.filter(Measurements.id != measurement.id)
+        with db.session.no_autoflush:
+            return query.first() is not None
+
+    def _extend_bounds(self, date):
+        if self.first_date is None or date < self.first_date:
+            self.first_date = date
+        if self.last_date is None or date > self.last_date:
+            self.last_date = date
+
+    def _shrink_bounds(self, item):
+        #bounds only need to be looked up again if the removed item was on one of them
+        if item.date not in (self.first_date, self.last_date):
+            return
+        firsts, lasts = [], []
+        for model in (Exercise, Measurements):
+            query = db.session.query(func.min(model.date), func.max(model.date)).filter(
+                model.user_id == self.user_id)
+            if isinstance(item, model):
+                query = query.filter(model.id != item.id)
+            with db.session.no_autoflush:
+                first, last = query.one()
+            if first is not None:
+                firsts.append(first)
+                lasts.append(last)
+        self.first_date = min(firsts, default=None)
+        self.last_date = max(lasts, default=None)
+
+    def serialize(self):
+        """
+        Function for serializing aggregate data
+        """
+        return {
+            "user_id": self.user_id,
+            "exercise_count": self.exercise_count,
+            "measurement_count": self.measurement_count,
+            "measurement_days": self.measurement_days,
+            "calories_in_sum": self.calories_in_sum,
+            "calories_out_sum": self.calories_out_sum,
+            "first_date": datetime.isoformat(self.first_date) if self.first_date else None,
+            "last_date": datetime.isoformat(self.last_date) if self.last_date else None,
+            "watermark": self.change_seq
+        }
+
+    def compute_stats(self):
+        """
+        Computes the same stats document as the stats worker, in constant time
+        """
+        return stats_document(self.user, self.exercise_count, self.measurement_count,
+                              self.calories_in_sum, self.calories_out_sum)
+
+class StatsChange(db.Model):
+    """
+    Database model for the journal of exercise/measurement changes not yet merged by
+    the stats worker. A removed or edited item is recorded with sign -1 and its old values.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="cascade"),
+                        primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    kind = db.Column(db.String(16), nullable=False)
+    sign = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+    calories_in = db.Column(db.Float, nullable=True)
+    calories_out = db.Column(db.Float, nullable=True)
+
+    def serialize(self):
+        """
+        Function for serializing a change
+        """
+        return {
+            "seq": self.seq,
+            "kind": self.kind,
+            "sign": self.sign,
+            "date": datetime.isoformat(self.date),
+            "calories_in": self.calories_in,
+            "calories_out": self.calories_out
+        }
+
+class MeasurementsRollup(db.Model):
+    """
+    Database model for per-user daily, weekly and monthly aggregates of measurements.
+    Maintained together with the running totals (see UserAggregate) so that trends can
+    be read with one row per bucket. date is the start of the bucket, weeks start on
+    Monday.
+    """
+    BUCKETS = ("day", "week", "month")
+    __table_args__ = (db.UniqueConstraint("user_id", "bucket", "date",
+                                          name="uq_measurements_rollup_user_id_bucket_date"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="cascade"), nullable=False)
+    bucket = db.Column(db.String(8), nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    weight_count = db.Column(db.Integer, nullable=False, default=0)
+    weight_sum = db.Column(db.Float, nullable=False, default=0)
+    weight_min = db.Column(db.Float, nullable=True)
+    weight_max = db.Column(db.Float, nullable=True)
+    calories_in_count = db.Column(db.Integer, nullable=False, default=0)
+    calories_in_sum = db.Column(db.Float, nullable=False, default=0)
+    calories_out_count = db.Column(db.Integer, nullable=False, default=0)
+    calories_out_sum = db.Column(db.Float, nullable=False, default=0)
+
+    @staticmethod
+    def bucket_start(bucket, moment):
+        """
+        Returns the start of the bucket the given time falls in
+        """
+        day = datetime.combine(moment.date(), datetime.min.time())
+        if bucket == "week":
+            return day - timedelta(days=day.weekday())
+        if bucket == "month":
+            return day.replace(day=1)
+        return day
+
+    @staticmethod
+    def bucket_end(bucket, start):
+        """
+        Returns the start of the next bucket
+        """
+        if bucket == "week":
+            return start + timedelta(weeks=1)
+        if bucket == "month":
+            return (start + timedelta(days=32)).replace(day=1)
+        return start + timedelta(days=1)
+
+    @classmethod
+    def apply(cls, user_id, items, sign=1):
+        """
+        Adds (sign 1) or removes (sign -1) measurements, given as models or column
+        dicts, to the user's buckets. Removed measurements must still be in the
+        measurements table with their old values.
+        """
+        items = [_measurement_values(item) for item in items]
+        if not items:
+            return
+        starts = [cls.bucket_start(bucket, item["date"]) for item in items
+                  for bucket in cls.BUCKETS]
+        with db.session.no_autoflush:
+            rollups = {(rollup.bucket, rollup.date): rollup for rollup in cls.query.filter(
+                cls.user_id == user_id, cls.date >= min(starts), cls.date <= max(starts)
+            )}
+        #buckets created earlier in this transaction, e.g. by rebuild, aren't flushed yet
+        rollups.update({(rollup.bucket, rollup.date): rollup for rollup in db.session.new
+                        if isinstance(rollup, cls) and rollup.user_id == user_id})
+        for item in items:
+            for bucket in cls.BUCKETS:
+                key = (bucket, cls.bucket_start(bucket, item["date"]))
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollup = rollups[key] = cls(user_id=user_id, bucket=bucket, date=key[1])
+                    db.session.add(rollup)
+                #emptied buckets are kept (an edit may move the item right back),
+                #reads skip them and rebuild drops them
+                rollup._add(item, sign)
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """
+        Recomputes the user's buckets from the measurements table
+        """
+        db.session.execute(cls.__table__.delete().where(cls.user_id == user_id))
+        rollups = {}
+        query = db.session.query(
+            Measurements.date, Measurements.weight, Measurements.calories_in,
+            Measurements.calories_out
+        ).filter(Measurements.user_id == user_id)
+        for row in query.yield_per(1000):
+            for bucket in cls.BUCKETS:
+                key = (bucket, cls.bucket_start(bucket, row.date))
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollup = rollups[key] = cls(user_id=user_id, bucket=bucket, date=key[1])
+                rollup._add(row._asdict(), 1)
+        db.session.add_all(rollups.values())
+
+    def _add(self, item, sign):
+        self.count = (self.count or 0) + sign
+        weight = item.get("weight")
+        if weight is not None:
+            self.weight_count = (self.weight_count or 0) + sign
+            self.weight_sum = (self.weight_sum or 0) + sign * weight
+            if sign > 0:
+                self.weight_min = weight if self.weight_min is None else min(self.weight_min,
+                                                                             weight)
+                self.weight_max = weight if self.weight_max is None else max(self.weight_max,
+                                                                             weight)
+            elif weight in (self.weight_min, self.weight_max):
+                self._rescan_weight(item.get("id"))
+        for name in ("calories_in", "calories_out"):
+            value = item.get(name)
+            if value is not None:
+                setattr(self, name + "_count", (getattr(self, name + "_count") or 0) + sign)
+                setattr(self, name + "_sum", (getattr(self, name + "_sum") or 0) + sign * value)
+
+    def _rescan_weight(self, removed_id):
+        #min and max can't be decremented, look them up from the rest of the bucket
+        query = db.session.query(func.min(Measurements.weight), func.max(Measurements.weight)
+        ).filter(
+            Measurements.user_id == self.user_id,
+            Measurements.date >= self.date,
+            Measurements.date < self.bucket_end(self.bucket, self.date),
+            Measurements.id != removed_id
+        )
+        with db.session.no_autoflush:
+            self.weight_min, self.weight_max = query.one()
+
+    def serialize(self):
+        """
+        Function for serializing a bucket
+        """
+        def average(total, count):
+            return total / count if count else None
+        return {
+            "bucket": self.bucket,
+            "date": datetime.isoformat(self.date),
+            "count": self.count,
+            "weight_min": self.weight_min,
+            "weight_max": self.weight_max,
+            "weight_avg": average(self.weight_sum, self.weight_count),
+            "calories_in_sum": self.calories_in_sum,
+            "calories_in_avg": average(self.calories_in_sum, self.calories_in_count),
+            "calories_out_sum": self.calories_out_sum,
+            "calories_out_avg": average(self.calories_out_sum, self.calories_out_count)
+        }
+
+def _measurement_values(item):
+    if isinstance(item, dict):
+        return item
+    return {name: getattr(item, name)
+            for name in ("id", "date", "weight", "calories_in", "calories_out")}
+
+class ExerciseArchive(db.Model):
+    """
+    Database model for exercises moved out of the exercise table by an archive job.
+    Keeps the original id.
+    """
+    __table_args__ = (db.Index("ix_exercise_archive_user_id_date", "user_id", "date"),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(64), nullable=False)
+    duration = db.Column(db.Float, nullable=True)
+    date = db.Column(db.DateTime, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="cascade"), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class MeasurementsArchive(db.Model):
+    """
+    Database model for measurements moved out of the measurements table by an archive
+    job. Keeps the original id.
+    """
+    __table_args__ = (db.Index("ix_measurements_archive_user_id_date", "user_id", "date"),)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date = db.Column(db.DateTime, nullable=False)
+    weight = db.Column(db.Float, nullable=True)
+    calories_in = db.Column(db.Float, nullable=True)
+    calories_out = db.Column(db.Float, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="cascade"), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class Job(SchemaMixin, db.Model):
+    """
+    Database model for background jobs (user deletion, stats pruning, archiving).
+    user_id is not a foreign key so that the job of a deleted user can still be polled.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    params = db.Column(db.Text, nullable=False, default="{}")
+    status = db.Column(db.String(16), nullable=False, default="queued")
+    total = db.Column(db.Integer, nullable=True)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True)
+
+    def serialize(self):
+        """
+        Function for serializing job status
+        """
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "user_id": self.user_id,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.processed,
+            "error": self.error,
+            "created": datetime.isoformat(self.created),
+            "started": self.started and datetime.isoformat(self.started),
+            "finished": self.finished and datetime.isoformat(self.finished)
+        }
+
+    @staticmethod
+    def json_schema():
+        """
+        JSON schema for starting an archive job, the only job started with a body
+        """
+        schema = {
+            "type": "object",
+            "required": ["before"]
+        }
+        props = schema["properties"] = {}
+        props["before"] = {
+            "description": "Entries dated before this datetime string are archived",
+            "type": "string"
+        }
+        return schema
+
+#compile schema validators once at import instead of on the first request
+for _model in (Exercise, User, Measurements, Stats, Job):
+    _model.validator()
+
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
@@ -287,6 +1066,91 @@ def init_db_command():
     """
     db.create_all()
 
+def rebuild_sqlite_table(conn, table):
+    """
+    Recreates a SQLite table with the definition of table, keeping its rows, for
+    changes ALTER TABLE can't make. Follows
+    https://www.sqlite.org/lang_altertable.html#otheralter: foreign keys are off
+    meanwhile so that dropping the old table doesn't cascade to the rows of other
+    tables, which keep referencing the table by name. conn must be in autocommit mode.
+    """
+    new = table.to_metadata(MetaData(), name=table.name + "_new")
+    columns = ", ".join(column.name for column in table.columns)
+    #on the DBAPI connection, SQLAlchemy would commit after each DDL statement
+    cursor = conn.connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=OFF")
+    try:
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute(str(CreateTable(new).compile(dialect=conn.dialect)))
+            cursor.execute(f'INSERT INTO "{new.name}" ({columns}) '
+                           f'SELECT {columns} FROM "{table.name}"')
+            cursor.execute(f'DROP TABLE "{table.name}"')
+            cursor.execute(f'ALTER TABLE "{new.name}" RENAME TO "{table.name}"')
+            if cursor.execute("PRAGMA foreign_key_check").fetchone() is not None:
+                raise RuntimeError(f"Rebuilding {table.name} broke foreign keys")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+    finally:
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+def _has_autoincrement(conn, table):
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' "
+                            "AND name = :name"), {"name": table.name}).scalar()
+    return "AUTOINCREMENT" in (ddl or "").upper()
+
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    """
+    Command for upgrading an existing database in place. Creates missing tables
+    and adds missing columns and indexes to existing ones. SQLite tables that should
+    have AUTOINCREMENT are rebuilt with it.
+    """
+    existing = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            click.echo(f"Created table {table.name}")
+            continue
+        present = {column["name"] for column in inspect(db.engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in present:
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                #quoted, "user" is reserved in PostgreSQL
+                name = db.engine.dialect.identifier_preparer.format_table(table)
+                with db.engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {name} ADD COLUMN {ddl}"))
+                click.echo(f"Added column {table.name}.{column.name}")
+        present = {index["name"] for index in inspect(db.engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in present:
+                index.create(bind=db.engine)
+                click.echo(f"Created index {index.name}")
+    #SQLite reuses the highest id of a deleted row unless the table has AUTOINCREMENT
+    if db.engine.dialect.name == "sqlite":
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for table in db.metadata.sorted_tables:
+                if table.dialect_options["sqlite"]["autoincrement"] \
+                        and not _has_autoincrement(conn, table):
+                    rebuild_sqlite_table(conn, table)
+                    click.echo(f"Rebuilt table {table.name} with AUTOINCREMENT")
+    #running totals that already exist are missing the buckets of a new rollup table
+    if MeasurementsRollup.__tablename__ not in existing:
+        for (user_id,) in db.session.query(UserAggregate.user_id).all():
+            MeasurementsRollup.rebuild(user_id)
+        db.session.commit()
+    #users created before the running totals get them built from their history
+    missing = User.query.filter(~User.aggregate.has()).all()
+    for user in missing:
+        UserAggregate.for_user(user, lock=True)
+    db.session.commit()
+    if missing:
+        click.echo(f"Built running totals of {len(missing)} users")
+
 @click.command("fill-db")
 @with_appcontext
 def fill_db_command():
@@ -314,3 +1178,7 @@ def fill_db_command():
                 meas.get("date"),"%d/%m/%y %H:%M:%S"), user_id=meas.get("user_id"))
             db.session.add(entry)
         db.session.commit()
+        #running totals of the inserted history, like the API creates them with the user
+        for user in User.query.all():
+            UserAggregate.for_user(user, lock=True)
+        db.session.commit()
@@ -0,0 +1,75 @@
+"""
+In-process delivery of new stats to clients listening on the stats events stream
+"""
+import queue
+import threading
+from flask import current_app
+
+class StatsNotifier:
+    """
+    Per-process registry of listeners keyed by user id. Each listener gets its own
+    small queue; when a slow listener's queue is full the oldest stats are dropped
+    since only the latest ones matter.
+    """
+    def __init__(self, queue_size=8):
+        self.queue_size = queue_size
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """
+        Registers a listener for a user's stats and returns its queue
+        """
+        listener = queue.Queue(self.queue_size)
+        with self._lock:
+            self._listeners.setdefault(user_id, set()).add(listener)
+        return listener
+
+    def unsubscribe(self, user_id, listener):
+        """
+        Removes a listener returned by subscribe
+        """
+        with self._lock:
+            listeners = self._listeners.get(user_id, set())
+            listeners.discard(listener)
+            if not listeners:
+                self._listeners.pop(user_id, None)
+
+    def publish(self, user_id, stats):
+        """
+        Hands stats to the listeners of their user. Returns the number of listeners.
+        """
+        with self._lock:
+            listeners = list(self._listeners.get(user_id, ()))
+        for listener in listeners:
+            while True:
+                try:
+                    listener.put_nowait(stats)
+                    break
+                except queue.Full:
+                    try:
+                        listener.get_nowait()
+                    except queue.Empty:
+                        pass
+        return len(listeners)
+
+    def listener_count(self, user_id=None):
+        """
+        Number of listeners of a user, or of all users
+        """
+        with self._lock:
+            if user_id is not None:
+                return len(self._listeners.get(user_id, ()))
+            return sum(len(listeners) for listeners in self._listeners.values())
+
+def init_app(app):
+    """
+    Creates the notifier of the app
+    """
+    app.extensions["stats_notifier"] = StatsNotifier()
+
+def get_notifier():
+    """
+    Returns the notifier of the current app
+    """
+    return current_app.extensions["stats_notifier"]
@@ -3,38 +3,88 @@ Implementation for exercise resources
 """
 
 import json
-from datetime import datetime
-from flask import Response, request
+from flask import Response, request, stream_with_context
 from flask import url_for
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from werkzeug.exceptions import UnsupportedMediaType, BadRequest
-from fitnessbuddy.models import db, Exercise
-from fitnessbuddy.utils import MasonBuilder
+from fitnessbuddy.cache import cached
+from fitnessbuddy.routing import read_only
+from fitnessbuddy.models import db, Exercise, UserAggregate, parse_datetime
+from fitnessbuddy.utils import (MasonBuilder, check_owner, paginate, filter_date_range,
+                                stream_collection, read_bulk_items, prepare_bulk_rows,
+                                ControlTemplate, check_not_modified, collection_validators,
+                                set_validators, commit_or_conflict)
 
 MASON = "application/vnd.mason+json"
 
+def _collection_controls(res, user):
+    res.add_control("self", url_for("api.exercisecollection", user=user))
+    res.add_control("fitnessbuddy:user", url_for("api.useritem", user=user))
+    res.add_control_post("fitnessbuddy:add-exercise", "fitnessbuddy:add-exercise",
+                         url_for("api.exercisecollection", user=user),
+                         schema_url=url_for("api.schemaitem", schema="exercise"))
+
+def _item_controls(res, user, exercise):
+    res.add_control("self", url_for("api.exerciseitem", user=user, exercise=exercise))
+    res.add_control("fitnessbuddy:exercises-all", url_for("api.exercisecollection",
+                                                          user=user), title="All exercises")
+    res.add_control_delete("Delete exercise", url_for("api.exerciseitem",
+                                                      user=user, exercise=exercise))
+    res.add_control_put("Edit exercise", url_for("api.exerciseitem",
+                                                 user=user, exercise=exercise),
+                        schema_url=url_for("api.schemaitem", schema="exercise"))
+
+def _bulk_controls(res, user):
+    res.add_control("self", url_for("api.exercisebulk", user=user))
+    res.add_control("fitnessbuddy:exercises-all", url_for("api.exercisecollection", user=user),
+                    title="All exercises")
+
+#controls are built once per app, see ControlTemplate
+COLLECTION_CONTROLS = ControlTemplate(_collection_controls, "user")
+ITEM_CONTROLS = ControlTemplate(_item_controls, "user", "exercise")
+BULK_CONTROLS = ControlTemplate(_bulk_controls, "user")
+
 class ExerciseCollection(Resource):
     """
     Exercise resource
     """
+    @cached
+    @read_only()
     def get(self, user):
         """
         Get method for Exercise colleciton
         """
+        etag, last_modified = collection_validators(user, "exercises")
+        not_modified = check_not_modified(etag, last_modified)
+        if not_modified:
+            return not_modified
+
+        res = MasonBuilder()
+        res.add_controls(COLLECTION_CONTROLS, user=user)
+
+        #stream the whole (date filtered) collection instead of a single page
+        if request.args.get("stream") in ("1", "true"):
+            query = filter_date_range(Exercise.query.filter_by(user=user), Exercise, request.args)
+            query = query.order_by(Exercise.date, Exercise.id)
+            resp = Response(stream_with_context(stream_collection(res, "exercises", query)),
+                            200, mimetype=MASON)
+            return set_validators(resp, etag, last_modified)
+
         body = []
-        for item in Exercise.query.filter_by(user=user).all():
+        page = paginate(Exercise.query.filter_by(user=user), Exercise, request.args)
+        for item in page.items:
             excr_item = item.serialize()
             body.append(excr_item)
 
-        res = MasonBuilder()
         res["exercises"] = body
-        res.add_control("self", url_for("api.exercisecollection", user=user))
-        res.add_control("fitnessbuddy:user", url_for("api.useritem", user=user))
-        res.add_control_post("fitnessbuddy:add-exercise", "fitnessbuddy:add-exercise",
-                             url_for("api.exercisecollection", user=user), Exercise.json_schema())
+        if page.next:
+            res.add_control_next(url_for("api.exercisecollection", user=user, **page.next))
+        if page.prev:
+            res.add_control_prev(url_for("api.exercisecollection", user=user, **page.prev))
 
-        return Response(json.dumps(res), 200, mimetype=MASON)
+        return set_validators(Response(json.dumps(res), 200, mimetype=MASON),
+                              etag, last_modified)
 
     def post(self, user):
         """
@@ -45,20 +95,22 @@ class ExerciseCollection(Resource):
             raise UnsupportedMediaType
         request.json["user_id"] = user.id
         try:
-            validate(request.json, Exercise.json_schema())
+            Exercise.validate(request.json)
         except ValidationError as err:
             raise BadRequest(description=str(err)) from err
 
+        aggregate = UserAggregate.for_user(user, lock=True)
         exrc = Exercise()
         exrc.deserialize(request.json)
         exrc.user = user
 
-        #Add entry to db
+        #Add entry to db and update the user's running totals in the same transaction
         db.session.add(exrc)
+        aggregate.add_exercise(exrc)
         db.session.commit()
 
         res = MasonBuilder()
-        res.add_control("self", url_for("api.exerciseitem", user=exrc.user, exercise=exrc))
+        res.add_control("self", url_for("api.exerciseitem", user=user, exercise=exrc))
 
         return Response(json.dumps(res), 201, mimetype=MASON)
 
@@ -71,21 +123,18 @@ class ExerciseItem(Resource):
         """
         Get method for ExerciseItem
         """
-        if user != exercise.user:
-            raise BadRequest(description=
-                "Requested exercise does not correspond to requested user")
+        check_owner(user, exercise, "Requested exercise does not correspond to requested user")
+
+        etag = f"exercise-{exercise.id}-{exercise.version}"
+        not_modified = check_not_modified(etag, exercise.updated_at)
+        if not_modified:
+            return not_modified
 
         res = MasonBuilder()
         res["exercise"] = exercise.serialize()
-        res.add_control("self", url_for("api.exerciseitem", user=user, exercise=exercise))
-        res.add_control("fitnessbuddy:exercises-all", url_for("api.exercisecollection",
-                                                              user=user), title="All exercises")
-        res.add_control_delete("Delete exercise", url_for("api.exerciseitem",
-                                                          user=exercise.user, exercise=exercise))
-        res.add_control_put("Edit exercise", url_for("api.exerciseitem",
-                                                     user=exercise.user, exercise=exercise),
-                                                     Exercise.json_schema())
-        return Response(json.dumps(res), 200, mimetype=MASON)
+        res.add_controls(ITEM_CONTROLS, user=user, exercise=exercise)
+        return set_validators(Response(json.dumps(res), 200, mimetype=MASON),
+                              etag, exercise.updated_at)
 
     def put(self, user, exercise):
         """
@@ -93,32 +142,62 @@ class ExerciseItem(Resource):
         """
         if not request.is_json:
             raise UnsupportedMediaType
+        check_owner(user, exercise, "Requested exercise does not correspond to requested user")
         if request.json.get("user_id"):
             if not request.json["user_id"] == user.id:
                 raise BadRequest(description="UserID mismatch in request address and body")
         else:
             request.json["user_id"] = user.id
         try:
-            validate(request.json, Exercise.json_schema())
+            Exercise.validate(request.json)
         except ValidationError as err:
             raise BadRequest(description=str(err)) from err
 
-        #update database entry
+        #update database entry (replacing the old values in the running totals)
+        aggregate = UserAggregate.for_user(user, lock=True)
+        aggregate.remove_exercise(exercise)
         exercise.name = request.json["name"]
         exercise.duration = request.json["duration"]
         exercise.user_id = request.json["user_id"]
-        exercise.date = datetime.fromisoformat(request.json["date"])
-        db.session.commit()
+        exercise.date = parse_datetime(request.json["date"])
+        aggregate.add_exercise(exercise)
+        commit_or_conflict("Exercise was modified by another request, try again")
 
         #204 has no response body
         return Response(status=204, headers={"location":str(url_for("api.exerciseitem",
-            user=exercise.user, exercise=exercise))})
+            user=user, exercise=exercise))})
 
     def delete(self, user, exercise):
         """
         Delete method for ExerciseItem
         """
+        check_owner(user, exercise, "Requested exercise does not correspond to requested user")
+        UserAggregate.for_user(user, lock=True).remove_exercise(exercise)
         db.session.delete(exercise)
-        db.session.commit()
+        commit_or_conflict("Exercise was modified by another request, try again")
 
         return Response("Entry deleted", status=204)
+
+
+class ExerciseBulk(Resource):
+    """
+    Bulk ingest of exercises
+    """
+    def post(self, user):
+        """
+        Post method for ExerciseBulk. Accepts a JSON array or NDJSON of exercises, inserts
+        the valid ones in a single transaction and returns a result for every item.
+        """
+        rows, results = prepare_bulk_rows(user, Exercise, read_bulk_items())
+        if rows:
+            #update the running totals before inserting so new days can be counted
+            UserAggregate.for_user(user, lock=True).add_exercises(rows)
+            db.session.execute(Exercise.__table__.insert(), rows)
+            db.session.commit()
+
+        res = MasonBuilder()
+        res["results"] = results
+        res["created"] = len(rows)
+        res["failed"] = len(results) - len(rows)
+        res.add_controls(BULK_CONTROLS, user=user)
+        return Response(json.dumps(res), 200, mimetype=MASON)
@@ -0,0 +1,36 @@
+"""
+Job resource implementations
+"""
+import json
+from flask import Response, url_for
+from flask_restful import Resource
+from fitnessbuddy.models import db, User
+from fitnessbuddy.utils import MasonBuilder
+
+MASON = "application/vnd.mason+json"
+
+def job_accepted(job):
+    """
+    Returns the 202 response of a request that started a job, pointing to the job
+    """
+    href = url_for("api.jobitem", job=job)
+    res = MasonBuilder()
+    res["job"] = job.serialize()
+    res.add_control("fitnessbuddy:job", href, title="Job status")
+    return Response(json.dumps(res), 202, mimetype=MASON, headers={"location": href})
+
+class JobItem(Resource):
+    """
+    Resource for polling the status of a background job. Methods: get
+    """
+    def get(self, job):
+        """
+        Method for getting job status
+        """
+        res = MasonBuilder()
+        res["job"] = job.serialize()
+        res.add_control("self", url_for("api.jobitem", job=job))
+        user = db.session.get(User, job.user_id) if job.user_id is not None else None
+        if user is not None:
+            res.add_control("fitnessbuddy:user", url_for("api.useritem", user=user))
+        return Response(json.dumps(res), 200, mimetype=MASON)
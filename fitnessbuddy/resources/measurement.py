@@ -3,42 +3,104 @@ Measurement resource implementations
 """
 
 import json
-from datetime import datetime
-from flask import Response, request
+from flask import Response, request, stream_with_context
 from flask import url_for
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from werkzeug.exceptions import UnsupportedMediaType, BadRequest
-from fitnessbuddy.models import db, Measurements
-from fitnessbuddy.utils import MasonBuilder
+from fitnessbuddy.cache import cached
+from fitnessbuddy.routing import read_only
+from fitnessbuddy.models import (db, Measurements, MeasurementsRollup, UserAggregate,
+                                 parse_datetime)
+from fitnessbuddy.utils import (MasonBuilder, check_owner, paginate, filter_date_range,
+                                stream_collection, read_bulk_items, prepare_bulk_rows,
+                                ControlTemplate, check_not_modified, collection_validators,
+                                set_validators, commit_or_conflict)
 
 MASON = "application/vnd.mason+json"
 
+def _collection_controls(res, user):
+    res.add_control("self", url_for("api.measurementscollection", user=user))
+    res.add_control("fitnessbuddy:user", url_for("api.useritem", user=user))
+    res.add_control_post("fitnessbuddy:add-measurement", "fitnessbuddy:addmeasurement",
+                         url_for("api.measurementscollection", user=user),
+                         schema_url=url_for("api.schemaitem", schema="measurement"))
+    res.add_control("fitnessbuddy:rollup", url_for("api.measurementsrollupcollection",
+                                                   user=user), title="Trends")
+
+def _item_controls(res, user, measurements):
+    res.add_control("self", url_for("api.measurementsitem", user=user,
+                                    measurements=measurements))
+    res.add_control("fitnessbuddy:measurements-all", url_for("api.measurementscollection",
+                                            user=user), title="All measurements")
+    res.add_control_delete("Delete measurements", url_for("api.measurementsitem",
+                                            user=user, measurements=measurements))
+    res.add_control_put("Edit measurements", url_for("api.measurementsitem",
+                                            user=user, measurements=measurements),
+                        schema_url=url_for("api.schemaitem", schema="measurement"))
+
+def _bulk_controls(res, user):
+    res.add_control("self", url_for("api.measurementsbulk", user=user))
+    res.add_control("fitnessbuddy:measurements-all", url_for("api.measurementscollection",
+                                                             user=user),
+                    title="All measurements")
+
+def _rollup_controls(res, user):
+    res.add_control("self", url_for("api.measurementsrollupcollection", user=user))
+    res.add_control("fitnessbuddy:measurements-all", url_for("api.measurementscollection",
+                                                             user=user),
+                    title="All measurements")
+
+# controls are built once per app, see ControlTemplate
+COLLECTION_CONTROLS = ControlTemplate(_collection_controls, "user")
+ITEM_CONTROLS = ControlTemplate(_item_controls, "user", "measurements")
+BULK_CONTROLS = ControlTemplate(_bulk_controls, "user")
+ROLLUP_CONTROLS = ControlTemplate(_rollup_controls, "user")
+
 class MeasurementsCollection(Resource):
     """
     Class for measurements
     """
+    @cached
+    @read_only()
     def get(self, user):
         """
         Get method for MeasurementCollection
         """
+        etag, last_modified = collection_validators(user, "measurements")
+        not_modified = check_not_modified(etag, last_modified)
+        if not_modified:
+            return not_modified
+
+        res = MasonBuilder()
+        res.add_controls(COLLECTION_CONTROLS, user=user)
+
+        # stream the whole (date filtered) collection instead of a single page
+        if request.args.get("stream") in ("1", "true"):
+            query = filter_date_range(Measurements.query.filter_by(user=user), Measurements,
+                                      request.args)
+            query = query.order_by(Measurements.date, Measurements.id)
+            resp = Response(stream_with_context(stream_collection(res, "measurements", query)),
+                            200, mimetype=MASON)
+            return set_validators(resp, etag, last_modified)
+
         # initialize response body
         body = []
-        # find all users and add them to the response
-        for item in Measurements.query.filter_by(user=user).all():
+        # find one page of the user's measurements and add them to the response
+        page = paginate(Measurements.query.filter_by(user=user), Measurements, request.args)
+        for item in page.items:
             measurement_item = item.serialize()
             body.append(measurement_item)
 
-        res = MasonBuilder()
         res["measurements"] = body
-        res.add_control("self", url_for("api.measurementscollection", user=user))
-        res.add_control("fitnessbuddy:user", url_for("api.useritem", user=user))
-        res.add_control_post("fitnessbuddy:add-measurement", "fitnessbuddy:addmeasurement",
-                             url_for("api.measurementscollection", user=user),
-                             Measurements.json_schema())
+        if page.next:
+            res.add_control_next(url_for("api.measurementscollection", user=user, **page.next))
+        if page.prev:
+            res.add_control_prev(url_for("api.measurementscollection", user=user, **page.prev))
 
-        # return users
-        return Response(json.dumps(res), 200, mimetype=MASON)
+        # return measurements
+        return set_validators(Response(json.dumps(res), 200, mimetype=MASON),
+                              etag, last_modified)
 
     def post(self, user):
         """
@@ -50,21 +112,23 @@ class MeasurementsCollection(Resource):
         request.json["user_id"] = user.id
         # check json schema
         try:
-            validate(request.json, Measurements.json_schema())
+            Measurements.validate(request.json)
         except ValidationError as error:
             raise BadRequest(description=str(error)) from error
 
-        # initialize new user using deserializer
+        # initialize new measurement using deserializer
+        aggregate = UserAggregate.for_user(user, lock=True)
         measurement = Measurements()
         measurement.deserialize(request.json)
         measurement.user = user
-        # add new user to database
+        # add new measurement to database and update the user's running totals
         db.session.add(measurement)
+        aggregate.add_measurement(measurement)
         db.session.commit()
 
         res = MasonBuilder()
         res.add_control("self", url_for("api.measurementsitem",
-                                        user=measurement.user, measurements=measurement))
+                                        user=user, measurements=measurement))
 
         return Response(json.dumps(res), 201, mimetype=MASON)
 
@@ -77,23 +141,19 @@ class MeasurementsItem(Resource):
         """
         Get method for MeasurementItem
         """
-        if user != measurements.user:
-            raise BadRequest(
-                description="Requested measurement does not correspond to requested user"
-            )
+        check_owner(user, measurements,
+                    "Requested measurement does not correspond to requested user")
+
+        etag = f"measurement-{measurements.id}-{measurements.version}"
+        not_modified = check_not_modified(etag, measurements.updated_at)
+        if not_modified:
+            return not_modified
 
         res = MasonBuilder()
         res["measurement"] = measurements.serialize()
-        res.add_control("self", url_for("api.measurementsitem", user=measurements.user,
-                                        measurements=measurements))
-        res.add_control("fitnessbuddy:measurements-all", url_for("api.measurementscollection",
-                                                user=user), title="All measurements")
-        res.add_control_delete("Delete measurements", url_for("api.measurementsitem",
-                                                user=measurements.user, measurements=measurements))
-        res.add_control_put("Edit measurements", url_for("api.measurementsitem",
-                                                user=measurements.user, measurements=measurements),
-                                                Measurements.json_schema())
-        return Response(json.dumps(res), 200, mimetype=MASON)
+        res.add_controls(ITEM_CONTROLS, user=user, measurements=measurements)
+        return set_validators(Response(json.dumps(res), 200, mimetype=MASON),
+                              etag, measurements.updated_at)
 
     def put(self, user, measurements):
         """
@@ -102,6 +162,8 @@ class MeasurementsItem(Resource):
         # check that request is json
         if not request.is_json:
             raise UnsupportedMediaType
+        check_owner(user, measurements,
+                    "Requested measurement does not correspond to requested user")
         if request.json["user_id"]:
             if not request.json["user_id"] == user.id:
                 raise BadRequest(
@@ -110,24 +172,27 @@ class MeasurementsItem(Resource):
 
         # check json schema
         try:
-            validate(request.json, Measurements.json_schema())
+            Measurements.validate(request.json)
         except Exception as error:
             raise BadRequest() from error
 
-        # update database entry
-        measurements.date = datetime.fromisoformat(request.json["date"])
+        # update database entry (replacing the old values in the running totals)
+        aggregate = UserAggregate.for_user(user, lock=True)
+        aggregate.remove_measurement(measurements)
+        measurements.date = parse_datetime(request.json["date"])
         measurements.weight = request.json["weight"]
         measurements.calories_in = request.json["calories_in"]
         measurements.calories_out = request.json["calories_out"]
         measurements.user_id = request.json["user_id"]
-        db.session.commit()
+        aggregate.add_measurement(measurements)
+        commit_or_conflict("Measurement was modified by another request, try again")
         return Response(
             status=204,
             headers={
                 "location": str(
                     url_for(
                         "api.measurementsitem",
-                        user=measurements.user,
+                        user=user,
                         measurements=measurements,
                     )
                 )
@@ -138,6 +203,68 @@ class MeasurementsItem(Resource):
         """
         Delete method for MeasurementItem
         """
+        check_owner(user, measurements,
+                    "Requested measurement does not correspond to requested user")
+        UserAggregate.for_user(user, lock=True).remove_measurement(measurements)
         db.session.delete(measurements)
-        db.session.commit()
+        commit_or_conflict("Measurement was modified by another request, try again")
         return Response(status=204)
+
+
+class MeasurementsBulk(Resource):
+    """
+    Bulk ingest of measurements
+    """
+    def post(self, user):
+        """
+        Post method for MeasurementsBulk. Accepts a JSON array or NDJSON of measurements, inserts
+        the valid ones in a single transaction and returns a result for every item.
+        """
+        rows, results = prepare_bulk_rows(user, Measurements, read_bulk_items())
+        if rows:
+            #update the running totals before inserting so new days can be counted
+            UserAggregate.for_user(user, lock=True).add_measurements(rows)
+            db.session.execute(Measurements.__table__.insert(), rows)
+            db.session.commit()
+
+        res = MasonBuilder()
+        res["results"] = results
+        res["created"] = len(rows)
+        res["failed"] = len(results) - len(rows)
+        res.add_controls(BULK_CONTROLS, user=user)
+        return Response(json.dumps(res), 200, mimetype=MASON)
+
+
+class MeasurementsRollupCollection(Resource):
+    """
+    Daily, weekly or monthly aggregates of a user's measurements
+    """
+    @cached
+    @read_only()
+    def get(self, user):
+        """
+        Get method for MeasurementsRollupCollection. Returns the non-empty buckets
+        selected by the bucket (day, week or month) and since/until query parameters,
+        read from the rollup table.
+        """
+        bucket = request.args.get("bucket", "day")
+        if bucket not in MeasurementsRollup.BUCKETS:
+            raise BadRequest(description="'bucket' must be one of: "
+                             + ", ".join(MeasurementsRollup.BUCKETS))
+        etag, last_modified = collection_validators(user, "rollup")
+        not_modified = check_not_modified(etag, last_modified)
+        if not_modified:
+            return not_modified
+
+        query = MeasurementsRollup.query.filter(
+            MeasurementsRollup.user_id == user.id,
+            MeasurementsRollup.bucket == bucket,
+            MeasurementsRollup.count > 0
+        )
+        query = filter_date_range(query, MeasurementsRollup, request.args)
+
+        res = MasonBuilder()
+        res["rollup"] = [rollup.serialize() for rollup in query.order_by(MeasurementsRollup.date)]
+        res.add_controls(ROLLUP_CONTROLS, user=user)
+        return set_validators(Response(json.dumps(res), 200, mimetype=MASON),
+                              etag, last_modified)
@@ -0,0 +1,23 @@
+"""
+Monitoring resource implementations
+"""
+import json
+from flask import Response, url_for
+from flask_restful import Resource
+from fitnessbuddy.cache import get_cache
+from fitnessbuddy.utils import MasonBuilder
+
+MASON = "application/vnd.mason+json"
+
+class CacheStats(Resource):
+    """
+    Response cache counters of the process serving the request
+    """
+    def get(self):
+        """
+        Get method for CacheStats
+        """
+        res = MasonBuilder()
+        res["cache"] = get_cache().stats()
+        res.add_control("self", url_for("api.cachestats"))
+        return Response(json.dumps(res), 200, mimetype=MASON)
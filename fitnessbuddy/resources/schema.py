@@ -0,0 +1,43 @@
+"""
+Schema resource implementations
+"""
+import json
+import functools
+from flask import Response, request
+from flask_restful import Resource
+from werkzeug.exceptions import NotFound
+from fitnessbuddy.models import Exercise, Measurements, User, Stats, Job
+
+SCHEMA = "application/schema+json"
+#schemas only change with a deploy
+SCHEMA_MAX_AGE = 86400
+SCHEMAS = {
+    "exercise": Exercise.json_schema,
+    "measurement": Measurements.json_schema,
+    "user": User.json_schema,
+    "stats": Stats.json_schema,
+    "archive": Job.json_schema
+}
+
+@functools.lru_cache(maxsize=None)
+def schema_body(name):
+    """
+    Returns a JSON schema, serialized once per process
+    """
+    return json.dumps(SCHEMAS[name]())
+
+class SchemaItem(Resource):
+    """
+    JSON schema of a model or a request body, referenced by the schemaUrl of add and edit controls
+    """
+    def get(self, schema):
+        """
+        Get method for SchemaItem
+        """
+        if schema not in SCHEMAS:
+            raise NotFound
+        resp = Response(schema_body(schema), 200, mimetype=SCHEMA)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = SCHEMA_MAX_AGE
+        resp.add_etag()
+        return resp.make_conditional(request)
@@ -2,36 +2,52 @@
 Statistics model implementations
 """
 
-import os
-import ssl
 import json
-import pika
-from flask import Response, request, url_for
+import time
+import queue
+import click
+from sqlalchemy import select
+from flask import Response, current_app, request, url_for
+from flask.cli import with_appcontext
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
-from werkzeug.exceptions import UnsupportedMediaType, BadRequest
-from fitnessbuddy.models import db, Stats, Measurements, Exercise
-from fitnessbuddy.utils import MasonBuilder
+from jsonschema import ValidationError
+from werkzeug.exceptions import UnsupportedMediaType, BadRequest, ServiceUnavailable
+from fitnessbuddy.models import db, Stats, User, UserAggregate
+from fitnessbuddy.utils import MasonBuilder, ControlTemplate, read_bulk_items
+from fitnessbuddy.broker import get_publisher, PublishError
+from fitnessbuddy.notify import get_notifier
+from fitnessbuddy.routing import read_only
+from fitnessbuddy.cache import get_cache, user_scope
 
 MASON = "application/vnd.mason+json"
+MAX_BATCH_USERS = 1000
 
-context = ssl.create_default_context()
-context.check_hostname = False
-context.verify_mode = ssl.CERT_NONE
+def _task_controls(res, user):
+    res.add_control_post("fitnessbuddy:add-stats", "Post new stats",
+                         url_for("api.userstats", user=user),
+                         schema_url=url_for("api.schemaitem", schema="stats"))
+    res.add_control("fitnessbuddy:stats-aggregate",
+                    url_for("api.useraggregateitem", user=user), title="Running totals")
 
-USR = ""
-PWD = ""
+def _aggregate_controls(res, user):
+    res.add_control("self", url_for("api.useraggregateitem", user=user))
+    res.add_control("fitnessbuddy:user", url_for("api.useritem", user=user))
+    res.add_control("fitnessbuddy:stats", url_for("api.userstats", user=user), title="Stats")
+    res.add_control("fitnessbuddy:stats-events", url_for("api.userstatsevents", user=user),
+                    title="New stats as server-sent events")
 
-#get credentials from \client directory
-CWD = str(os.getcwd())
-#if this is executed by pytest we have to remove "test" from the path
-if "test" in CWD:
-    CWD = CWD.replace("\\test", "")
-credentials_file = str("{}\client\pikacredentials.json".format(CWD))
-with open(credentials_file, encoding="utf-8") as f:
-    cred = json.load(f)
-    USR = cred.get("user")
-    PWD = cred.get("password")
+def _sync_controls(res, user):
+    res.add_control("self", url_for("api.userstats", user=user, mode="sync"))
+    res.add_control("fitnessbuddy:user", url_for("api.useritem", user=user))
+    res.add_control("fitnessbuddy:stats-aggregate",
+                    url_for("api.useraggregateitem", user=user), title="Running totals")
+    res.add_control("fitnessbuddy:stats-events", url_for("api.userstatsevents", user=user),
+                    title="New stats as server-sent events")
+
+#controls are built once per app, see ControlTemplate
+TASK_CONTROLS = ControlTemplate(_task_controls, "user")
+AGGREGATE_CONTROLS = ControlTemplate(_aggregate_controls, "user")
+SYNC_CONTROLS = ControlTemplate(_sync_controls, "user")
 
 class UserStats(Resource):
     """
@@ -40,15 +56,45 @@ class UserStats(Resource):
     def get(self, user):
         """
         Method for generating new user statistics whenever clients sents a get request.
+        With ?mode=sync the stats are computed right away and returned instead.
+        The X-Stats-Task header of the 202 tells whether a task was queued, deferred
+        (the broker is unreachable and the task is retried from the outbound buffer)
+        or the request attached to a pending task.
         """
-        #delete old stats
-        for item in Stats.query.filter_by(user=user).all():
-            db.session.delete(item)
+        mode = request.args.get("mode", "async")
+        if mode not in ("sync", "async"):
+            raise BadRequest(description="'mode' must be sync or async")
+        if mode == "sync":
+            with read_only():
+                stats = Stats.compute(user)
+            res = MasonBuilder()
+            res["stats"] = stats
+            res.add_controls(SYNC_CONTROLS, user=user)
+            return Response(json.dumps(res), 200, mimetype=MASON)
+
+        #while a task with every change is pending further requests attach to it,
+        #its stats reach all listeners of the user
+        aggregate = UserAggregate.for_user(user, lock=True)
+        if not aggregate.request_stats(current_app.config["STATS_TASK_TIMEOUT"]):
+            db.session.commit()
+            return Response(status=202, headers={"X-Stats-Task": "pending"})
+        #the new stats replace the old ones, only a few are kept between requests
+        pruned = db.session.execute(Stats.__table__.delete().where(Stats.user_id == user.id))
         db.session.commit()
+        if pruned.rowcount:
+            #Core statements bypass the session events that invalidate cached responses
+            get_cache().invalidate({user_scope(user.id)})
 
         #send task to generate new stats
-        self.send_task(user)
-        return Response(status=202)
+        try:
+            sent = self.send_task(user)
+        except ServiceUnavailable:
+            #nothing is pending, let the next request try again
+            aggregate = UserAggregate.for_user(user, lock=True)
+            aggregate.stats_received(aggregate.stats_generation)
+            db.session.commit()
+            raise
+        return Response(status=202, headers={"X-Stats-Task": "queued" if sent else "deferred"})
 
     def post(self, user):
         """
@@ -62,7 +108,7 @@ class UserStats(Resource):
                 raise BadRequest(description="UserID mismatch in request address and body")
         #check json schema
         try:
-            validate(request.json, Stats.json_schema())
+            Stats.validate(request.json)
         except ValidationError as error:
             raise BadRequest(description=str(error)) from error
 
@@ -71,7 +117,17 @@ class UserStats(Resource):
         stats.deserialize(request.json)
         stats.user = user
         db.session.add(stats)
+        #changes included in these stats no longer need to be sent to the worker
+        #and the pending task ends with them
+        watermark, generation = request.json.get("watermark"), request.json.get("generation")
+        if watermark is not None or generation is not None:
+            aggregate = UserAggregate.for_user(user, lock=True)
+            if watermark is not None:
+                aggregate.acknowledge(watermark)
+            aggregate.stats_received(generation)
         db.session.commit()
+        #push to clients listening on the events stream of this user
+        get_notifier().publish(user.id, stats.serialize())
 
         res = MasonBuilder()
         res.add_control("self", url_for("api.userstats", user=user))
@@ -79,40 +135,238 @@ class UserStats(Resource):
         return Response(json.dumps(res), 201, mimetype=MASON)
 
     def send_task(self, user):
-        #get current data from user
-        body_excr = []
-        body_meas = []
+        """
+        Sends a task with the user's changes since the worker's last acknowledged
+        watermark. The journal is capped (see UserAggregate.MAX_PENDING_CHANGES),
+        a worker further behind finds the base past its watermark and resyncs from
+        the running totals instead. Returns False if the task was buffered to be
+        sent when the broker is reachable again.
+        """
+        #from a replica unless this request wrote something already
+        with read_only():
+            aggregate = UserAggregate.for_user(user)
+            changes = aggregate.pending_changes().all()
+
         res = MasonBuilder()
-        for item in Exercise.query.filter_by(user=user).all():
-            excr_item = item.serialize()
-            body_excr.append(excr_item)
-        for item in Measurements.query.filter_by(user=user).all():
-            measurement_item = item.serialize()
-            body_meas.append(measurement_item)
-
-        res["exercises"] = body_excr
-        res["measurements"] = body_meas
         res["user"] = user.serialize()
+        res["base"] = aggregate.stats_watermark
+        res["changes"] = [change.serialize() for change in changes]
+        res["watermark"] = aggregate.change_seq
+        #tasks of older generations are superseded by this one
+        res["generation"] = aggregate.stats_generation
+
+        res.add_controls(TASK_CONTROLS, user=user)
+
+        #publish new task to "stats" queue over the app's long-lived connection
+        try:
+            return get_publisher().publish(json.dumps(res))
+        except PublishError as error:
+            raise ServiceUnavailable(description=str(error)) from error
+
+class StatsBulk(Resource):
+    """
+    Bulk submission of many users' stats, e.g. by the stats worker. Methods: post
+    """
+    def post(self):
+        """
+        Accepts a JSON array or NDJSON of stats of any users, stores the valid ones in
+        a single transaction and returns a result for every item. Watermarks and
+        generations are handled like in UserStats.post.
+        """
+        items = read_bulk_items()
+        docs = [doc for doc in items if isinstance(doc, dict)]
+        schema_errors = iter(Stats.validate_many(docs))
+        user_ids = {doc.get("user_id") for doc in docs if isinstance(doc.get("user_id"), int)}
+        users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+
+        stored, results = [], []
+        for index, doc in enumerate(items):
+            error = None
+            if isinstance(doc, str):
+                error = doc
+            elif not isinstance(doc, dict):
+                error = "Item must be a JSON object"
+            else:
+                error = next(schema_errors)
+            if error is None and doc["user_id"] not in users:
+                results.append({"index": index, "status": 404, "error": "User not found"})
+                continue
+            if error is None:
+                stats = Stats()
+                try:
+                    stats.deserialize(doc)
+                except (KeyError, ValueError) as err:
+                    error = f"Invalid stats: {err}"
+            if error is not None:
+                results.append({"index": index, "status": 400, "error": error})
+                continue
+            db.session.add(stats)
+            stored.append((stats, doc))
+            results.append({"index": index, "status": 201})
+
+        #one lock per user, taken in id order so that concurrent batches can't deadlock
+        received = {}
+        for stats, doc in stored:
+            watermark, generation = received.get(stats.user_id, (None, None))
+            if doc.get("watermark") is not None:
+                watermark = max(watermark or 0, doc["watermark"])
+            if doc.get("generation") is not None:
+                generation = max(generation or 0, doc["generation"])
+            received[stats.user_id] = (watermark, generation)
+        for user_id in sorted(received):
+            watermark, generation = received[user_id]
+            if watermark is None and generation is None:
+                continue
+            aggregate = UserAggregate.for_user(users[user_id], lock=True)
+            if watermark is not None:
+                aggregate.acknowledge(watermark)
+            aggregate.stats_received(generation)
+        db.session.commit()
+        notifier = get_notifier()
+        for stats, _ in stored:
+            notifier.publish(stats.user_id, stats.serialize())
+
+        res = MasonBuilder()
+        res["results"] = results
+        res["created"] = len(stored)
+        res["failed"] = len(results) - len(stored)
+        res.add_control("self", url_for("api.statsbulk"))
+        return Response(json.dumps(res), 200, mimetype=MASON)
+
+class StatsExport(Resource):
+    """
+    Resource for what the stats of many users are computed from, read by batch
+    tasks of the stats worker. Methods: get
+    """
+    @read_only()
+    def get(self):
+        """
+        Returns the columns of the users listed in ?users=1,2,3 (at most
+        MAX_BATCH_USERS), see Stats.export
+        """
+        try:
+            user_ids = [int(item) for item in request.args.get("users", "").split(",") if item]
+        except ValueError as error:
+            raise BadRequest(description="'users' must be a comma separated list of ids") \
+                from error
+        if not user_ids or len(user_ids) > MAX_BATCH_USERS:
+            raise BadRequest(description=f"'users' must list 1-{MAX_BATCH_USERS} user ids")
+
+        res = MasonBuilder()
+        res["users"] = Stats.export(user_ids)
+        res.add_control("self", url_for("api.statsexport", users=request.args["users"]))
+        res.add_control_post("fitnessbuddy:add-stats-bulk", "Post stats of many users",
+                             url_for("api.statsbulk"),
+                             schema_url=url_for("api.schemaitem", schema="stats"))
+        return Response(json.dumps(res), 200, mimetype=MASON)
+
+def send_batch_task(user_ids):
+    """
+    Sends a task that recomputes the stats of many users at once. The worker reads
+    their columns from the export and posts the results to the bulk resource.
+    """
+    res = MasonBuilder()
+    res["kind"] = "batch"
+    res["users"] = user_ids
+    res.add_control("fitnessbuddy:stats-export",
+                    url_for("api.statsexport", users=",".join(map(str, user_ids))))
+    res.add_control_post("fitnessbuddy:add-stats-bulk", "Post stats of many users",
+                         url_for("api.statsbulk"),
+                         schema_url=url_for("api.schemaitem", schema="stats"))
+    get_publisher().publish(json.dumps(res))
+
+@click.command("refresh-stats")
+@click.option("--batch-size", type=click.IntRange(1, MAX_BATCH_USERS), default=500,
+              help="users per batch task")
+@with_appcontext
+def refresh_stats_command(batch_size):
+    """
+    Command for queueing batch tasks that recompute the stats of every user,
+    e.g. nightly
+    """
+    user_ids = db.session.execute(select(User.id).order_by(User.id)).scalars().all()
+    #hrefs of the tasks are built without a request
+    with current_app.test_request_context():
+        try:
+            for start in range(0, len(user_ids), batch_size):
+                send_batch_task(user_ids[start:start + batch_size])
+        except PublishError as error:
+            raise click.ClickException(str(error)) from error
+    tasks = (len(user_ids) + batch_size - 1) // batch_size
+    #the command exits right away, so buffered tasks would be lost
+    if not get_publisher().flush():
+        raise click.ClickException(
+            f"Broker unavailable, {get_publisher().pending} batch task(s) were not sent")
+    click.echo(f"Queued {tasks} batch task(s) for {len(user_ids)} users")
+
+def _event(stats):
+    return f"id: {stats['id']}\nevent: stats\ndata: {json.dumps(stats)}\n\n"
+
+class UserStatsEvents(Resource):
+    """
+    Resource for receiving a user's new stats as server-sent events. Methods: get
+    """
+    def get(self, user):
+        """
+        Streams the stats posted for the user from now on as "stats" events with the
+        stats id as event id. A client that reconnects with Last-Event-ID (or ?after=id)
+        first gets the latest stats stored after that id. Comment lines are sent every
+        STATS_EVENTS_HEARTBEAT seconds and the stream ends after STATS_EVENTS_TIMEOUT
+        seconds, after which EventSource clients reconnect.
+        """
+        last_id = request.headers.get("Last-Event-ID", request.args.get("after"))
+        try:
+            last_id = None if last_id is None else int(last_id)
+        except ValueError as error:
+            raise BadRequest(description="Last event id must be an integer") from error
+
+        #subscribe before looking up missed stats so that nothing falls in between
+        notifier = get_notifier()
+        listener = notifier.subscribe(user.id)
+        missed = None
+        if last_id is not None:
+            missed = Stats.query.filter(Stats.user_id == user.id, Stats.id > last_id) \
+                .order_by(Stats.id.desc()).first()
+            missed = missed and missed.serialize()
+
+        heartbeat = current_app.config["STATS_EVENTS_HEARTBEAT"]
+        timeout = current_app.config["STATS_EVENTS_TIMEOUT"]
+
+        #the stream doesn't use the database, so no connection is held while it's open
+        def stream():
+            yield "retry: 3000\n\n"
+            if missed:
+                yield _event(missed)
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    stats = listener.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _event(stats)
+
+        response = Response(stream(), 200, mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        response.call_on_close(lambda: notifier.unsubscribe(user.id, listener))
+        return response
+
+class UserAggregateItem(Resource):
+    """
+    Resource for user's running totals and the stats derived from them. Methods: get
+    """
+    def get(self, user):
+        """
+        Method for getting user statistics synchronously from the running totals
+        """
+        aggregate = UserAggregate.for_user(user)
+
+        res = MasonBuilder()
+        res["aggregate"] = aggregate.serialize()
+        res["stats"] = aggregate.compute_stats()
+        res.add_controls(AGGREGATE_CONTROLS, user=user)
 
-        res.add_control_post("fitnessbuddy:add-stats", "Post new stats",
-                             url_for("api.userstats", user=user), Stats.json_schema())
-
-        #connect to rabbitMQ
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host="193.167.189.95",
-                port=5672,
-                virtual_host="ryhma-jll-vhost",
-                credentials=pika.PlainCredentials(USR, PWD),
-                ssl_options=pika.SSLOptions(context)
-            )
-        )
-        #publish new task to "stats" queue
-        channel = connection.channel()
-        channel.queue_declare(queue="stats")
-        channel.basic_publish(
-            exchange="",
-            routing_key="stats",
-            body=json.dumps(res)
-        )
-        connection.close()
+        return Response(json.dumps(res), 200, mimetype=MASON)
@@ -2,21 +2,55 @@
 Resources for User
 """
 import json
-from datetime import datetime
 from flask import Response, request, url_for
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from werkzeug.exceptions import UnsupportedMediaType, BadRequest
 from sqlalchemy.exc import IntegrityError
-from fitnessbuddy.models import db, User
-from fitnessbuddy.utils import MasonBuilder
+from fitnessbuddy import jobs
+from fitnessbuddy.cache import cached
+from fitnessbuddy.routing import read_only
+from fitnessbuddy.models import db, User, UserAggregate, Job, parse_datetime
+from fitnessbuddy.utils import MasonBuilder, ControlTemplate, check_not_modified, set_validators
+from fitnessbuddy.utils import commit_or_conflict
+from fitnessbuddy.resources.job import job_accepted
 
 MASON = "application/vnd.mason+json"
 
+def _collection_controls(res):
+    res.add_control("self", url_for("api.usercollection"))
+    res.add_control_post("fitnessbuddy:add-user", "Add user", url_for("api.usercollection"),
+                         schema_url=url_for("api.schemaitem", schema="user"))
+
+def _item_controls(res, user):
+    res.add_control("self", url_for("api.useritem", user=user))
+    res.add_control("fitnessbuddy:exercises-all",
+                    url_for("api.exercisecollection", user=user), title="All exercises")
+    res.add_control("fitnessbuddy:measurements-all",
+                    url_for("api.measurementscollection", user=user), title="All measurements")
+    res.add_control("fitnessbuddy:users-all", url_for("api.usercollection"), title="All users")
+    res.add_control("fitnessbuddy:stats", url_for("api.userstats", user=user), title="Stats")
+    res.add_control("fitnessbuddy:stats-aggregate", url_for("api.useraggregateitem", user=user),
+                    title="Running totals")
+    res.add_control("fitnessbuddy:stats-events", url_for("api.userstatsevents", user=user),
+                    title="New stats as server-sent events")
+    res.add_control_post("fitnessbuddy:archive", "Archive old entries",
+                         url_for("api.userarchive", user=user),
+                         schema_url=url_for("api.schemaitem", schema="archive"))
+    res.add_control_delete("Delete user", url_for("api.useritem", user=user))
+    res.add_control_put("Edit user", url_for("api.useritem", user=user),
+                        schema_url=url_for("api.schemaitem", schema="user"))
+
+#controls are built once per app, see ControlTemplate
+COLLECTION_CONTROLS = ControlTemplate(_collection_controls)
+ITEM_CONTROLS = ControlTemplate(_item_controls, "user")
+
 class UserCollection(Resource):
     """
     Resource for user collections. Methods: get, post
     """
+    @cached
+    @read_only()
     def get(self):
         """
         Method for getting all user information
@@ -30,8 +64,7 @@ class UserCollection(Resource):
             body.append(user_item)
 
         res["users"] = body
-        res.add_control("self", "/api/users/")
-        res.add_control_post("fitnessbuddy:add-user", "Add user", "/api/users/", User.json_schema())
+        res.add_controls(COLLECTION_CONTROLS)
 
         #return users
         return Response(json.dumps(res), 200, mimetype=MASON)
@@ -45,13 +78,15 @@ class UserCollection(Resource):
             raise UnsupportedMediaType
         #check json schema
         try:
-            validate(request.json, User.json_schema())
+            User.validate(request.json)
         except ValidationError as error:
             raise BadRequest(description=str(error)) from error
 
         #initialize new user using deserializer
         user = User()
         user.deserialize(request.json)
+        #the running totals are created with the user so writers only ever lock them
+        user.aggregate = UserAggregate(change_seq=0, stats_watermark=0, stats_generation=0)
 
         #add new user to database
         db.session.add(user)
@@ -67,23 +102,23 @@ class UserItem(Resource):
     """
     Resource for single user items. Methods: get, put, delete
     """
+    @cached
+    @read_only()
     def get(self, user):
         """
         Method for getting user information for a specific user
         """
+        etag = f"user-{user.id}-{user.version}"
+        not_modified = check_not_modified(etag, user.updated_at)
+        if not_modified:
+            return not_modified
+
         res = MasonBuilder()
         res["user"] = user.serialize()
-        res.add_control("self", url_for("api.useritem", user=user))
-        res.add_control("fitnessbuddy:exercises-all",
-                        url_for("api.exercisecollection", user=user), title="All exercises")
-        res.add_control("fitnessbuddy:measurements-all",
-                        url_for("api.measurementscollection", user=user), title="All measurements")
-        res.add_control("fitnessbuddy:users-all", url_for("api.usercollection"), title="All users")
-        res.add_control("fitnessbuddy:stats", url_for("api.userstats", user=user), title="Stats")
-        res.add_control_delete("Delete user", url_for("api.useritem", user=user))
-        res.add_control_put("Edit user", url_for("api.useritem", user=user), User.json_schema())
+        res.add_controls(ITEM_CONTROLS, user=user)
         
-        return Response(json.dumps(res), 200, mimetype=MASON)
+        return set_validators(Response(json.dumps(res), 200, mimetype=MASON),
+                              etag, user.updated_at)
 
     def put(self, user):
         """
@@ -94,7 +129,7 @@ class UserItem(Resource):
             raise UnsupportedMediaType
         #check json schema
         try:
-            validate(request.json, User.json_schema())
+            User.validate(request.json)
         except ValidationError as error:
             raise BadRequest(description=str(error)) from error
 
@@ -102,17 +137,35 @@ class UserItem(Resource):
         user.name = request.json["name"]
         user.email = request.json["email"]
         user.age = request.json["age"]
-        user.user_creation_date = datetime.fromisoformat(request.json["user_creation_date"])
-        db.session.commit()
+        user.user_creation_date = parse_datetime(request.json["user_creation_date"])
+        commit_or_conflict("User was modified by another request, try again")
         
         #204 has no response body
         return Response(status=204, headers={"location":url_for("api.useritem", user=user)})
 
     def delete(self, user):
         """
-        Method for deleting existing user
+        Method for deleting existing user. The user's history is deleted by a
+        background job, the response points to its status.
         """
-        db.session.delete(user)
-        db.session.commit()
-        #204 has no response body
-        return Response(status=204)
+        return job_accepted(jobs.submit("delete-user", user_id=user.id))
+
+
+class UserArchive(Resource):
+    """
+    Resource for archiving user's old exercises and measurements. Methods: post
+    """
+    def post(self, user):
+        """
+        Method for starting a job that moves exercises and measurements dated before
+        the given time to the archive
+        """
+        if not request.is_json:
+            raise UnsupportedMediaType
+        try:
+            Job.validate(request.json)
+            before = parse_datetime(request.json["before"])
+        except (ValidationError, ValueError) as error:
+            raise BadRequest(description=str(error)) from error
+        return job_accepted(jobs.submit("archive", user_id=user.id,
+                                        before=before.isoformat()))
@@ -0,0 +1,61 @@
+"""
+Routing of read-only queries to replica databases
+"""
+import random
+from contextlib import contextmanager
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+
+class RoutingSession(Session):
+    """
+    Session that sends queries made inside read_only sections to a random replica
+    and everything else to the primary. Once the session has written anything it
+    sticks to the primary, so the rest of the request reads its own writes. Queries
+    sent to a replica are counted, see replica_reads.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self._flushing or getattr(clause, "is_dml", False):
+            stick_to_primary(self)
+        elif bind is None and self.info.get("read_only") and not self.info.get("primary"):
+            replicas = current_app.extensions.get("replicas")
+            if replicas:
+                self.info["replica_reads"] = self.info.get("replica_reads", 0) + 1
+                return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def stick_to_primary(session):
+    """
+    Sends the session's remaining queries to the primary, e.g. before reading data
+    that is going to be written back
+    """
+    session.info["primary"] = True
+
+def replica_reads():
+    """
+    Returns the number of queries the current session has sent to replicas. A
+    replica may lag behind the primary, so what was read there may be stale.
+    """
+    return current_app.extensions["sqlalchemy"].session.info.get("replica_reads", 0)
+
+@contextmanager
+def read_only():
+    """
+    Allows the queries of the current session to go to a replica. Can also be used
+    as a decorator for resource methods.
+    """
+    info = current_app.extensions["sqlalchemy"].session.info
+    info["read_only"] = info.get("read_only", 0) + 1
+    try:
+        yield
+    finally:
+        info["read_only"] -= 1
+
+def init_app(app, options):
+    """
+    Creates the engines of the replica URIs in DATABASE_REPLICAS, with engine options
+    built by options(uri). Replicas are not binds since they hold the same tables.
+    """
+    app.extensions["replicas"] = [
+        create_engine(uri, **options(uri)) for uri in app.config["DATABASE_REPLICAS"]
+    ]
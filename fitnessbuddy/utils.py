@@ -1,19 +1,59 @@
 """
 Converter implementations
 """
+import json
+import base64
+import binascii
+from collections import namedtuple
+from datetime import datetime, timezone
+from flask import Response, g, request, current_app
+from sqlalchemy import tuple_
+from sqlalchemy.orm.exc import StaleDataError
 from werkzeug.routing import BaseConverter
-from werkzeug.exceptions import NotFound
-from fitnessbuddy.models import User, Measurements, Exercise
+from werkzeug.exceptions import (NotFound, BadRequest, UnsupportedMediaType,
+                                 RequestEntityTooLarge, Conflict)
+from fitnessbuddy.models import (db, User, Measurements, Exercise, UserAggregate, Job,
+                                 parse_datetime)
+from fitnessbuddy.routing import read_only
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+MAX_BULK_ITEMS = 10000
+NDJSON = "application/x-ndjson"
+
+Page = namedtuple("Page", ["items", "next", "prev"])
+
+def load_instance(model, value):
+    """
+    Loads a model instance by primary key for a URL converter. Instances are kept in a
+    per-request cache so repeated matches of the same id don't hit the database again.
+    """
+    cache = g.setdefault("converter_cache", {})
+    key = (model, value)
+    if key not in cache:
+        try:
+            cache[key] = db.session.get(model, int(value))
+        except ValueError:
+            cache[key] = None
+    if cache[key] is None:
+        raise NotFound
+    return cache[key]
+
+def check_owner(user, item, description):
+    """
+    Checks that an exercise or measurement belongs to the user in the URL. Compares
+    ids so that the item's user relationship doesn't have to be loaded.
+    """
+    if item.user_id != user.id:
+        raise BadRequest(description=description)
 
 class UserConverter(BaseConverter):
     """
     Converter for user resource
     """
     def to_python(self, value):
-        user = User.query.filter_by(id=value).first()
-        if user is None:
-            raise NotFound
-        return user
+        return load_instance(User, value)
 
     def to_url(self, value):
         return str(value.id)
@@ -23,10 +63,7 @@ class MeasurementsConverter(BaseConverter):
     Converter for measurement resource
     """
     def to_python(self, value):
-        measurement = Measurements.query.filter_by(id=value).first()
-        if measurement is None:
-            raise NotFound
-        return measurement
+        return load_instance(Measurements, value)
 
     def to_url(self, value):
         return str(value.id)
@@ -36,14 +73,293 @@ class ExerciseConverter(BaseConverter):
     Converter for exercise resource
     """
     def to_python(self, value):
-        exercise = Exercise.query.filter_by(id=value).first()
-        if exercise is None:
-            raise NotFound
-        return exercise
+        return load_instance(Exercise, value)
 
     def to_url(self, value):
         return str(value.id)
 
+class JobConverter(BaseConverter):
+    """
+    Converter for job resource
+    """
+    def to_python(self, value):
+        return load_instance(Job, value)
+
+    def to_url(self, value):
+        return str(value.id)
+
+def commit_or_conflict(description):
+    """
+    Commits the session. If a row being updated or deleted was changed by another
+    request after it was loaded, its row version no longer matches: the transaction
+    is rolled back and 409 Conflict is raised with the given description.
+    """
+    try:
+        db.session.commit()
+    except StaleDataError as error:
+        db.session.rollback()
+        raise Conflict(description=description) from error
+
+def encode_cursor(item):
+    """
+    Encodes the (date, id) position of an item into an opaque cursor string
+    """
+    raw = "{}|{}".format(datetime.isoformat(item.date), item.id)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor back to a (date, id) tuple
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        date, item_id = raw.split("|")
+        return datetime.fromisoformat(date), int(item_id)
+    except (ValueError, UnicodeError, binascii.Error) as error:
+        raise BadRequest(description="Invalid page cursor") from error
+
+def _parse_date_arg(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse_datetime(value)
+    except ValueError as error:
+        raise BadRequest(description=f"'{name}' must be an ISO 8601 datetime") from error
+
+def filter_date_range(query, model, args):
+    """
+    Applies the since (inclusive) and until (exclusive) query parameters to a query
+    """
+    since = _parse_date_arg(args, "since")
+    until = _parse_date_arg(args, "until")
+    if since is not None:
+        query = query.filter(model.date >= since)
+    if until is not None:
+        query = query.filter(model.date < until)
+    return query
+
+def stream_collection(envelope, key, query, chunk_size=None):
+    """
+    Generator that writes a Mason document with the serialized items of query under key.
+    The envelope (controls etc.) is written first and items follow in chunks as they are
+    fetched from the database, so memory use doesn't grow with the size of the collection.
+    """
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    head = json.dumps(envelope)[:-1]
+    yield head + (", " if envelope else "") + json.dumps(key) + ": ["
+    chunk = []
+    separator = ""
+    #the stream is read after the resource method (and its read_only section) returned
+    with read_only():
+        for item in query.yield_per(chunk_size):
+            chunk.append(json.dumps(item.serialize()))
+            if len(chunk) == chunk_size:
+                yield separator + ", ".join(chunk)
+                separator = ", "
+                chunk = []
+    if chunk:
+        yield separator + ", ".join(chunk)
+    yield "]}"
+
+def _http_date(value):
+    #HTTP dates have second precision and stored timestamps are naive UTC
+    return value.replace(microsecond=0, tzinfo=timezone.utc)
+
+def set_validators(resp, etag, last_modified=None):
+    """
+    Sets the (weak) ETag and Last-Modified headers of a response
+    """
+    resp.set_etag(etag, weak=True)
+    if last_modified is not None:
+        resp.last_modified = _http_date(last_modified)
+    return resp
+
+def check_not_modified(etag, last_modified=None):
+    """
+    Returns a 304 response if the client's cached copy is current according to
+    If-None-Match, or If-Modified-Since when no ETags were sent. Returns None if
+    the full response has to be built.
+    """
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        fresh = _http_date(last_modified) <= request.if_modified_since
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    return set_validators(Response(status=304), etag, last_modified)
+
+def collection_validators(user, kind):
+    """
+    Returns the ETag and Last-Modified of one of the user's collections. They come
+    from the user's running totals, which change with every exercise and measurement
+    write, so the collection itself doesn't have to be queried. Nothing is written:
+    a user without the totals (see upgrade-db) hasn't been written to since, their
+    collections are at version 0 until the first write creates them.
+    """
+    aggregate = db.session.get(UserAggregate, user.id)
+    if aggregate is None:
+        return f"{kind}-{user.id}-0", None
+    return f"{kind}-{user.id}-{aggregate.change_seq}", aggregate.updated_at
+
+def read_bulk_items():
+    """
+    Reads the items of a bulk request body, either a JSON array or NDJSON (one object
+    per line). Returns a list where lines that aren't valid JSON are replaced by the
+    error message.
+    """
+    if request.mimetype == NDJSON:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError as error:
+                items.append(f"Invalid JSON: {error}")
+    elif request.is_json:
+        items = request.get_json()
+        if not isinstance(items, list):
+            raise BadRequest(description="Bulk request body must be a JSON array")
+    else:
+        raise UnsupportedMediaType
+    if len(items) > MAX_BULK_ITEMS:
+        raise RequestEntityTooLarge(
+            description=f"At most {MAX_BULK_ITEMS} items can be sent in one request")
+    return items
+
+def prepare_bulk_rows(user, model, items):
+    """
+    Validates bulk items with the model's batch validator and converts the
+    valid ones to column dicts for an executemany insert. Returns (rows, results)
+    where results has a status (201 or 400) for every item in request order.
+    """
+    #leave out the id and columns filled in by defaults (row version, timestamps)
+    columns = [column.name for column in model.__table__.columns
+               if not column.primary_key and column.default is None]
+    for doc in items:
+        if isinstance(doc, dict):
+            doc.setdefault("user_id", user.id)
+    schema_errors = iter(model.validate_many([doc for doc in items if isinstance(doc, dict)]))
+    rows, results = [], []
+    for index, doc in enumerate(items):
+        error = None
+        if isinstance(doc, str):
+            error = doc
+        elif not isinstance(doc, dict):
+            error = "Item must be a JSON object"
+        else:
+            error = next(schema_errors)
+            if error is None and doc["user_id"] != user.id:
+                error = "UserID mismatch in request address and body"
+        if error is None:
+            instance = model()
+            try:
+                instance.deserialize(doc)
+            except ValueError as err:
+                error = str(err)
+        if error is not None:
+            results.append({"index": index, "status": 400, "error": error})
+            continue
+        rows.append({column: getattr(instance, column) for column in columns})
+        results.append({"index": index, "status": 201})
+    return rows, results
+
+def paginate(query, model, args):
+    """
+    Keyset pagination on (date, id) for a query over a model with a date column.
+    Supported query parameters:
+    - limit: page size (default PAGE_SIZE, at most MAX_PAGE_SIZE)
+    - after / before: cursor of the item the page starts after / ends before
+    - since / until: only include items with since <= date < until
+    The cursor is compared as a row value, which the (user_id, date) indexes seek
+    to, and only limit + 1 rows are fetched from the database. Returns a Page whose
+    next and prev fields are the query arguments for the adjacent pages (or None).
+    """
+    try:
+        limit = int(args.get("limit", PAGE_SIZE))
+    except ValueError as error:
+        raise BadRequest(description="'limit' must be an integer") from error
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise BadRequest(description=f"'limit' must be between 1 and {MAX_PAGE_SIZE}")
+    if args.get("after") and args.get("before"):
+        raise BadRequest(description="Only one of 'after' and 'before' can be given")
+
+    #filters and page size are carried over to the next/prev links
+    query = filter_date_range(query, model, args)
+    carry = {"limit": limit}
+    carry.update({name: args[name] for name in ("since", "until") if args.get(name)})
+
+    backwards = bool(args.get("before"))
+    if args.get("after"):
+        date, item_id = decode_cursor(args["after"])
+        query = query.filter(tuple_(model.date, model.id) > tuple_(date, item_id))
+    elif backwards:
+        date, item_id = decode_cursor(args["before"])
+        query = query.filter(tuple_(model.date, model.id) < tuple_(date, item_id))
+
+    if backwards:
+        query = query.order_by(model.date.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.date.asc(), model.id.asc())
+    items = query.limit(limit + 1).all()
+    has_more = len(items) > limit
+    items = items[:limit]
+    if backwards:
+        items.reverse()
+
+    #the extra row tells whether there is more in the walking direction, the
+    #cursor we came from tells whether there is more in the other one
+    if backwards:
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, bool(args.get("after"))
+    next_args = prev_args = None
+    if items and has_next:
+        next_args = dict(carry, after=encode_cursor(items[-1]))
+    if items and has_prev:
+        prev_args = dict(carry, before=encode_cursor(items[0]))
+    return Page(items, next_args, prev_args)
+
+
+class _Placeholder:
+    """
+    Stands in for a model instance when building control templates. Converters put
+    its id, a format field like {user}, into the URL.
+    """
+    def __init__(self, name):
+        self.id = "{" + name + "}"
+
+class ControlTemplate:
+    """
+    @controls of one resource type built once per app. The build function adds the
+    controls to a MasonBuilder for placeholder instances of the given URL parameters;
+    per request only the ids are filled into the hrefs.
+    """
+    def __init__(self, build, *params):
+        self.build = build
+        self.params = params
+
+    def _compile(self):
+        templates = current_app.extensions.setdefault("mason_templates", {})
+        controls = templates.get(self)
+        if controls is None:
+            builder = MasonBuilder()
+            self.build(builder, *(_Placeholder(param) for param in self.params))
+            controls = [(name, control.pop("href"), control)
+                        for name, control in builder["@controls"].items()]
+            templates[self] = controls
+        return controls
+
+    def render(self, **items):
+        """
+        Returns the controls for the given instances (keyword per URL parameter)
+        """
+        ids = {name: item.id for name, item in items.items()}
+        return {name: dict(control, href=href.format_map(ids))
+                for name, href, control in self._compile()}
 
 class MasonBuilder(dict):
     """
@@ -67,10 +383,19 @@ class MasonBuilder(dict):
         self["@controls"][ctrl_name] = kwargs
         self["@controls"][ctrl_name]["href"] = href
 
+    def add_controls(self, template, **items):
+        """
+        Adds all controls of a ControlTemplate, filled in with the given instances.
+
+        : param ControlTemplate template: precomputed controls of the resource type
+        """
+
+        self.setdefault("@controls", {}).update(template.render(**items))
+
     """
     Class for building Mason objects, taken mostly from course exercise examples 
     """
-    def add_control_post(self, ctrl_name, title, href, schema):
+    def add_control_post(self, ctrl_name, title, href, schema=None, schema_url=None):
         """
         Utility method for adding POST type controls. The control is
         constructed from the method's parameters. Method and encoding are
@@ -80,6 +405,7 @@ class MasonBuilder(dict):
         : param str href: target URI for the control
         : param str title: human-readable title for the control
         : param dict schema: a dictionary representing a valid JSON schema
+        : param str schema_url: URI of the schema, used instead of inlining it
         """
 
         self.add_control(
@@ -88,10 +414,10 @@ class MasonBuilder(dict):
             method="POST",
             encoding="json",
             title=title,
-            schema=schema
+            **_schema_property(schema, schema_url)
         )
 
-    def add_control_put(self, title, href, schema):
+    def add_control_put(self, title, href, schema=None, schema_url=None):
         """
         Utility method for adding PUT type controls. The control is
         constructed from the method's parameters. Control name, method and
@@ -100,6 +426,7 @@ class MasonBuilder(dict):
         : param str href: target URI for the control
         : param str title: human-readable title for the control
         : param dict schema: a dictionary representing a valid JSON schema
+        : param str schema_url: URI of the schema, used instead of inlining it
         """
 
         self.add_control(
@@ -108,9 +435,27 @@ class MasonBuilder(dict):
             method="PUT",
             encoding="json",
             title=title,
-            schema=schema
+            **_schema_property(schema, schema_url)
         )
 
+    def add_control_next(self, href):
+        """
+        Utility method for adding a link to the next page of a paginated collection.
+
+        : param str href: target URI for the control
+        """
+
+        self.add_control("next", href, title="Next page")
+
+    def add_control_prev(self, href):
+        """
+        Utility method for adding a link to the previous page of a paginated collection.
+
+        : param str href: target URI for the control
+        """
+
+        self.add_control("prev", href, title="Previous page")
+
     def add_control_delete(self, title, href):
         """
         Utility method for adding PUT type controls. The control is
@@ -128,3 +473,8 @@ class MasonBuilder(dict):
             method="DELETE",
             title=title,
         )
+
+def _schema_property(schema, schema_url):
+    if schema_url is not None:
+        return {"schemaUrl": schema_url}
+    return {"schema": schema}
@@ -7,3 +7,73 @@ from os.path import dirname as d
 from os.path import abspath
 root_dir = d(d(abspath(__file__)))
 sys.path.append(root_dir)
+
+import pika
+
+
+class FakeBroker:
+    """
+    In-process stand-in for a RabbitMQ broker. Used as BROKER_CONNECTION_FACTORY so that
+    tests can publish without a real broker. Set down or nack to simulate failures.
+    """
+    def __init__(self):
+        self.queues = {}
+        self.connections = 0
+        self.down = False
+        self.nack = False
+
+    def __call__(self, parameters):
+        if self.down:
+            raise pika.exceptions.AMQPConnectionError("broker down")
+        self.connections += 1
+        return FakeConnection(self)
+
+    def messages(self, queue="stats"):
+        """
+        Messages published to a queue so far
+        """
+        return self.queues.get(queue, [])
+
+
+class FakeConnection:
+    """
+    Stand-in for pika.BlockingConnection
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def process_data_events(self, time_limit=0):
+        if self.broker.down:
+            self.is_open = False
+            raise pika.exceptions.StreamLostError("connection lost")
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeChannel:
+    """
+    Stand-in for a pika BlockingChannel
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+
+    def queue_declare(self, queue, **kwargs):
+        self.connection.broker.queues.setdefault(queue, [])
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        broker = self.connection.broker
+        if broker.down or not self.connection.is_open:
+            self.connection.is_open = False
+            raise pika.exceptions.StreamLostError("connection lost")
+        if broker.nack:
+            raise pika.exceptions.NackError([])
+        broker.queues[routing_key].append(body)
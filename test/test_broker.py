@@ -0,0 +1,89 @@
+"""
+Tests for the stats task publisher
+"""
+import time
+import pika
+import pytest
+from conftest import FakeBroker
+from fitnessbuddy.broker import StatsPublisher, PublishError
+
+
+@pytest.fixture
+def broker():
+    """
+    In-process stand-in broker
+    """
+    return FakeBroker()
+
+def make_publisher(broker, buffer_size=3, retry_interval=0):
+    """
+    Publisher connected to the stand-in broker, retrying only on publish unless
+    retry_interval is given
+    """
+    return StatsPublisher(pika.ConnectionParameters(), buffer_size=buffer_size,
+                          connection_factory=broker, retry_interval=retry_interval)
+
+def test_connection_is_reused(broker):
+    """
+    All messages go over one connection
+    """
+    publisher = make_publisher(broker)
+    for i in range(5):
+        assert publisher.publish(f"task{i}")
+    assert broker.messages() == [f"task{i}" for i in range(5)]
+    assert broker.connections == 1
+
+def test_reconnect_and_buffering(broker):
+    """
+    Messages are buffered while the broker is down and sent in order after reconnecting
+    """
+    publisher = make_publisher(broker)
+    assert publisher.publish("task1")
+    broker.down = True
+    assert not publisher.publish("task2")
+    assert not publisher.publish("task3")
+    assert publisher.pending == 2
+    broker.down = False
+    assert publisher.publish("task4")
+    assert publisher.pending == 0
+    assert broker.messages() == ["task1", "task2", "task3", "task4"]
+    assert broker.connections == 2
+
+def test_nacked_messages_are_kept(broker):
+    """
+    Messages the broker doesn't confirm stay in the buffer
+    """
+    publisher = make_publisher(broker)
+    broker.nack = True
+    assert not publisher.publish("task1")
+    assert publisher.pending == 1
+    broker.nack = False
+    assert publisher.publish("task2")
+    assert broker.messages() == ["task1", "task2"]
+
+def test_buffer_is_bounded(broker):
+    """
+    Publishing fails once the buffer is full
+    """
+    publisher = make_publisher(broker, buffer_size=2)
+    broker.down = True
+    publisher.publish("task1")
+    publisher.publish("task2")
+    with pytest.raises(PublishError):
+        publisher.publish("task3")
+    assert publisher.pending == 2
+
+def test_buffer_is_flushed_by_timer(broker):
+    """
+    Buffered messages are sent when the broker is back without another publish
+    """
+    publisher = make_publisher(broker, retry_interval=0.05)
+    broker.down = True
+    assert not publisher.publish("task1")
+    broker.down = False
+    deadline = time.monotonic() + 5
+    while publisher.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert publisher.pending == 0
+    assert broker.messages() == ["task1"]
+    publisher.close()
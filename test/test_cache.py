@@ -0,0 +1,164 @@
+"""
+Tests for the response cache
+"""
+import json
+import tempfile
+import os
+from datetime import datetime
+import pytest
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+import tools.populate_database
+from fitnessbuddy import create_app, db
+from fitnessbuddy.cache import LocalBackend
+from fitnessbuddy.models import Exercise
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Enable foreign keys
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+@pytest.fixture
+def client():
+    """
+    Test client with a small response cache
+    """
+    tempfile.tempdir = os.path.dirname(__file__)
+    db_fd, db_fname = tempfile.mkstemp(prefix="temppytest_")
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "RESPONSE_CACHE_SIZE": 4
+    }
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        tools.populate_database.populate_database(db, app)
+
+    yield app.test_client()
+
+    os.close(db_fd)
+
+def get_stats(client):
+    """
+    Cache counters of the test app
+    """
+    return json.loads(client.get("/api/cache/stats/").data)["cache"]
+
+def test_hits_and_write_invalidation(client):
+    """
+    Repeated GETs are served from the cache until the user's data changes
+    """
+    url = "/api/users/1/exercises/"
+    first = client.get(url)
+    assert first.headers["X-Cache"] == "MISS"
+    second = client.get(url)
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.data == first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+    #other query strings are cached separately
+    assert client.get(url + "?limit=1").headers["X-Cache"] == "MISS"
+
+    resp = client.post(url, json={"name": "cached", "date": "2023-05-01T12:00:00"})
+    assert resp.status_code == 201
+    resp = client.get(url)
+    assert resp.headers["X-Cache"] == "MISS"
+    assert "cached" in [item["name"] for item in json.loads(resp.data)["exercises"]]
+
+    #bulk inserts bypass the unit of work but still invalidate
+    client.post(url + "bulk/", json=[{"name": "bulk", "date": "2023-05-02T12:00:00"}])
+    resp = client.get(url)
+    assert resp.headers["X-Cache"] == "MISS"
+    assert "bulk" in [item["name"] for item in json.loads(resp.data)["exercises"]]
+
+    #other users are not affected
+    client.get("/api/users/2/exercises/")
+    client.post(url, json={"name": "again", "date": "2023-05-03T12:00:00"})
+    assert client.get("/api/users/2/exercises/").headers["X-Cache"] == "HIT"
+
+    stats = get_stats(client)
+    assert stats["hits"] == 2
+    assert stats["invalidations"] > 0
+
+def test_user_collection_invalidation(client):
+    """
+    Editing or deleting a user invalidates the user collection and the user item
+    """
+    client.get("/api/users/")
+    client.get("/api/users/2/")
+    assert client.get("/api/users/").headers["X-Cache"] == "HIT"
+    user = json.loads(client.get("/api/users/2/").data)["user"]
+    user["name"] = "renamed"
+    assert client.put("/api/users/2/", json=user).status_code == 204
+
+    resp = client.get("/api/users/")
+    assert resp.headers["X-Cache"] == "MISS"
+    assert "renamed" in [item["name"] for item in json.loads(resp.data)["users"]]
+    assert json.loads(client.get("/api/users/2/").data)["user"]["name"] == "renamed"
+
+    client.delete("/api/users/2/")
+    assert client.get("/api/users/2/").status_code == 404
+    assert 2 not in [item["id"] for item in json.loads(client.get("/api/users/").data)["users"]]
+
+def test_session_write_invalidation(client):
+    """
+    Writes committed outside the resources (e.g. CLI commands) invalidate through
+    session events
+    """
+    url = "/api/users/1/exercises/"
+    client.get(url)
+    with client.application.app_context():
+        db.session.add(Exercise(name="direct", date=datetime(2023, 5, 1), user_id=1))
+        db.session.commit()
+    resp = client.get(url)
+    assert resp.headers["X-Cache"] == "MISS"
+    assert "direct" in [item["name"] for item in json.loads(resp.data)["exercises"]]
+
+    #rolled back writes don't invalidate anything
+    client.get(url)
+    with client.application.app_context():
+        db.session.add(Exercise(name="rolled back", date=datetime(2023, 5, 1), user_id=1))
+        db.session.flush()
+        db.session.rollback()
+    assert client.get(url).headers["X-Cache"] == "HIT"
+
+def test_eviction():
+    """
+    The local backend keeps the most recently used entries
+    """
+    backend = LocalBackend(maxsize=2)
+    backend.set("user:1|0|a", "a")
+    backend.set("user:1|0|b", "b")
+    backend.get("user:1|0|a")
+    backend.set("user:2|0|c", "c")
+    assert backend.get("user:1|0|b") is None
+    assert backend.get("user:1|0|a") == "a"
+    assert backend.evictions == 1
+
+    backend.invalidate("user:1")
+    assert backend.generation("user:1") == 1
+    assert backend.get("user:1|0|a") is None
+    assert backend.get("user:2|0|c") == "c"
+
+def test_local_expiry(monkeypatch):
+    """
+    Local entries expire after the ttl and a size of 0 stores nothing
+    """
+    now = [1000.0]
+    monkeypatch.setattr("fitnessbuddy.cache.time.monotonic", lambda: now[0])
+    backend = LocalBackend(maxsize=2, ttl=10)
+    backend.set("user:1|0|a", "a")
+    now[0] += 9
+    assert backend.get("user:1|0|a") == "a"
+    now[0] += 1
+    assert backend.get("user:1|0|a") is None
+    assert len(backend) == 0
+
+    backend = LocalBackend(maxsize=0)
+    backend.set("user:1|0|a", "a")
+    assert backend.get("user:1|0|a") is None
@@ -10,7 +10,9 @@ import pytest
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 import tools.populate_database
+import fitnessbuddy.utils
 from fitnessbuddy import create_app, db
+from fitnessbuddy.models import Exercise, UserAggregate
 
 
 
@@ -97,8 +99,11 @@ def test_ExerciseCollection_get(client):
     controls = json.loads(resp.data)["@controls"]
     expected = {'self': {'href': '/api/users/1/exercises/'}, 
                 'fitnessbuddy:user': {'href': '/api/users/1/'}, 
-                'fitnessbuddy:add-exercise': {'method': 'POST', 'encoding': 'json', 'title': 'fitnessbuddy:add-exercise', 'schema': exercise_schema, 'href': '/api/users/1/exercises/'}}
+                'fitnessbuddy:add-exercise': {'method': 'POST', 'encoding': 'json', 'title': 'fitnessbuddy:add-exercise', 'schemaUrl': '/api/schemas/exercise/', 'href': '/api/users/1/exercises/'}}
     assert controls == expected
+    #Schema is referenced instead of inlined
+    resp = client.get(controls["fitnessbuddy:add-exercise"]["schemaUrl"])
+    assert json.loads(resp.data) == exercise_schema
 
     #Get from nonexisting user
     resp = client.get(resource_url_invalid)
@@ -173,7 +178,7 @@ def test_ExerciseItem_get(client):
     excepted = {'self': {'href': '/api/users/1/exercises/1/'}, 
                 'fitnessbuddy:exercises-all': {'title': 'All exercises', 'href': '/api/users/1/exercises/'}, 
                 'fitnessbuddy:delete': {'method': 'DELETE', 'title': 'Delete exercise', 'href': '/api/users/1/exercises/1/'}, 
-                'edit': {'method': 'PUT', 'encoding': 'json', 'title': 'Edit exercise', 'schema': exercise_schema, 'href': '/api/users/1/exercises/1/'}}
+                'edit': {'method': 'PUT', 'encoding': 'json', 'title': 'Edit exercise', 'schemaUrl': '/api/schemas/exercise/', 'href': '/api/users/1/exercises/1/'}}
     assert controls == excepted
 
     #Get existing exercise but corresponding to wrong user
@@ -258,3 +263,330 @@ def test_ExerciseItem_delete(client):
     #Try deleting nonexisting record
     resp = client.delete(resource_url_invalid)
     assert resp.status_code == 404
+
+
+def test_ExerciseCollection_pagination(client):
+    """
+    Test keyset pagination and time-range filtering of ExerciseCollection
+    """
+    resource_url = "/api/users/1/exercises/"
+    for day in range(1, 6):
+        resp = client.post(resource_url, json={
+            "name": f"paged{day}",
+            "date": datetime.isoformat(datetime(2023, 3, day, 12)),
+            "duration": 10.0
+        })
+        assert resp.status_code == 201
+
+    #Walk forwards through all 7 exercises, 3 at a time
+    names = []
+    url = resource_url + "?limit=3"
+    pages = 0
+    while url:
+        resp = client.get(url)
+        assert resp.status_code == 200
+        cont = json.loads(resp.data)
+        assert len(cont["exercises"]) <= 3
+        names += [item["name"] for item in cont["exercises"]]
+        url = cont["@controls"].get("next", {}).get("href")
+        pages += 1
+    assert pages == 3
+    assert names == ["laji1", "laji2", "paged1", "paged2", "paged3", "paged4", "paged5"]
+
+    #Walk back from the last page
+    prev = cont["@controls"]["prev"]["href"]
+    cont = json.loads(client.get(prev).data)
+    assert [item["name"] for item in cont["exercises"]] == ["paged2", "paged3", "paged4"]
+    assert "next" in cont["@controls"]
+    assert "prev" in cont["@controls"]
+
+    #Pages after a cursor seek the index to the cursor's date
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if "FROM exercise" in statement:
+            statements.append((statement, parameters))
+    with client.application.app_context():
+        engine = db.engine
+    for cursor in ("after", "before"):
+        #a page size not requested yet so the response isn't cached
+        url = cont["@controls"]["next" if cursor == "after" else "prev"]["href"]
+        url = url.replace("limit=3", "limit=2")
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            client.get(url)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        statement, parameters = statements.pop()
+        with client.application.app_context():
+            plan = db.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + statement,
+                                                           parameters).all()
+        assert any("(user_id=? AND date" in row[-1] for row in plan)
+
+    #Time range filtering, carried over to the next link
+    resp = client.get(resource_url + "?since=2023-03-02T00:00:00&until=2023-03-05T00:00:00&limit=2")
+    cont = json.loads(resp.data)
+    assert [item["name"] for item in cont["exercises"]] == ["paged2", "paged3"]
+    assert "prev" not in cont["@controls"]
+    cont = json.loads(client.get(cont["@controls"]["next"]["href"]).data)
+    assert [item["name"] for item in cont["exercises"]] == ["paged4"]
+    assert "next" not in cont["@controls"]
+
+    #Invalid parameters
+    assert client.get(resource_url + "?limit=0").status_code == 400
+    assert client.get(resource_url + "?limit=asd").status_code == 400
+    assert client.get(resource_url + "?after=notacursor").status_code == 400
+    assert client.get(resource_url + "?since=yesterday").status_code == 400
+
+
+def test_ExerciseCollection_stream(client, monkeypatch):
+    """
+    Test streaming the whole ExerciseCollection
+    """
+    monkeypatch.setattr(fitnessbuddy.utils, "STREAM_CHUNK_SIZE", 5)
+    resource_url = "/api/users/1/exercises/"
+    for day in range(1, 13):
+        resp = client.post(resource_url, json={
+            "name": f"streamed{day}",
+            "date": datetime.isoformat(datetime(2023, 3, day, 12)),
+        })
+        assert resp.status_code == 201
+
+    resp = client.get(resource_url + "?stream=true")
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    cont = json.loads(resp.data)
+    assert len(cont["exercises"]) == 14
+    assert cont["exercises"] == json.loads(client.get(resource_url).data)["exercises"]
+    assert cont["@controls"]["fitnessbuddy:add-exercise"]["href"] == resource_url
+    assert "next" not in cont["@controls"]
+
+    #Date filter applies to the stream too
+    resp = client.get(resource_url + "?stream=1&since=2023-03-10T00:00:00")
+    assert [item["name"] for item in json.loads(resp.data)["exercises"]] == \
+        ["streamed10", "streamed11", "streamed12"]
+
+    #Empty collection
+    resp = client.get("/api/users/9/exercises/?stream=1")
+    assert json.loads(resp.data)["exercises"] == []
+
+
+def test_ExerciseItem_queries(client):
+    """
+    Test that an item request loads the user and the exercise once each, and that
+    exercises of other users can't be modified
+    """
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        resp = client.get("/api/users/1/exercises/1/")
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert resp.status_code == 200
+    assert len(statements) == 2
+
+    #Exercise 3 belongs to user 2
+    resp = client.delete("/api/users/1/exercises/3/")
+    assert resp.status_code == 400
+    resp = client.put("/api/users/1/exercises/3/", json={"name": "x", "date": "2023-01-01T00:00:00"})
+    assert resp.status_code == 400
+    resp = client.get("/api/users/2/exercises/3/")
+    assert resp.status_code == 200
+    assert json.loads(resp.data)["exercise"]["name"] == "laji3"
+
+    #Non numeric ids are not found
+    assert client.get("/api/users/abc/exercises/").status_code == 404
+
+
+def test_ExerciseBulk_post(client):
+    """
+    Test bulk ingest of exercises as a JSON array and as NDJSON
+    """
+    resource_url = "/api/users/1/exercises/bulk/"
+    items = [
+        {"name": "bulk1", "date": "2023-04-01T12:00:00", "duration": 30},
+        {"name": "bulk2", "date": "2023-04-02T12:00:00", "user_id": 1},
+        {"name": "bulk3", "date": "2023-04-03T12:00:00", "user_id": 2},
+        {"name": "bulk4", "date": "not a date"},
+        {"date": "2023-04-05T12:00:00"},
+    ]
+    resp = client.post(resource_url, json=items)
+    assert resp.status_code == 200
+    cont = json.loads(resp.data)
+    assert cont["created"] == 2
+    assert cont["failed"] == 3
+    assert [item["status"] for item in cont["results"]] == [201, 201, 400, 400, 400]
+    assert [item["index"] for item in cont["results"]] == list(range(5))
+    names = [item["name"] for item in json.loads(client.get("/api/users/1/exercises/").data)["exercises"]]
+    assert "bulk1" in names and "bulk2" in names and "bulk3" not in names
+
+    #NDJSON with a broken line
+    body = '{"name": "bulk6", "date": "2023-04-06T12:00:00"}\n{broken\n\n' \
+           '{"name": "bulk7", "date": "2023-04-07T12:00:00"}\n'
+    resp = client.post(resource_url, data=body, content_type="application/x-ndjson")
+    cont = json.loads(resp.data)
+    assert [item["status"] for item in cont["results"]] == [201, 400, 201]
+    resp = client.get("/api/users/1/stats/aggregate/")
+    assert json.loads(resp.data)["aggregate"]["exercise_count"] == 6
+
+    #Not an array, not json and too many items
+    assert client.post(resource_url, json={"name": "x"}).status_code == 400
+    assert client.post(resource_url, data="asd").status_code == 415
+    too_many = [{"name": "x", "date": "2023-04-01T12:00:00"}] * (fitnessbuddy.utils.MAX_BULK_ITEMS + 1)
+    assert client.post(resource_url, json=too_many).status_code == 413
+    assert client.post("/api/users/12/exercises/bulk/", json=items).status_code == 404
+
+
+def test_ExerciseCollection_conditional_get(client):
+    """
+    Test ETag and Last-Modified handling of ExerciseCollection and ExerciseItem
+    """
+    resource_url = "/api/users/1/exercises/"
+    resp = client.get(resource_url)
+    etag = resp.headers["ETag"]
+    assert resp.last_modified is not None
+
+    #Unchanged collection is answered without querying the exercises
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        resp = client.get(resource_url, headers={"If-None-Match": etag})
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert resp.status_code == 304
+    assert resp.data == b""
+    assert not any("FROM exercise" in statement for statement in statements)
+    resp = client.get(resource_url + "?stream=1", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    #Any write changes the collection's ETag
+    resp = client.post(resource_url, json={"name": "new", "date": "2023-05-01T12:00:00"})
+    item_url = json.loads(resp.data)["@controls"]["self"]["href"]
+    resp = client.get(resource_url, headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+    #Items have their own version
+    resp = client.get(item_url)
+    item_etag = resp.headers["ETag"]
+    assert client.get(item_url, headers={"If-None-Match": item_etag}).status_code == 304
+    assert client.get(item_url, headers={"If-Modified-Since": resp.headers["Last-Modified"]}
+                      ).status_code == 304
+    client.put(item_url, json={"name": "newer", "date": "2023-05-01T12:00:00", "duration": 10})
+    resp = client.get(item_url, headers={"If-None-Match": item_etag})
+    assert resp.status_code == 200
+    assert json.loads(resp.data)["exercise"]["name"] == "newer"
+
+
+def test_ExerciseCollection_conditional_get_without_aggregate(client):
+    """
+    Test that collection validators of a user without running totals don't write
+    """
+    resource_url = "/api/users/1/exercises/"
+    with client.application.app_context():
+        db.session.delete(db.session.get(UserAggregate, 1))
+        db.session.commit()
+    resp = client.get(resource_url)
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+    assert etag == 'W/"exercises-1-0"'
+    assert client.get(resource_url, headers={"If-None-Match": etag}).status_code == 304
+    with client.application.app_context():
+        assert db.session.get(UserAggregate, 1) is None
+
+    #the first write creates the totals and changes the version
+    client.post(resource_url, json={"name": "new", "date": "2023-05-01T12:00:00"})
+    assert client.get(resource_url, headers={"If-None-Match": etag}).status_code == 200
+
+def test_ExerciseItem_concurrent_put(client, monkeypatch):
+    """
+    Test that a PUT losing to a concurrent write of the same exercise gets 409
+    """
+    url = "/api/users/1/exercises/1/"
+    updated_exercise = {
+        "date": "2023-05-01T12:00:00",
+        "name": "loser",
+        "duration": 10.0,
+        "user_id": 1
+    }
+    for_user = UserAggregate.for_user.__func__
+
+    def concurrent_write(cls, user, lock=False):
+        #another request commits its update after this one loaded the exercise
+        with db.engine.begin() as conn:
+            conn.execute(Exercise.__table__.update().where(Exercise.id == 1)
+                         .values(name="winner", version=Exercise.version + 1))
+        monkeypatch.setattr(UserAggregate, "for_user", classmethod(for_user))
+        return for_user(cls, user, lock)
+
+    monkeypatch.setattr(UserAggregate, "for_user", classmethod(concurrent_write))
+    resp = client.put(url, json=updated_exercise)
+    assert resp.status_code == 409
+    assert json.loads(client.get(url).data)["exercise"]["name"] == "winner"
+
+    #retrying with the current version works
+    resp = client.put(url, json=updated_exercise)
+    assert resp.status_code == 204
+    assert json.loads(client.get(url).data)["exercise"]["name"] == "loser"
+
+
+def test_ExerciseCollection_post_with_offset(client):
+    """
+    Test that dates with a UTC offset are stored as naive UTC
+    """
+    url = "/api/users/1/exercises/"
+    resp = client.post(url, json={"name": "offset", "date": "2023-01-05T10:00:00+02:00"})
+    assert resp.status_code == 201
+    item_url = json.loads(resp.data)["@controls"]["self"]["href"]
+    res = json.loads(client.get(item_url).data)["exercise"]
+    assert res["date"] == "2023-01-05T08:00:00"
+    resp = client.put(item_url,
+                      json={"name": "offset", "duration": 30.0,
+                            "date": "2023-01-06T10:00:00-01:00"})
+    assert resp.status_code == 204
+    resp = client.post(url + "bulk/", json=[{"name": "bulk", "date": "2023-01-07T10:00:00+02:00"}])
+    assert json.loads(resp.data)["created"] == 1
+
+def test_ExerciseCollection_post_aggregate_inserted_concurrently(client, monkeypatch):
+    """
+    Test that a write finding the running totals inserted by a concurrent first write
+    updates that row instead of inserting another
+    """
+    with client.application.app_context():
+        db.session.delete(db.session.get(UserAggregate, 1))
+        db.session.commit()
+    lock = UserAggregate._lock.__func__
+
+    def concurrent_insert(cls, user_id):
+        #another request inserts and commits the totals after this one found none
+        with db.engine.begin() as conn:
+            conn.execute(UserAggregate.__table__.insert().values(user_id=user_id,
+                                                                 exercise_count=3))
+        monkeypatch.setattr(UserAggregate, "_lock", classmethod(lock))
+        return False
+
+    monkeypatch.setattr(UserAggregate, "_lock", classmethod(concurrent_insert))
+    resp = client.post("/api/users/1/exercises/",
+                       json={"name": "new", "date": "2023-05-01T12:00:00"})
+    assert resp.status_code == 201
+    with client.application.app_context():
+        assert db.session.get(UserAggregate, 1).exercise_count == 4
+        assert UserAggregate.query.filter_by(user_id=1).count() == 1
+
+    #a write that inserts the totals itself builds them from the history
+    monkeypatch.undo()
+    with client.application.app_context():
+        db.session.delete(db.session.get(UserAggregate, 2))
+        db.session.commit()
+    client.post("/api/users/2/exercises/", json={"name": "new", "date": "2023-05-02T12:00:00"})
+    with client.application.app_context():
+        assert db.session.get(UserAggregate, 2).exercise_count == \
+            Exercise.query.filter_by(user_id=2).count()
@@ -0,0 +1,136 @@
+"""
+Tests for background jobs
+"""
+import json
+import tempfile
+import os
+from datetime import datetime
+import pytest
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+import tools.populate_database
+from fitnessbuddy import create_app, db
+from fitnessbuddy.models import (Exercise, Measurements, ExerciseArchive,
+                                 MeasurementsArchive, UserAggregate, Job)
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Enable foreign keys
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+@pytest.fixture
+def client():
+    """
+    Test client with small job chunks
+    """
+    tempfile.tempdir = os.path.dirname(__file__)
+    db_fd, db_fname = tempfile.mkstemp(prefix="temppytest_")
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "JOBS_CHUNK_SIZE": 2
+    }
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        tools.populate_database.populate_database(db, app)
+
+    yield app.test_client()
+
+    os.close(db_fd)
+
+def follow_job(client, resp):
+    """
+    Checks a 202 response and returns the job it points to
+    """
+    assert resp.status_code == 202
+    body = json.loads(resp.data)
+    href = body["@controls"]["fitnessbuddy:job"]["href"]
+    assert resp.headers["location"] == href
+    resp = client.get(href)
+    assert resp.status_code == 200
+    return json.loads(resp.data)["job"]
+
+def test_delete_user_job(client):
+    """
+    User deletion runs in chunks and removes everything the user owns
+    """
+    resp = client.post("/api/users/3/exercises/bulk/", json=[
+        {"name": f"bulk {i}", "date": f"2023-02-{i + 1:02}T12:00:00"} for i in range(5)
+    ])
+    assert resp.status_code == 200
+    job = follow_job(client, client.delete("/api/users/3/"))
+    assert job["kind"] == "delete-user"
+    assert job["status"] == "done"
+    #exercises, measurements, the running totals' journal and the measurement rollups
+    assert job["total"] == job["processed"] == 19
+    assert job["finished"] is not None
+    assert client.get("/api/users/3/").status_code == 404
+    with client.application.app_context():
+        assert Exercise.query.filter_by(user_id=3).count() == 0
+        assert Measurements.query.filter_by(user_id=3).count() == 0
+    #the user is gone so the job only links to itself
+    resp = client.get(f"/api/jobs/{job['id']}/")
+    assert "fitnessbuddy:user" not in json.loads(resp.data)["@controls"]
+    assert client.get("/api/jobs/1000/").status_code == 404
+
+def test_archive_job(client):
+    """
+    Archiving moves old rows to the archive tables and keeps the totals in sync
+    """
+    job = follow_job(client, client.post("/api/users/3/archive/",
+                                         json={"before": "2023-01-15T00:00:00"}))
+    assert job["kind"] == "archive"
+    assert job["status"] == "done"
+    assert job["total"] == job["processed"] == 3
+    with client.application.app_context():
+        assert Exercise.query.filter_by(user_id=3).count() == 1
+        assert Measurements.query.filter_by(user_id=3).count() == 0
+        assert ExerciseArchive.query.filter_by(user_id=3).count() == 1
+        assert MeasurementsArchive.query.filter_by(user_id=3).count() == 2
+        aggregate = db.session.get(UserAggregate, 3)
+        totals = aggregate.serialize()
+        aggregate.rebuild()
+        assert aggregate.serialize() == totals
+        assert totals["exercise_count"] == 1
+    resp = client.get("/api/users/3/exercises/")
+    assert [item["date"] for item in json.loads(resp.data)["exercises"]] == \
+        ["2023-01-15T16:00:00"]
+    #deleting the user also deletes the archive
+    follow_job(client, client.delete("/api/users/3/"))
+    with client.application.app_context():
+        assert ExerciseArchive.query.count() == 0
+        assert MeasurementsArchive.query.count() == 0
+
+def test_archive_invalid(client):
+    """
+    Invalid archive requests are rejected before a job is created
+    """
+    url = "/api/users/3/archive/"
+    assert client.post(url, data="before").status_code == 415
+    assert client.post(url, json={}).status_code == 400
+    assert client.post(url, json={"before": 5}).status_code == 400
+    assert client.post(url, json={"before": "yesterday"}).status_code == 400
+    with client.application.app_context():
+        assert Job.query.count() == 0
+
+def test_finished_jobs_expire(client):
+    """
+    Jobs that finished more than JOBS_RETENTION_HOURS ago are deleted on submit
+    """
+    follow_job(client, client.post("/api/users/3/archive/",
+                                   json={"before": "2023-01-01T00:00:00"}))
+    with client.application.app_context():
+        db.session.add(Job(kind="archive", user_id=3, params="{}", status="queued"))
+        db.session.commit()
+    client.application.config["JOBS_RETENTION_HOURS"] = 0
+    job = follow_job(client, client.post("/api/users/3/archive/",
+                                         json={"before": "2023-01-01T00:00:00"}))
+    with client.application.app_context():
+        assert [(item.id, item.status) for item in Job.query.order_by(Job.id)] == \
+            [(2, "queued"), (job["id"], "done")]
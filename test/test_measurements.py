@@ -7,7 +7,7 @@ import tempfile
 import os
 from datetime import datetime
 import pytest
-from fitnessbuddy.models import Exercise, User, Measurements
+from fitnessbuddy.models import Exercise, User, Measurements, MeasurementsRollup, UserAggregate
 from fitnessbuddy import create_app, db
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
@@ -94,8 +94,12 @@ def test_MeasurementsCollection_get(client):
     controls = json.loads(resp.data)["@controls"]
     expected = {'self': {'href': '/api/users/1/measurements/'}, 
                 'fitnessbuddy:user': {'href': '/api/users/1/'}, 
-                'fitnessbuddy:add-measurement': {'method': 'POST', 'encoding': 'json', 'title': 'fitnessbuddy:addmeasurement', 'schema': measurement_schema, 'href': '/api/users/1/measurements/'}}
+                'fitnessbuddy:add-measurement': {'method': 'POST', 'encoding': 'json', 'title': 'fitnessbuddy:addmeasurement', 'schemaUrl': '/api/schemas/measurement/', 'href': '/api/users/1/measurements/'},
+                'fitnessbuddy:rollup': {'title': 'Trends', 'href': '/api/users/1/measurements/rollup/'}}
     assert controls == expected
+    #Schema is referenced instead of inlined
+    resp = client.get(controls["fitnessbuddy:add-measurement"]["schemaUrl"])
+    assert json.loads(resp.data) == measurement_schema
 
     # Get from nonexisting user
     resp = client.get(resource_url_invalid)
@@ -199,7 +203,7 @@ def test_MeasurementsItem_get(client):
     expected = {'self': {'href': '/api/users/3/measurements/1/'}, 
                 'fitnessbuddy:measurements-all': {'title': 'All measurements', 'href': '/api/users/3/measurements/'}, 
                 'fitnessbuddy:delete': {'method': 'DELETE', 'title': 'Delete measurements', 'href': '/api/users/3/measurements/1/'}, 
-                'edit': {'method': 'PUT', 'encoding': 'json', 'title': 'Edit measurements', 'schema': measurement_schema, 'href': '/api/users/3/measurements/1/'}}
+                'edit': {'method': 'PUT', 'encoding': 'json', 'title': 'Edit measurements', 'schemaUrl': '/api/schemas/measurement/', 'href': '/api/users/3/measurements/1/'}}
     assert controls == expected
 
     # Get existing measurement but corresponding to wrong user
@@ -278,3 +282,140 @@ def test_MeasurementsItem_delete(client):
     # Try deleting nonexisting record
     resp = client.delete(resource_url_invalid)
     assert resp.status_code == 404
+
+
+def test_MeasurementsCollection_pagination(client):
+    """
+    Test keyset pagination of MeasurementsCollection
+    """
+    resource_url = "/api/users/3/measurements/"
+
+    resp = client.get(resource_url + "?limit=1")
+    assert resp.status_code == 200
+    cont = json.loads(resp.data)
+    assert len(cont["measurements"]) == 1
+    first = cont["measurements"][0]
+    assert "prev" not in cont["@controls"]
+
+    cont = json.loads(client.get(cont["@controls"]["next"]["href"]).data)
+    assert len(cont["measurements"]) == 1
+    assert cont["measurements"][0]["date"] > first["date"]
+    assert "next" not in cont["@controls"]
+
+    cont = json.loads(client.get(cont["@controls"]["prev"]["href"]).data)
+    assert cont["measurements"] == [first]
+
+    #Nothing before the first measurement
+    resp = client.get(resource_url + "?until=" + first["date"])
+    assert json.loads(resp.data)["measurements"] == []
+
+
+def test_MeasurementsBulk_post(client):
+    """
+    Test bulk ingest of measurements and that running totals stay in sync
+    """
+    resource_url = "/api/users/3/measurements/bulk/"
+    items = [
+        {"date": "2023-04-01T08:00:00", "weight": 80, "calories_in": 2000, "calories_out": 2500},
+        {"date": "2023-04-01T20:00:00", "weight": 81, "calories_in": 500},
+        {"date": "2023-04-02T08:00:00", "weight": "heavy"},
+        {"date": "2023-04-03T08:00:00", "calories_out": 3000},
+    ]
+    resp = client.post(resource_url, json=items)
+    assert resp.status_code == 200
+    cont = json.loads(resp.data)
+    assert cont["created"] == 3
+    assert [item["status"] for item in cont["results"]] == [201, 201, 400, 201]
+    assert "error" in cont["results"][2]
+    assert cont["@controls"]["fitnessbuddy:measurements-all"]["href"] == "/api/users/3/measurements/"
+
+    resp = client.get("/api/users/3/stats/aggregate/")
+    aggregate = json.loads(resp.data)["aggregate"]
+    with client.application.app_context():
+        rebuilt = UserAggregate(user_id=3)
+        rebuilt.rebuild()
+        rebuilt = rebuilt.serialize()
+    del aggregate["watermark"], rebuilt["watermark"]
+    assert aggregate == rebuilt
+
+
+def rollups_of(user_id):
+    """
+    Non-empty rollup buckets of a user, with sums rounded (incremental updates drift)
+    """
+    rollups = []
+    for rollup in MeasurementsRollup.query.filter(MeasurementsRollup.user_id == user_id,
+                                                  MeasurementsRollup.count > 0):
+        rollups.append({key: round(value, 6) if isinstance(value, float) else value
+                        for key, value in rollup.serialize().items()})
+    return sorted(rollups, key=lambda rollup: (rollup["bucket"], rollup["date"]))
+
+def test_MeasurementsRollup_get(client):
+    """
+    Test rollup buckets and that they stay in sync with every kind of write
+    """
+    resource_url = "/api/users/3/measurements/rollup/"
+    resp = client.get(resource_url + "?bucket=week")
+    assert resp.status_code == 200
+    cont = json.loads(resp.data)
+    #2023-01-01 is a Sunday
+    assert [item["date"] for item in cont["rollup"]] == ["2022-12-26T00:00:00",
+                                                        "2023-01-02T00:00:00"]
+    assert cont["@controls"]["fitnessbuddy:measurements-all"]["href"] == \
+        "/api/users/3/measurements/"
+
+    client.post("/api/users/3/measurements/", json={
+        "date": "2023-01-03T08:00:00", "weight": 70, "calories_in": 1000, "calories_out": 500})
+    client.post("/api/users/3/measurements/bulk/", json=[
+        {"date": "2023-01-04T08:00:00", "weight": 90},
+        {"date": "2023-02-01T08:00:00", "calories_in": 3000}
+    ])
+    resp = client.get(resource_url + "?bucket=month")
+    january, february = json.loads(resp.data)["rollup"]
+    assert january["count"] == 4
+    assert january["weight_min"] == 10.1
+    assert january["weight_max"] == 90
+    assert february["count"] == 1
+    assert february["weight_avg"] is None
+    assert february["calories_in_avg"] == 3000
+
+    #removing the heaviest measurement looks the maximum up again
+    with client.application.app_context():
+        heaviest = Measurements.query.filter_by(user_id=3, weight=90).one().id
+    assert client.delete(f"/api/users/3/measurements/{heaviest}/").status_code == 204
+    resp = client.put("/api/users/3/measurements/1/", json={
+        "date": "2023-03-01T08:00:00", "weight": 60, "calories_in": 100, "calories_out": 100,
+        "user_id": 3})
+    assert resp.status_code == 204
+
+    #both extremes of january are gone
+    january = json.loads(client.get(resource_url + "?bucket=month").data)["rollup"][0]
+    assert (january["weight_min"], january["weight_max"]) == (20.2, 70)
+
+    resp = client.get(resource_url + "?bucket=day&since=2023-01-02T00:00:00"
+                      "&until=2023-02-01T00:00:00")
+    assert [item["date"] for item in json.loads(resp.data)["rollup"]] == [
+        "2023-01-02T00:00:00", "2023-01-03T00:00:00"]
+    with client.application.app_context():
+        maintained = rollups_of(3)
+        MeasurementsRollup.rebuild(3)
+        assert rollups_of(3) == maintained
+
+    assert client.get(resource_url + "?bucket=year").status_code == 400
+    assert client.get(resource_url + "?since=yesterday").status_code == 400
+    assert client.get("/api/users/100/measurements/rollup/").status_code == 404
+
+
+def test_MeasurementsCollection_post_with_offset(client):
+    """
+    Test that measurements dated with a UTC offset are stored as naive UTC
+    """
+    url = "/api/users/1/measurements/"
+    resp = client.post(url, json={"date": "2023-01-05T10:00:00+02:00", "weight": 80})
+    assert resp.status_code == 201
+    item_url = json.loads(resp.data)["@controls"]["self"]["href"]
+    res = json.loads(client.get(item_url).data)["measurement"]
+    assert res["date"] == "2023-01-05T08:00:00"
+    resp = client.post(url + "bulk/", json=[{"date": "2023-01-06T01:00:00+02:00", "weight": 80}])
+    assert resp.status_code == 200
+    assert json.loads(resp.data)["created"] == 1
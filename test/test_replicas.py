@@ -0,0 +1,147 @@
+"""
+Tests for routing reads to a replica database
+"""
+import json
+import shutil
+import tempfile
+import os
+from datetime import datetime
+import pytest
+from sqlalchemy.engine import Engine
+from sqlalchemy import event, func
+import tools.populate_database
+from fitnessbuddy import create_app, db
+from fitnessbuddy.models import Exercise, UserAggregate
+from fitnessbuddy.routing import read_only
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Enable foreign keys
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+@pytest.fixture
+def client():
+    """
+    Test client with a primary database and a replica that is a copy of it. Writes
+    made in tests only reach the primary, like on a lagging replica.
+    """
+    tempfile.tempdir = os.path.dirname(__file__)
+    db_fd, db_fname = tempfile.mkstemp(prefix="temppytest_")
+    replica_fd, replica_fname = tempfile.mkstemp(prefix="temppytest_")
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "DATABASE_REPLICAS": ["sqlite:///" + replica_fname],
+        "TESTING": True
+    }
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        tools.populate_database.populate_database(db, app)
+        #closing the connections checkpoints the WAL into the file
+        db.engine.dispose()
+    shutil.copyfile(db_fname, replica_fname)
+
+    with app.app_context():
+        db.session.add(Exercise(name="primary only", date=datetime(2023, 5, 1), user_id=1))
+        db.session.commit()
+
+    yield app.test_client()
+
+    os.close(db_fd)
+    os.close(replica_fd)
+
+def exercise_names(client, url):
+    """
+    Names of the exercises in a collection response
+    """
+    return [item["name"] for item in json.loads(client.get(url).data)["exercises"]]
+
+def test_collection_reads_from_replica(client):
+    """
+    Collection GETs read from the replica, other requests from the primary
+    """
+    assert len(client.application.extensions["replicas"]) == 1
+    url = "/api/users/1/exercises/"
+    assert "primary only" not in exercise_names(client, url)
+    assert "primary only" not in exercise_names(client, url + "?stream=1")
+
+    #item GETs and converters use the primary
+    with client.application.app_context():
+        exercise_id = Exercise.query.filter_by(name="primary only").one().id
+    resp = client.get(f"{url}{exercise_id}/")
+    assert resp.status_code == 200
+
+    #writes go to the primary
+    resp = client.post(url, json={"name": "posted", "date": "2023-05-02T12:00:00"})
+    assert resp.status_code == 201
+    with client.application.app_context():
+        assert Exercise.query.filter_by(name="posted").count() == 1
+    assert "posted" not in exercise_names(client, url)
+
+def test_read_your_writes(client):
+    """
+    Once the session has written it reads from the primary for the rest of the request
+    """
+    with client.application.app_context():
+        with read_only():
+            assert Exercise.query.filter_by(user_id=1).count() == 2
+            db.session.add(Exercise(name="new", date=datetime(2023, 5, 2), user_id=1))
+            db.session.flush()
+            assert Exercise.query.filter_by(user_id=1).count() == 4
+        db.session.rollback()
+
+    with client.application.app_context():
+        with read_only():
+            assert db.session.query(func.count(Exercise.id)).scalar() == 16
+            db.session.execute(Exercise.__table__.delete().where(Exercise.user_id == 2))
+            assert db.session.query(func.count(Exercise.id)).scalar() == 15
+        db.session.rollback()
+
+    #sessions of new requests start on the replica again
+    with client.application.app_context():
+        with read_only():
+            assert Exercise.query.filter_by(user_id=1).count() == 2
+
+def test_aggregate_built_from_primary(client):
+    """
+    Running totals missing on the replica are built from the primary's rows, without
+    writing them on a GET
+    """
+    with client.application.app_context():
+        db.session.delete(db.session.get(UserAggregate, 1))
+        db.session.commit()
+        with client.application.extensions["replicas"][0].begin() as conn:
+            conn.execute(UserAggregate.__table__.delete())
+    resp = client.get("/api/users/1/stats/aggregate/")
+    assert json.loads(resp.data)["aggregate"]["exercise_count"] == 3
+    with client.application.app_context():
+        assert db.session.get(UserAggregate, 1) is None
+
+def test_replica_responses_cached_briefly(client, monkeypatch):
+    """
+    Responses read from a lagging replica are only cached for the replica ttl
+    """
+    now = [1000.0]
+    monkeypatch.setattr("fitnessbuddy.cache.time.monotonic", lambda: now[0])
+    url = "/api/users/1/exercises/"
+    assert "primary only" not in exercise_names(client, url)
+
+    #the replica catches up
+    with client.application.app_context():
+        row = db.session.execute(Exercise.__table__.select().where(
+            Exercise.name == "primary only")).mappings().one()
+        with client.application.extensions["replicas"][0].begin() as conn:
+            conn.execute(Exercise.__table__.insert(), [dict(row)])
+    resp = client.get(url)
+    assert resp.headers["X-Cache"] == "HIT"
+    assert "primary only" not in exercise_names(client, url)
+
+    now[0] += client.application.config["RESPONSE_CACHE_REPLICA_TTL"]
+    resp = client.get(url)
+    assert resp.headers["X-Cache"] == "MISS"
+    assert "primary only" in [item["name"] for item in json.loads(resp.data)["exercises"]]
@@ -5,11 +5,15 @@ import json
 import tempfile
 import os
 from datetime import datetime
+from types import SimpleNamespace
 from fitnessbuddy import create_app, db
+from fitnessbuddy.models import UserAggregate, User, Job, Stats, StatsChange
+from worker import worker
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 import tools.populate_database
 import pytest
+from conftest import FakeBroker
 
 stats_schema = {'type': 'object', 'required': ['date', 'user_id'], 'properties': 
                {'date': {'description': "Datetime when these stats were generated", 'type': 'string'}, 
@@ -17,7 +21,8 @@ stats_schema = {'type': 'object', 'required': ['date', 'user_id'], 'properties':
                 'total_exercises': {'description': "Total amount of exercises this user has done", 'type': 'number'}, 
                 'daily_exercises': {'description': "Average number of exercises per day", 'type': 'number'},
                 'daily_calories_in': {'description': "Average number of calories eaten per day", 'type': 'number'},
-                'daily_calories_out': {'description': "Average number of calories burnt per day", 'type': 'number'}
+                'daily_calories_out': {'description': "Average number of calories burnt per day", 'type': 'number'},
+                'watermark': {'description': "Sequence number of the last change included in these stats", 'type': 'integer'}
                 }}
 
 @event.listens_for(Engine, "connect")
@@ -39,7 +44,8 @@ def client():
     db_fd, db_fname = tempfile.mkstemp(prefix="temppytest_")
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
+        "TESTING": True,
+        "BROKER_CONNECTION_FACTORY": FakeBroker()
     }
 
     app = create_app(config)
@@ -116,6 +122,99 @@ def test_stats_post(client):
     resp = client.post(resource_url_valid, data="asd")
     assert resp.status_code == 415
 
+def read_events(resp):
+    """
+    Reads a server-sent events stream until it ends and returns its events as dicts
+    """
+    events = []
+    for block in b"".join(resp.response).decode().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines()
+                      if not line.startswith(":"))
+        if "data" in fields:
+            fields["data"] = json.loads(fields["data"])
+            events.append(fields)
+    return events
+
+def test_stats_events(client):
+    """
+    Function for testing that posted stats are pushed to the user's event stream only
+    """
+    client.application.config.update(STATS_EVENTS_HEARTBEAT=0.05, STATS_EVENTS_TIMEOUT=0.2)
+    notifier = client.application.extensions["stats_notifier"]
+    body = {
+        "date": datetime.isoformat(datetime.now()),
+        "user_id": 1,
+        "total_exercises": 15,
+        "daily_exercises": 0.8,
+        "daily_calories_in": 2575.6,
+        "daily_calories_out": 2575.6
+    }
+
+    resp = client.get("/api/users/1/stats/events/", buffered=False)
+    other = client.get("/api/users/2/stats/events/", buffered=False)
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/event-stream"
+    assert notifier.listener_count(1) == 1
+    assert client.post("/api/users/1/stats/", json=body).status_code == 201
+    events = read_events(resp)
+    assert [event["event"] for event in events] == ["stats"]
+    assert events[0]["data"]["daily_calories_in"] == 2575.6
+    assert events[0]["id"] == str(events[0]["data"]["id"])
+    assert read_events(other) == []
+    resp.close()
+    other.close()
+    assert notifier.listener_count() == 0
+
+    #reconnecting clients get the latest stats they missed
+    stats_id = int(events[0]["id"])
+    assert client.post("/api/users/1/stats/", json=body).status_code == 201
+    resp = client.get("/api/users/1/stats/events/", headers={"Last-Event-ID": str(stats_id)},
+                      buffered=False)
+    assert [int(event["id"]) for event in read_events(resp)] == [stats_id + 1]
+    resp.close()
+    resp = client.get(f"/api/users/1/stats/events/?after={stats_id + 1}", buffered=False)
+    assert read_events(resp) == []
+    resp.close()
+
+    resp = client.get("/api/users/1/stats/events/?after=latest")
+    assert resp.status_code == 400
+    assert notifier.listener_count() == 0
+    resp = client.get("/api/users/21311/stats/events/")
+    assert resp.status_code == 404
+
+def test_stats_bulk_post(client):
+    """
+    Function for testing that many users' stats can be posted in one request
+    """
+    url = "/api/stats/bulk/"
+    notifier = client.application.extensions["stats_notifier"]
+    listener = notifier.subscribe(2)
+    #pending tasks of users 1 and 2
+    client.get("/api/users/1/stats/")
+    client.get("/api/users/2/stats/")
+    def stats(user_id, **extra):
+        return dict({"date": "2023-05-01T12:00:00", "user_id": user_id, "total_exercises": 1,
+                     "daily_exercises": 0.5, "daily_calories_in": 2000,
+                     "daily_calories_out": 2100}, **extra)
+    items = [stats(1, generation=1), stats(2, generation=1, watermark=0), stats(21311),
+             {"date": "2023-05-01T12:00:00"}, stats(3, total_exercises="many"), "broken"]
+    resp = client.post(url, json=items)
+    assert resp.status_code == 200
+    cont = json.loads(resp.data)
+    assert [item["status"] for item in cont["results"]] == [201, 201, 404, 400, 400, 400]
+    assert (cont["created"], cont["failed"]) == (2, 4)
+    assert cont["@controls"]["self"]["href"] == url
+    with client.application.app_context():
+        assert Stats.query.filter(Stats.user_id.in_([1, 2])).count() == 2
+        #the pending tasks ended
+        assert db.session.get(UserAggregate, 1).stats_requested is None
+        assert db.session.get(UserAggregate, 2).stats_requested is None
+    assert listener.get_nowait()["user_id"] == 2
+    notifier.unsubscribe(2, listener)
+
+    assert client.post(url, json={"user_id": 1}).status_code == 400
+    assert client.post(url, data="stats").status_code == 415
+
 def test_stats_get(client):
     """
     Function for testing get method on Stats resource
@@ -126,7 +225,330 @@ def test_stats_get(client):
     #Get from valid url
     resp = client.get(resource_url_valid)
     assert resp.status_code == 202
+    assert resp.headers["X-Stats-Task"] == "queued"
+    broker = client.application.config["BROKER_CONNECTION_FACTORY"]
+    task = json.loads(broker.messages()[-1])
+    assert task["user"]["id"] == 1
+    assert task["@controls"]["fitnessbuddy:add-stats"]["href"] == resource_url_valid
+
+    #Broker down: the task is buffered, until there is no more room for it
+    client.application.config["STATS_TASK_TIMEOUT"] = 0
+    broker.down = True
+    resp = client.get(resource_url_valid)
+    assert resp.status_code == 202
+    assert resp.headers["X-Stats-Task"] == "deferred"
+    publisher = client.application.extensions["stats_publisher"]
+    publisher.buffer_size = 1
+    resp = client.get(resource_url_valid)
+    assert resp.status_code == 503
+    broker.down = False
+    resp = client.get(resource_url_valid)
+    assert resp.status_code == 202
+    assert len(broker.messages()) == 3
+    publisher.close()
 
     #Get from invalid url
     resp = client.get(resource_url_invalid)
     assert resp.status_code == 404
+
+def test_stats_get_prunes_old_stats(client):
+    """
+    Function for testing that requesting new stats deletes the user's old ones without a job
+    """
+    with client.application.app_context():
+        for _ in range(3):
+            db.session.add(Stats(user_id=3, date=datetime(2023, 1, 1)))
+        db.session.add(Stats(user_id=4, date=datetime(2023, 1, 1)))
+        db.session.commit()
+    resp = client.get("/api/users/3/stats/")
+    assert resp.status_code == 202
+    assert resp.data == b""
+    with client.application.app_context():
+        assert Stats.query.filter_by(user_id=3).count() == 0
+        assert Stats.query.filter_by(user_id=4).count() == 1
+        assert Job.query.count() == 0
+
+
+def test_stats_coalescing(client):
+    """
+    Function for testing that stats requests attach to a pending task of the same user
+    """
+    url = "/api/users/1/stats/"
+    broker = client.application.config["BROKER_CONNECTION_FACTORY"]
+    body = {
+        "date": datetime.isoformat(datetime.now()),
+        "user_id": 1,
+        "total_exercises": 2,
+        "daily_exercises": 0.1,
+        "daily_calories_in": 2000,
+        "daily_calories_out": 2500
+    }
+    def generations():
+        return [json.loads(message)["generation"] for message in broker.messages()]
+
+    assert client.get(url).status_code == 202
+    modified = client.get("/api/users/1/exercises/").headers["Last-Modified"]
+    with client.application.app_context():
+        jobs = Job.query.count()
+    #nothing new to compute, no task or prune job
+    for _ in range(3):
+        resp = client.get(url)
+        assert resp.status_code == 202
+        assert resp.headers["X-Stats-Task"] == "pending"
+    assert generations() == [1]
+    with client.application.app_context():
+        assert Job.query.count() == jobs
+    assert client.get("/api/users/1/exercises/").headers["Last-Modified"] == modified
+    #other users have their own tasks
+    assert client.get("/api/users/2/stats/").status_code == 202
+    assert len(generations()) == 2
+
+    #a change after the pending task was sent needs a new generation
+    client.post("/api/users/1/exercises/", json={"name": "run", "date": "2023-05-01T12:00:00"})
+    assert client.get(url).status_code == 202
+    assert generations()[-1] == 2
+
+    #results of an older generation don't end the pending task, the current one does
+    assert client.post(url, json=dict(body, generation=1)).status_code == 201
+    assert client.get(url).status_code == 202
+    assert generations()[-1] == 2
+    assert client.post(url, json=dict(body, generation=2)).status_code == 201
+    assert client.get(url).status_code == 202
+    assert generations()[-1] == 3
+
+    #pending tasks time out in case the worker lost them
+    client.application.config["STATS_TASK_TIMEOUT"] = 0
+    assert client.get(url).status_code == 202
+    assert generations()[-1] == 4
+
+def test_stats_get_sync(client):
+    """
+    Function for testing that synchronous stats match the worker's output
+    """
+    #a measurement without calories, which the worker counts as 0
+    client.post("/api/users/3/measurements/", json={"date": "2023-01-05T10:00:00", "weight": 50})
+    broker = client.application.config["BROKER_CONNECTION_FACTORY"]
+    for user_id in (1, 3, 9):
+        resp = client.get(f"/api/users/{user_id}/stats/?mode=sync")
+        assert resp.status_code == 200
+        cont = json.loads(resp.data)
+        with client.application.app_context():
+            user = db.session.get(User, user_id)
+            body = {
+                "user": user.serialize(),
+                "exercises": [item.serialize() for item in user.exercise],
+                "measurements": [item.serialize() for item in user.measurements]
+            }
+        expected = worker.compute_stats(body)
+        stats = cont["stats"]
+        assert (stats["daily_exercises"], stats["daily_calories_in"],
+                stats["daily_calories_out"]) == expected
+        assert stats["total_exercises"] == len(body["exercises"])
+        assert stats["user_id"] == user_id
+        assert cont["@controls"]["self"]["href"] == f"/api/users/{user_id}/stats/?mode=sync"
+        assert cont["@controls"]["fitnessbuddy:user"]["href"] == f"/api/users/{user_id}/"
+
+    #nothing is queued, stored or pruned
+    assert broker.messages() == []
+    with client.application.app_context():
+        assert Job.query.count() == 0
+
+    resp = client.get("/api/users/1/stats/?mode=later")
+    assert resp.status_code == 400
+    resp = client.get("/api/users/21311/stats/?mode=sync")
+    assert resp.status_code == 404
+
+class ClientSession:
+    """
+    Stand-in for the worker's HTTP session that sends its requests to the test client
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def _response(self, resp):
+        def raise_for_status():
+            assert resp.status_code < 400
+        return SimpleNamespace(status_code=resp.status_code, ok=resp.status_code < 400,
+                               json=lambda: json.loads(resp.data),
+                               raise_for_status=raise_for_status)
+
+    def get(self, href, timeout):
+        return self._response(self.client.get(href[len(worker.API_SERVER):]))
+
+    def post(self, href, json, timeout):
+        return self._response(self.client.post(href[len(worker.API_SERVER):], json=json))
+
+def test_stats_batch(client, monkeypatch):
+    """
+    Function for testing batch tasks that recompute many users' stats at once
+    """
+    broker = client.application.config["BROKER_CONNECTION_FACTORY"]
+    client.post("/api/users/3/measurements/", json={"date": "2023-01-05T10:00:00", "weight": 50})
+    result = client.application.test_cli_runner().invoke(args=["refresh-stats",
+                                                               "--batch-size", "4"])
+    assert result.exit_code == 0
+    assert result.output == "Queued 3 batch task(s) for 10 users\n"
+    tasks = [json.loads(message) for message in broker.messages()]
+    assert [task["users"] for task in tasks] == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+    assert {task["kind"] for task in tasks} == {"batch"}
+
+    monkeypatch.setattr(worker, "get_session", lambda: ClientSession(client))
+    results, error = worker.process_task(json.dumps(tasks[0]))
+    assert error is None
+    assert [stats["user_id"] for stats in results] == [1, 2, 3, 4]
+    for stats in results:
+        user_id = stats["user_id"]
+        expected = json.loads(client.get(f"/api/users/{user_id}/stats/?mode=sync").data)["stats"]
+        del expected["date"], stats["date"]
+        stats.pop("watermark", None)
+        assert stats == expected
+    with client.application.app_context():
+        assert Stats.query.count() == 4
+        #the measurement's change was included and acknowledged
+        assert db.session.get(UserAggregate, 3).stats_watermark == 1
+
+    resp = client.get("/api/stats/export/?users=1,2,21311")
+    assert resp.status_code == 200
+    users = json.loads(resp.data)["users"]
+    assert users["id"] == [1, 2]
+    assert users["watermark"] == [0, 0]
+    for url in ("/api/stats/export/", "/api/stats/export/?users=1,a",
+                "/api/stats/export/?users=" + ",".join(map(str, range(1001)))):
+        assert client.get(url).status_code == 400
+
+def get_rebuilt_aggregate(client, user_id):
+    """
+    Compute a user's running totals from scratch for comparison
+    """
+    with client.application.app_context():
+        aggregate = UserAggregate(user_id=user_id)
+        aggregate.rebuild()
+        return aggregate.serialize()
+
+def without_watermark(aggregate):
+    """
+    Drop the change sequence number that a rebuilt aggregate doesn't have
+    """
+    del aggregate["watermark"]
+    return aggregate
+
+def test_stats_aggregate(client):
+    """
+    Function for testing that running totals stay in sync with exercise and measurement writes
+    """
+    resource_url = "/api/users/3/stats/aggregate/"
+    measurement = {
+        "date": "2023-01-02T18:00:00",
+        "weight": 50.0,
+        "calories_in": 500,
+        "calories_out": 50,
+        "user_id": 3
+    }
+
+    #Totals are built from the existing history
+    resp = client.get(resource_url)
+    assert resp.status_code == 200
+    cont = json.loads(resp.data)
+    agg = without_watermark(cont["aggregate"])
+    assert agg == without_watermark(get_rebuilt_aggregate(client, 3))
+    assert (agg["measurement_count"], agg["measurement_days"]) == (2, 2)
+    assert (agg["calories_in_sum"], agg["calories_out_sum"]) == (2100, 300)
+    assert cont["stats"]["daily_calories_in"] == 1050
+    assert cont["stats"]["total_exercises"] == agg["exercise_count"]
+    assert cont["@controls"]["fitnessbuddy:stats"]["href"] == "/api/users/3/stats/"
+
+    #Second measurement on an already recorded day
+    resp = client.post("/api/users/3/measurements/", json=measurement)
+    assert resp.status_code == 201
+    agg = without_watermark(json.loads(client.get(resource_url).data)["aggregate"])
+    assert (agg["measurement_count"], agg["measurement_days"]) == (3, 2)
+    assert agg == without_watermark(get_rebuilt_aggregate(client, 3))
+
+    #Move the first measurement onto the same day too
+    measurement["date"] = "2023-01-02T08:00:00"
+    resp = client.put("/api/users/3/measurements/1/", json=measurement)
+    assert resp.status_code == 204
+    agg = without_watermark(json.loads(client.get(resource_url).data)["aggregate"])
+    assert (agg["measurement_count"], agg["measurement_days"]) == (3, 1)
+    assert agg == without_watermark(get_rebuilt_aggregate(client, 3))
+
+    #Exercises
+    resp = client.post("/api/users/3/exercises/", json={"name": "late", "date": "2024-01-01T10:00:00"})
+    assert resp.status_code == 201
+    agg = without_watermark(json.loads(client.get(resource_url).data)["aggregate"])
+    assert agg["last_date"] == "2024-01-01T10:00:00"
+    assert agg == without_watermark(get_rebuilt_aggregate(client, 3))
+    exercise_href = json.loads(resp.data)["@controls"]["self"]["href"]
+    assert client.delete(exercise_href).status_code == 204
+    assert client.delete("/api/users/3/measurements/2/").status_code == 204
+    agg = without_watermark(json.loads(client.get(resource_url).data)["aggregate"])
+    assert agg == without_watermark(get_rebuilt_aggregate(client, 3))
+
+    #Non existing user
+    resp = client.get("/api/users/21311/stats/aggregate/")
+    assert resp.status_code == 404
+
+def test_stats_change_journal(client):
+    """
+    Function for testing that changes are journaled until the worker acknowledges them
+    """
+    with client.application.app_context():
+        assert db.session.get(UserAggregate, 3).change_seq == 0
+
+    resp = client.post("/api/users/3/measurements/", json={
+        "date": "2023-01-05T10:00:00", "calories_in": 500, "calories_out": 50})
+    assert resp.status_code == 201
+    resp = client.delete("/api/users/3/measurements/1/")
+    assert resp.status_code == 204
+
+    with client.application.app_context():
+        aggregate = db.session.get(UserAggregate, 3)
+        changes = [change.serialize() for change in aggregate.pending_changes()]
+        assert aggregate.change_seq == 2
+        assert [(change["seq"], change["sign"]) for change in changes] == [(1, 1), (2, -1)]
+        assert changes[1]["calories_in"] == 1000
+
+    #worker acknowledges the first change with its stats
+    resp = client.post("/api/users/3/stats/", json={
+        "date": datetime.isoformat(datetime.now()),
+        "user_id": 3,
+        "total_exercises": 0,
+        "daily_exercises": 0,
+        "daily_calories_in": 800,
+        "daily_calories_out": 125,
+        "watermark": 1
+    })
+    assert resp.status_code == 201
+    with client.application.app_context():
+        aggregate = db.session.get(UserAggregate, 3)
+        assert aggregate.stats_watermark == 1
+        assert [change.seq for change in aggregate.pending_changes()] == [2]
+
+def test_stats_change_journal_capped(client, monkeypatch):
+    """
+    Function for testing that a journal the worker has fallen too far behind on is
+    dropped and the next task makes the worker resync
+    """
+    monkeypatch.setattr(UserAggregate, "MAX_PENDING_CHANGES", 2)
+    url = "/api/users/3/measurements/"
+    for day in range(5, 7):
+        client.post(url, json={"date": f"2023-01-0{day}T10:00:00", "calories_in": 500})
+    with client.application.app_context():
+        assert StatsChange.query.filter_by(user_id=3).count() == 2
+
+    #single and bulk writes past the cap drop the pending changes
+    client.post(url, json={"date": "2023-01-07T10:00:00", "calories_in": 500})
+    with client.application.app_context():
+        aggregate = db.session.get(UserAggregate, 3)
+        assert (aggregate.change_seq, aggregate.stats_watermark) == (3, 3)
+        assert StatsChange.query.filter_by(user_id=3).count() == 0
+    client.post(url + "bulk/", json=[{"date": "2023-01-08T10:00:00"}] * 3)
+    with client.application.app_context():
+        assert db.session.get(UserAggregate, 3).stats_watermark == 6
+        assert StatsChange.query.filter_by(user_id=3).count() == 0
+
+    #the task's base is past any watermark the worker has
+    assert client.get("/api/users/3/stats/").status_code == 202
+    broker = client.application.config["BROKER_CONNECTION_FACTORY"]
+    task = json.loads(broker.messages()[-1])
+    assert (task["base"], task["watermark"], task["changes"]) == (6, 6, [])
@@ -6,6 +6,7 @@ import tempfile
 import os
 from datetime import datetime
 from fitnessbuddy import create_app, db
+from fitnessbuddy.models import Exercise, Measurements, UserAggregate, StatsChange
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 import tools.populate_database
@@ -99,6 +100,9 @@ def test_usercollection_post(client):
     #check that last user is the one we just added
     res = json.loads(resp.data).get("users")
     assert res[len(res)-1] == valid_user
+    #running totals are created with the user
+    with client.application.app_context():
+        assert db.session.get(UserAggregate, 11).change_seq == 0
 
     #Invalid data to valid url
     resp = client.post(resource_url_valid, json=invalid_user)
@@ -134,8 +138,11 @@ def test_usercollection_get(client):
     #Verify controls
     controls = json.loads(resp.data)["@controls"]
     expected = {'self': {'href': '/api/users/'}, 
-                'fitnessbuddy:add-user': {'method': 'POST', 'encoding': 'json', 'title': 'Add user', 'schema': user_schema, 'href': '/api/users/'}}
+                'fitnessbuddy:add-user': {'method': 'POST', 'encoding': 'json', 'title': 'Add user', 'schemaUrl': '/api/schemas/user/', 'href': '/api/users/'}}
     assert controls == expected
+    #Schema is referenced instead of inlined
+    resp = client.get(controls["fitnessbuddy:add-user"]["schemaUrl"])
+    assert json.loads(resp.data) == user_schema
 
     #Get from invalid url
     resp = client.get(resource_url_invalid)
@@ -162,10 +169,19 @@ def test_useritem_get(client):
                 'fitnessbuddy:measurements-all': {'title': 'All measurements', 'href': '/api/users/1/measurements/'}, 
                 'fitnessbuddy:users-all': {'title': 'All users', 'href': '/api/users/'}, 
                 'fitnessbuddy:delete': {'method': 'DELETE', 'title': 'Delete user', 'href': '/api/users/1/'},
+                'fitnessbuddy:archive': {'method': 'POST', 'encoding': 'json', 'title': 'Archive old entries', 'schemaUrl': '/api/schemas/archive/', 'href': '/api/users/1/archive/'},
                 'fitnessbuddy:stats': {'title': 'Stats', 'href': '/api/users/1/stats/'},
-                'edit': {'method': 'PUT', 'encoding': 'json', 'title': 'Edit user', 'schema': user_schema, 'href': '/api/users/1/'}}
+                'fitnessbuddy:stats-aggregate': {'title': 'Running totals', 'href': '/api/users/1/stats/aggregate/'},
+                'fitnessbuddy:stats-events': {'title': 'New stats as server-sent events', 'href': '/api/users/1/stats/events/'},
+                'edit': {'method': 'PUT', 'encoding': 'json', 'title': 'Edit user', 'schemaUrl': '/api/schemas/user/', 'href': '/api/users/1/'}}
     assert controls == expected
 
+    #Conditional get of unchanged user
+    etag = resp.headers["ETag"]
+    resp = client.get(resource_url_valid, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["ETag"] == etag
+
     #Get not existing user
     resp = client.get(resource_url_not_exist)
     assert resp.status_code == 404
@@ -189,9 +205,11 @@ def test_useritem_put(client):
         "thisis": "invalid"
     }
 
+    etag = client.get(resource_url_valid).headers["ETag"]
     #Put updated user
     resp = client.put(resource_url_valid, json=updated_user)
     assert resp.status_code == 204
+    assert client.get(resource_url_valid, headers={"If-None-Match": etag}).status_code == 200
     #get updated user and check that it matches
     resp = client.get(resource_url_valid)
     res = json.loads(resp.data)["user"]
@@ -217,9 +235,14 @@ def test_useritem_delete(client):
     resource_url_valid = "/api/users/1/"
     resource_url_not_exist = "/api/users/999/"
 
-    #Delete existing user
+    #Delete existing user, deletion runs as a job
     resp = client.delete(resource_url_valid)
-    assert resp.status_code == 204
+    assert resp.status_code == 202
+    job_url = json.loads(resp.data)["@controls"]["fitnessbuddy:job"]["href"]
+    assert resp.headers["location"] == job_url
+    job = json.loads(client.get(job_url).data)["job"]
+    assert job["kind"] == "delete-user"
+    assert job["status"] == "done"
     #Check that this user can't be found anymore
     resp = client.get(resource_url_valid)
     assert resp.status_code == 404
@@ -227,3 +250,47 @@ def test_useritem_delete(client):
     #Try to delete not existing user
     resp = client.delete(resource_url_not_exist)
     assert resp.status_code == 404
+
+def test_schemaitem_get(client):
+    """
+    Function for testing that schemas are served with caching headers
+    """
+    resp = client.get("/api/schemas/stats/")
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/schema+json"
+    assert resp.cache_control.public
+    assert "watermark" in json.loads(resp.data)["properties"]
+
+    #Revalidation with the ETag has no body
+    resp = client.get("/api/schemas/stats/", headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+
+    resp = client.get("/api/schemas/nothing/")
+    assert resp.status_code == 404
+
+def test_useritem_delete_cascade(client):
+    """
+    Function for testing that deleting a user removes the user's rows in the database
+    without loading them
+    """
+    #user 3 has exercises, measurements and running totals with journal rows
+    client.post("/api/users/3/exercises/", json={"name": "x", "date": "2023-05-01T12:00:00"})
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        resp = client.delete("/api/users/3/")
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert resp.status_code == 202
+    #rows are deleted by id without loading them
+    assert not [statement for statement in statements
+                if "exercise.name" in statement or "measurements.weight" in statement]
+
+    with client.application.app_context():
+        for model in (Exercise, Measurements, UserAggregate, StatsChange):
+            assert model.query.filter_by(user_id=3).count() == 0
@@ -0,0 +1,279 @@
+"""
+Tests for the stats worker
+"""
+import json
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import pytest
+from worker import worker
+
+
+def make_body(days, measurements, exercises):
+    """
+    Build a full history task body like the API used to send
+    """
+    return {
+        "user": {"id": 1, "user_creation_date":
+                 datetime.isoformat(datetime.today() - timedelta(days=days))},
+        "measurements": [{"date": f"2023-01-{i % 28 + 1:02d}T10:00:00",
+                          "calories_in": 2000 + i, "calories_out": 1500 + 2 * i}
+                         for i in range(measurements)],
+        "exercises": [{"date": "2023-01-01T10:00:00"} for _ in range(exercises)]
+    }
+
+def as_changes(body):
+    """
+    Turn a full history body into journal changes
+    """
+    changes = []
+    for item in body["exercises"]:
+        changes.append({"kind": "exercise", "sign": 1, "date": item["date"],
+                        "calories_in": None, "calories_out": None})
+    for item in body["measurements"]:
+        changes.append({"kind": "measurement", "sign": 1, "date": item["date"],
+                        "calories_in": item["calories_in"], "calories_out": item["calories_out"]})
+    for seq, change in enumerate(changes, start=1):
+        change["seq"] = seq
+    return changes
+
+def test_compute_stats():
+    """
+    compute_stats averages the full history, counting missing calories as 0
+    """
+    assert worker.compute_stats(make_body(10, 2, 5)) == (0.5, 2000.5, 1501.0)
+    assert worker.compute_stats(make_body(0, 0, 2)) == (0, 0, 0)
+    body = make_body(10, 2, 1)
+    body["measurements"][1]["calories_in"] = None
+    assert worker.compute_stats(body) == (0.1, 1000.0, 1501.0)
+
+@pytest.fixture
+def cache(monkeypatch):
+    """
+    Fresh aggregate cache and a fake resync that records its calls
+    """
+    monkeypatch.setattr(worker, "CACHE", worker.AggregateCache(maxsize=2))
+    resyncs = []
+    def resync(href):
+        resyncs.append(href)
+        return {"exercise_count": 10, "measurement_count": 0, "calories_in_sum": 0,
+                "calories_out_sum": 0, "watermark": 5}
+    monkeypatch.setattr(worker, "resync_aggregate", resync)
+    return resyncs
+
+def make_task(user_id, base, changes):
+    """
+    Build a delta task
+    """
+    return {
+        "user": {"id": user_id, "user_creation_date": "2023-01-01T00:00:00"},
+        "base": base,
+        "watermark": max([change["seq"] for change in changes], default=base or 0),
+        "changes": changes,
+        "@controls": {"fitnessbuddy:stats-aggregate": {"href": f"/api/users/{user_id}/stats/aggregate/"}}
+    }
+
+def test_batch_stats_match_compute_stats(monkeypatch):
+    """
+    Stats computed for a batch of users from their columns match compute_stats
+    """
+    bodies = [make_body(days, measurements, exercises) for days, measurements, exercises
+              in [(40, 25, 7), (400, 1000, 300), (3, 0, 0), (0, 5, 2)]]
+    bodies[0]["measurements"][1]["calories_in"] = None
+    users = {
+        "user_creation_date": [body["user"]["user_creation_date"] for body in bodies],
+        "exercise_count": [len(body["exercises"]) for body in bodies],
+        "measurement_count": [len(body["measurements"]) for body in bodies],
+        "calories_in_sum": [float(sum(item["calories_in"] or 0 for item in body["measurements"]))
+                            for body in bodies],
+        "calories_out_sum": [float(sum(item["calories_out"] for item in body["measurements"]))
+                             for body in bodies]
+    }
+    expected = [worker.compute_stats(body) for body in bodies]
+    assert worker.compute_batch_stats(users) == expected
+    monkeypatch.setattr(worker, "np", None)
+    assert worker.compute_batch_stats(users) == expected
+
+def test_aggregate_stats_match_full_history():
+    """
+    Merging the whole history as changes gives the same stats as compute_stats
+    """
+    body = make_body(40, 25, 7)
+    partial = {"exercise_count": 0, "measurement_count": 0, "calories_in_sum": 0,
+               "calories_out_sum": 0, "watermark": 0}
+    worker.merge_changes(partial, as_changes(body))
+    assert worker.compute_aggregate_stats(partial, body["user"]) == worker.compute_stats(body)
+
+def test_delta_updates_and_resync(cache):
+    """
+    Deltas are merged into cached aggregates, misses and gaps fall back to a resync
+    """
+    measurement = {"seq": 6, "kind": "measurement", "sign": 1, "date": "2023-01-01T10:00:00",
+                   "calories_in": 2000, "calories_out": 1000}
+    #cache miss
+    partial = worker.update_aggregate(make_task(1, 5, [measurement]))
+    assert cache == ["http://localhost:5000/api/users/1/stats/aggregate/"]
+    assert (partial["measurement_count"], partial["watermark"]) == (1, 6)
+
+    #cache hit, already merged changes are skipped
+    removal = dict(measurement, seq=7, sign=-1)
+    partial = worker.update_aggregate(make_task(1, 5, [measurement, removal]))
+    assert len(cache) == 1
+    assert (partial["measurement_count"], partial["calories_in_sum"]) == (0, 0)
+    assert partial["watermark"] == 7
+
+    #gap between the cached watermark and the task's base
+    worker.update_aggregate(make_task(1, 9, [dict(measurement, seq=10)]))
+    assert len(cache) == 2
+
+    #too many changes, API asks for a resync
+    worker.update_aggregate(make_task(1, None, []))
+    assert len(cache) == 3
+
+class RecordingSession:
+    """
+    Session that records posts and answers them with the given status
+    """
+    def __init__(self, status):
+        self.status = status
+        self.posts = []
+
+    def post(self, href, json, timeout):
+        self.posts.append((href, json, timeout))
+        return SimpleNamespace(status_code=self.status, ok=self.status < 400)
+
+def test_process_task_posts_result(cache, monkeypatch):
+    """
+    Results are posted over the shared session with a timeout, 201 counts as success
+    """
+    session = RecordingSession(201)
+    monkeypatch.setattr(worker, "get_session", lambda: session)
+    task = make_task(1, None, [])
+    task["generation"] = 4
+    task["@controls"]["fitnessbuddy:add-stats"] = {"href": "/api/users/1/stats/"}
+    new_stats, error = worker.process_task(json.dumps(task))
+    assert error is None
+    assert new_stats["generation"] == 4
+    assert session.posts == [("http://localhost:5000/api/users/1/stats/", new_stats,
+                              worker.HTTP_TIMEOUT)]
+    session.status = 500
+    new_stats, error = worker.process_task(json.dumps(task))
+    assert error == "Unable to send result: 500"
+
+def test_session(monkeypatch):
+    """
+    The session is created once per process with pooled, retrying connections
+    """
+    monkeypatch.setattr(worker, "_SESSION", None)
+    session = worker.get_session()
+    assert worker.get_session() is session
+    adapter = session.get_adapter("http://localhost:5000/")
+    assert adapter._pool_maxsize == worker.HTTP_POOL_SIZE
+    assert adapter.max_retries.total == 3
+    assert 503 in adapter.max_retries.status_forcelist
+    #forked pool processes get their own
+    monkeypatch.setattr(worker, "_SESSION_PID", -1)
+    assert worker.get_session() is not session
+
+def test_aggregate_cache_eviction():
+    """
+    Least recently used aggregates are evicted first and newer ones are never replaced
+    """
+    lru = worker.AggregateCache(maxsize=2)
+    lru.put(1, {"watermark": 1})
+    lru.put(2, {"watermark": 2})
+    assert lru.get(1) == {"watermark": 1}
+    lru.put(3, {"watermark": 3})
+    assert lru.get(2) is None
+    assert lru.get(1) == {"watermark": 1}
+    lru.put(3, {"watermark": 0})
+    assert lru.get(3) == {"watermark": 3}
+
+
+class RecordingChannel:
+    """
+    Channel that records what the worker does with it
+    """
+    def __init__(self):
+        self.acks = []
+        self.published = []
+
+    def basic_ack(self, delivery_tag):
+        self.acks.append(delivery_tag)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((exchange, routing_key, body))
+
+def test_pool_handler(monkeypatch):
+    """
+    Tasks run on the pool, publishing and acking is left to the connection thread
+    """
+    def fake_process_task(body, sleep):
+        if body == b"3":
+            raise ValueError("broken task")
+        return {"user_id": int(body)}, None
+    errors = []
+    monkeypatch.setattr(worker, "process_task", fake_process_task)
+    monkeypatch.setattr(worker, "log_error", errors.append)
+    callbacks = []
+    connection = SimpleNamespace(add_callback_threadsafe=callbacks.append)
+    channel = RecordingChannel()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        handler = worker.make_pool_handler(connection, executor)
+        for tag in range(1, 11):
+            handler(channel, SimpleNamespace(delivery_tag=tag), None, str(tag).encode())
+
+    #nothing is acked from the pool threads
+    assert channel.acks == []
+    for callback in callbacks:
+        callback()
+    assert sorted(channel.acks) == list(range(1, 11))
+    assert len(channel.published) == 9
+    #each user's stats are routed to that user's listeners only
+    assert sorted(key for _, key, _ in channel.published) == \
+        sorted(f"user.{tag}.stats" for tag in range(1, 11) if tag != 3)
+    assert {exchange for exchange, _, _ in channel.published} == {"user-notifications"}
+    assert errors == ["Task failed: broken task"]
+
+def test_superseded_tasks(monkeypatch):
+    """
+    Older generations of a user's stats are cancelled on the pool or dropped on arrival
+    """
+    release = threading.Event()
+    handled = []
+    def fake_process_task(body, sleep):
+        task = json.loads(body)
+        if task["user"]["id"] == 0:
+            release.wait(5)
+        handled.append((task["user"]["id"], task["generation"]))
+        return {"user_id": task["user"]["id"]}, None
+    monkeypatch.setattr(worker, "process_task", fake_process_task)
+    monkeypatch.setattr(worker, "GENERATIONS", worker.GenerationTracker())
+    callbacks = []
+    connection = SimpleNamespace(add_callback_threadsafe=callbacks.append)
+    channel = RecordingChannel()
+
+    #(user id, generation), user 0 keeps the only pool thread busy meanwhile
+    tasks = [(0, 1), (1, 1), (1, 2), (2, 1), (1, 3), (1, 2)]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        handler = worker.make_pool_handler(connection, executor)
+        for tag, (user_id, generation) in enumerate(tasks, start=1):
+            body = json.dumps({"user": {"id": user_id}, "generation": generation})
+            handler(channel, SimpleNamespace(delivery_tag=tag), None, body.encode())
+        release.set()
+    for callback in callbacks:
+        callback()
+    assert handled == [(0, 1), (2, 1), (1, 3)]
+    assert sorted(channel.acks) == list(range(1, 7))
+    assert len(channel.published) == 3
+
+def test_parse_args():
+    """
+    Prefetch defaults to twice the number of handlers and sleeping is opt-in
+    """
+    args = worker.parse_args(["--workers", "4", "--pool", "process"])
+    assert (args.workers, args.pool, args.prefetch, args.sleep) == (4, "process", 8, False)
+    args = worker.parse_args(["--prefetch", "1", "--sleep"])
+    assert (args.workers, args.prefetch, args.sleep) == (1, 1, True)
@@ -0,0 +1,92 @@
+"""
+Benchmark refreshing the stats of every user one by one against batch tasks.
+"per user" runs one aggregate query set per user (like a full task per user), "batch"
+reads batches of users with the grouped queries of Stats.export and computes them with
+worker.compute_batch_stats. Broker and HTTP round trips are left out.
+Usage (from repository root):
+    python -m tools.benchmark_batch_stats --users 2000 --rows 50 --batch-size 500
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from fitnessbuddy import create_app, db
+from fitnessbuddy.models import User, Exercise, Measurements, Stats
+from worker import worker
+
+def populate(users, rows):
+    """
+    Inserts users with rows exercises and measurements each
+    """
+    start = datetime(2022, 1, 1)
+    db.session.execute(User.__table__.insert(), [
+        {"name": f"user {i}", "email": f"user{i}@example.com", "age": 30,
+         "user_creation_date": start} for i in range(users)
+    ])
+    user_ids = db.session.execute(select(User.id)).scalars().all()
+    for user_id in user_ids:
+        dates = [start + timedelta(hours=i) for i in range(rows)]
+        db.session.execute(Exercise.__table__.insert(), [
+            {"name": "run", "date": date, "user_id": user_id} for date in dates
+        ])
+        db.session.execute(Measurements.__table__.insert(), [
+            {"date": date, "user_id": user_id, "calories_in": random.uniform(1500, 3500),
+             "calories_out": random.uniform(1500, 3500)} for date in dates
+        ])
+    db.session.commit()
+    return user_ids
+
+def per_user(user_ids):
+    """
+    Stats of every user with one set of queries each
+    """
+    return [Stats.compute(db.session.get(User, user_id)) for user_id in user_ids]
+
+def batched(user_ids, batch_size):
+    """
+    Stats of every user in batches from grouped queries
+    """
+    results = []
+    for start in range(0, len(user_ids), batch_size):
+        results += worker.compute_batch_stats(Stats.export(user_ids[start:start + batch_size]))
+    return results
+
+def main():
+    """
+    Run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=50, help="exercises and measurements per user")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    try:
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+        with app.app_context():
+            db.create_all()
+            user_ids = populate(args.users, args.rows)
+            begin = time.perf_counter()
+            expected = per_user(user_ids)
+            one_by_one = time.perf_counter() - begin
+            db.session.expunge_all()
+            begin = time.perf_counter()
+            results = batched(user_ids, args.batch_size)
+            batch = time.perf_counter() - begin
+            assert results == [(stats["daily_exercises"], stats["daily_calories_in"],
+                                stats["daily_calories_out"]) for stats in expected]
+            db.engine.dispose()
+        print(f"{args.users} users: per user {one_by_one * 1000:.0f} ms, "
+              f"batches of {args.batch_size} {batch * 1000:.0f} ms")
+    finally:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.remove(db_fname + suffix)
+
+if __name__ == "__main__":
+    main()
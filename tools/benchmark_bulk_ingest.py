@@ -0,0 +1,79 @@
+"""
+Benchmark ingest throughput of single item POSTs against one bulk request.
+
+Posts the same generated measurements and exercises to a temporary database through the
+collection resources one at a time and through the bulk resources as a JSON array
+and as NDJSON.
+Usage (from repository root):
+    python -m tools.benchmark_bulk_ingest --items 5000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from fitnessbuddy import create_app, db
+from fitnessbuddy.models import User
+
+def make_items(kind, count):
+    """
+    Generate count exercises or measurements a few hours apart
+    """
+    start = datetime(2023, 1, 1)
+    items = []
+    for i in range(count):
+        date = datetime.isoformat(start + timedelta(hours=5 * i))
+        if kind == "exercises":
+            items.append({"name": "run", "date": date, "duration": 30})
+        else:
+            items.append({"date": date, "weight": 80, "calories_in": 2500,
+                          "calories_out": 2300})
+    return items
+
+def run(kind, items, mode):
+    """
+    Ingest items into a fresh database and return items per second
+    """
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    try:
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(name="bench", email="bench@email.com", age=30,
+                                user_creation_date=datetime(2023, 1, 1)))
+            db.session.commit()
+        client = app.test_client()
+        url = f"/api/users/1/{kind}/"
+        begin = time.perf_counter()
+        if mode == "single":
+            for item in items:
+                assert client.post(url, json=item).status_code == 201
+        elif mode == "bulk json":
+            resp = client.post(url + "bulk/", json=items)
+            assert json.loads(resp.data)["created"] == len(items)
+        else:
+            body = "\n".join(json.dumps(item) for item in items)
+            resp = client.post(url + "bulk/", data=body, content_type="application/x-ndjson")
+            assert json.loads(resp.data)["created"] == len(items)
+        return len(items) / (time.perf_counter() - begin)
+    finally:
+        os.close(db_fd)
+        os.remove(db_fname)
+
+def main():
+    """
+    Run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=5000, help="items per run")
+    args = parser.parse_args()
+
+    print(f"{'collection':<14}{'mode':<12}{'items/s':>12}")
+    for kind in ("exercises", "measurements"):
+        items = make_items(kind, args.items)
+        for mode in ("single", "bulk json", "bulk ndjson"):
+            print(f"{kind:<14}{mode:<12}{run(kind, items, mode):>12.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark worker.compute_stats against the per-row implementation the worker used before,
+which is kept here for reference as "original".
+Usage (from repository root):
+    python -m tools.benchmark_compute_stats --sizes 10000 100000 1000000
+"""
+import argparse
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from worker import worker
+
+def compute_stats_original(body):
+    """
+    Previous implementation of worker.compute_stats
+    """
+    measurement_date_counts = OrderedDict()
+    sum_of_calories_in = 0
+    sum_of_calories_out = 0
+    difference = datetime.today() - datetime.fromisoformat(body["user"]["user_creation_date"])
+    for i in range(len(body["measurements"])):
+        try:
+            in_date_format_measurement = datetime.fromisoformat(body["measurements"][i]["date"])
+            measurement_date_counts[in_date_format_measurement.date()] += 1
+        except KeyError:
+            measurement_date_counts[in_date_format_measurement.date()] = 1
+        sum_of_calories_in += body["measurements"][i]["calories_in"]
+        sum_of_calories_out += body["measurements"][i]["calories_out"]
+    try:
+        avg_exercise = len(body["exercises"]) / difference.days
+    except ZeroDivisionError:
+        avg_exercise = 0
+    try:
+        avg_calories_in = sum_of_calories_in / len(body["measurements"])
+        avg_calories_out = sum_of_calories_out / len(body["measurements"])
+    except ZeroDivisionError:
+        avg_calories_in = avg_calories_out = 0
+    return round(avg_exercise, 2), round(avg_calories_in, 2), round(avg_calories_out, 2)
+
+def make_body(rows):
+    """
+    Full history task body with the given amount of measurements and exercises
+    """
+    start = datetime(2020, 1, 1)
+    return {
+        "user": {"id": 1, "user_creation_date": datetime.isoformat(start)},
+        "measurements": [{
+            "date": datetime.isoformat(start + timedelta(hours=i)),
+            "weight": 80.0,
+            "calories_in": random.uniform(1500, 3500),
+            "calories_out": random.uniform(1500, 3500)
+        } for i in range(rows)],
+        "exercises": [{"date": datetime.isoformat(start + timedelta(hours=i))}
+                      for i in range(rows)]
+    }
+
+def best_of(func, body, repeat):
+    """
+    Best wall clock time in milliseconds
+    """
+    times = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func(body)
+        times.append(time.perf_counter() - begin)
+    return min(times) * 1000
+
+def main():
+    """
+    Run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10}{'original (ms)':>16}{'current (ms)':>15}")
+    for rows in args.sizes:
+        body = make_body(rows)
+        assert worker.compute_stats(body) == compute_stats_original(body)
+        original = best_of(compute_stats_original, body, args.repeat)
+        current = best_of(worker.compute_stats, body, args.repeat)
+        print(f"{rows:>10}{original:>16.2f}{current:>15.2f}")
+
+if __name__ == "__main__":
+    main()
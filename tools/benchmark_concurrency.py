@@ -0,0 +1,109 @@
+"""
+Load test of concurrent API workers on one SQLite database.
+
+Runs worker processes (like gunicorn sync workers) that send a mix of collection
+GETs and exercise POSTs through the test client, first with the old engine setup
+(a new connection per checkout, rollback journal, synchronous=FULL) and then with
+the default configuration (pooled connections, WAL, synchronous=NORMAL).
+The response cache is disabled so every GET reaches the database.
+Usage (from repository root):
+    python -m tools.benchmark_concurrency --workers 8 --seconds 10
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from sqlalchemy.pool import NullPool
+import tools.populate_database
+from fitnessbuddy import create_app, db
+from fitnessbuddy.models import User
+
+LEGACY = {
+    "SQLITE_WAL": False,
+    "SQLITE_SYNCHRONOUS": "FULL",
+    "SQLALCHEMY_ENGINE_OPTIONS": {"poolclass": NullPool}
+}
+
+def make_app(db_fname, config):
+    """
+    Creates an app on the given database without response caching
+    """
+    return create_app(dict(config, SQLALCHEMY_DATABASE_URI="sqlite:///" + db_fname,
+                           RESPONSE_CACHE_SIZE=0, JOBS_SYNC=True))
+
+def worker(db_fname, config, seconds, write_ratio, results):
+    """
+    Sends requests until time is up and reports latencies and failures
+    """
+    client = make_app(db_fname, config).test_client()
+    rng = random.Random(os.getpid())
+    latencies, failures = [], 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        user = rng.randint(1, 8)
+        begin = time.perf_counter()
+        try:
+            if rng.random() < write_ratio:
+                resp = client.post(f"/api/users/{user}/exercises/",
+                                   json={"name": "load", "date": "2023-05-01T12:00:00"})
+            else:
+                resp = client.get(f"/api/users/{user}/exercises/")
+            failures += resp.status_code >= 500
+        except Exception:  # noqa: W0703
+            #e.g. "database is locked" raised through the test client
+            failures += 1
+        latencies.append(time.perf_counter() - begin)
+    results.put((latencies, failures))
+
+def run(config, workers, seconds, write_ratio):
+    """
+    Returns requests per second, 95th percentile latency and failures for a config
+    """
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    try:
+        app = make_app(db_fname, config)
+        with app.app_context():
+            db.create_all()
+            tools.populate_database.populate_database(db, app)
+            db.engine.dispose()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=worker,
+                                             args=(db_fname, config, seconds, write_ratio,
+                                                   results))
+                     for _ in range(workers)]
+        for process in processes:
+            process.start()
+        latencies, failures = [], 0
+        for _ in processes:
+            worker_latencies, worker_failures = results.get()
+            latencies += worker_latencies
+            failures += worker_failures
+        for process in processes:
+            process.join()
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0
+        return len(latencies) / seconds, p95, failures
+    finally:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.remove(db_fname + suffix)
+
+def main():
+    """
+    Run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=8, help="worker processes")
+    parser.add_argument("--seconds", type=float, default=10, help="duration per setup")
+    parser.add_argument("--writes", type=float, default=0.2, help="share of POST requests")
+    args = parser.parse_args()
+
+    for name, config in (("legacy", LEGACY), ("configured", {})):
+        rps, p95, failures = run(config, args.workers, args.seconds, args.writes)
+        print(f"{name}: {rps:.0f} requests/s, p95 {p95 * 1000:.1f} ms, {failures} failed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark building Mason controls per request against precomputed control templates.
+
+Builds the controls of an exercise item the way the resources used to (url_for for
+every control and the schema inlined in the edit control) and from the resource's
+ControlTemplate, and compares time per response and response size.
+Usage (from repository root):
+    python -m tools.benchmark_controls --repeat 20000
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from flask import url_for
+from fitnessbuddy import create_app, db
+from fitnessbuddy.models import Exercise, User
+from fitnessbuddy.resources.exercise import ITEM_CONTROLS
+from fitnessbuddy.utils import MasonBuilder
+
+def inline_controls(user, exercise):
+    """
+    Controls of an exercise item built with url_for and an inlined schema
+    """
+    res = MasonBuilder()
+    res["exercise"] = exercise.serialize()
+    res.add_control("self", url_for("api.exerciseitem", user=user, exercise=exercise))
+    res.add_control("fitnessbuddy:exercises-all", url_for("api.exercisecollection",
+                                                          user=user), title="All exercises")
+    res.add_control_delete("Delete exercise", url_for("api.exerciseitem",
+                                                      user=user, exercise=exercise))
+    res.add_control_put("Edit exercise", url_for("api.exerciseitem",
+                                                 user=user, exercise=exercise),
+                        Exercise.json_schema())
+    return json.dumps(res)
+
+def template_controls(user, exercise):
+    """
+    Controls of an exercise item filled in from the precomputed template
+    """
+    res = MasonBuilder()
+    res["exercise"] = exercise.serialize()
+    res.add_controls(ITEM_CONTROLS, user=user, exercise=exercise)
+    return json.dumps(res)
+
+def main():
+    """
+    Run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=20000, help="responses per method")
+    args = parser.parse_args()
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    with app.test_request_context():
+        db.create_all()
+        user = User(name="bench", email="bench@email.com", age=30,
+                    user_creation_date=datetime(2023, 1, 1))
+        exercise = Exercise(name="run", duration=30, date=user.user_creation_date, user=user)
+        db.session.add(exercise)
+        db.session.commit()
+
+        print(f"{'controls':<12}{'us/response':>14}{'bytes':>8}")
+        for name, build in (("url_for", inline_controls), ("template", template_controls)):
+            body = build(user, exercise)
+            begin = time.perf_counter()
+            for _ in range(args.repeat):
+                build(user, exercise)
+            elapsed = (time.perf_counter() - begin) / args.repeat * 1e6
+            print(f"{name:<12}{elapsed:>14.1f}{len(body):>8}")
+
+if __name__ == "__main__":
+    main()
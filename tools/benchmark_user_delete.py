@@ -0,0 +1,74 @@
+"""
+Benchmark deleting a user with a long history.
+
+Times deleting a user whose children are loaded into the session and deleted one by
+one by the ORM (what the old cascade configuration did) against leaving them to the
+database's ON DELETE CASCADE.
+Usage (from repository root):
+    python -m tools.benchmark_user_delete --rows 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from fitnessbuddy import create_app, db
+from fitnessbuddy.models import Exercise, Measurements, User
+
+def fill(rows):
+    """
+    Insert a user with the given amount of exercise and measurement rows
+    """
+    start = datetime(2020, 1, 1)
+    user = User(name="heavy", email="heavy@email.com", age=30, user_creation_date=start)
+    db.session.add(user)
+    db.session.commit()
+    for table, row in ((Exercise.__table__, {"name": "run", "duration": 30.0}),
+                       (Measurements.__table__, {"weight": 80.0, "calories_in": 2500.0,
+                                                 "calories_out": 2300.0})):
+        db.session.execute(table.insert(), [
+            dict(row, user_id=user.id, date=start + timedelta(hours=i)) for i in range(rows)
+        ])
+    db.session.commit()
+    return user.id
+
+def time_delete(rows, load_children):
+    """
+    Returns seconds taken to delete a user with rows exercises and measurements
+    """
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    try:
+        with app.app_context():
+            db.create_all()
+            user_id = fill(rows)
+            db.session.expunge_all()
+            begin = time.perf_counter()
+            user = db.session.get(User, user_id)
+            if load_children:
+                #loaded children are deleted by the ORM row by row
+                _ = user.exercise, user.measurements, user.stats
+            db.session.delete(user)
+            db.session.commit()
+            elapsed = time.perf_counter() - begin
+            assert Exercise.query.filter_by(user_id=user_id).count() == 0
+        return elapsed
+    finally:
+        os.close(db_fd)
+        os.remove(db_fname)
+
+def main():
+    """
+    Run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000, help="rows per table")
+    args = parser.parse_args()
+
+    orm = time_delete(args.rows, True)
+    passive = time_delete(args.rows, False)
+    print(f"{args.rows} exercises and measurements: {orm:.2f} s with ORM cascade, "
+          f"{passive:.2f} s with ON DELETE CASCADE")
+
+if __name__ == "__main__":
+    main()
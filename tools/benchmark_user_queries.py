@@ -0,0 +1,97 @@
+"""
+Benchmark per-user query latency with and without the (user_id, date) indexes.
+
+Fills a temporary database with exercise and measurement rows spread over a number of
+users and times the queries the collection resources run for a single user.
+Usage (from repository root):
+    python -m tools.benchmark_user_queries --rows 1000000 --users 1000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from fitnessbuddy import create_app, db
+from fitnessbuddy.models import Exercise, Measurements, User
+from fitnessbuddy.utils import paginate
+
+CHUNK = 50000
+
+def fill(rows, users):
+    """
+    Insert users and the given amount of exercise and measurement rows
+    """
+    start = datetime(2020, 1, 1)
+    db.session.execute(User.__table__.insert(), [
+        {"name": f"user{i}", "email": f"user{i}@email.com", "age": 30,
+         "user_creation_date": start} for i in range(users)
+    ])
+    for table, make in (
+        (Exercise.__table__, lambda i: {"name": "run", "duration": 30.0}),
+        (Measurements.__table__, lambda i: {"weight": 80.0, "calories_in": 2500.0,
+                                            "calories_out": 2300.0}),
+    ):
+        for offset in range(0, rows, CHUNK):
+            chunk = []
+            for i in range(offset, min(rows, offset + CHUNK)):
+                row = make(i)
+                row["user_id"] = random.randint(1, users)
+                row["date"] = start + timedelta(minutes=random.randint(0, 60 * 24 * 365 * 3))
+                chunk.append(row)
+            db.session.execute(table.insert(), chunk)
+    db.session.commit()
+
+def time_queries(users, repeat):
+    """
+    Returns average latency in milliseconds of full history and first page queries
+    """
+    ids = [random.randint(1, users) for _ in range(repeat)]
+    results = {}
+    for name, run in (
+        ("all exercises", lambda uid: Exercise.query.filter_by(user_id=uid).all()),
+        ("all measurements", lambda uid: Measurements.query.filter_by(user_id=uid).all()),
+        ("first page", lambda uid: paginate(Exercise.query.filter_by(user_id=uid),
+                                            Exercise, {}).items),
+    ):
+        begin = time.perf_counter()
+        for uid in ids:
+            run(uid)
+            db.session.expunge_all()
+        results[name] = (time.perf_counter() - begin) / repeat * 1000
+    return results
+
+def main():
+    """
+    Run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1000000, help="rows per table")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50, help="queried users per run")
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    try:
+        with app.app_context():
+            db.create_all()
+            print(f"Inserting {args.rows} rows per table for {args.users} users...")
+            fill(args.rows, args.users)
+
+            with_index = time_queries(args.users, args.repeat)
+            for table in ("exercise", "measurements"):
+                db.session.execute(text(f"DROP INDEX ix_{table}_user_id_date"))
+            db.session.commit()
+            without_index = time_queries(args.users, args.repeat)
+
+        print(f"{'query':<20}{'no index (ms)':>16}{'index (ms)':>14}")
+        for name, latency in with_index.items():
+            print(f"{name:<20}{without_index[name]:>16.2f}{latency:>14.2f}")
+    finally:
+        os.close(db_fd)
+        os.remove(db_fname)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark per-request JSON schema validation cost.
+
+Compares jsonschema.validate with a freshly built schema (what the resources did on
+every POST/PUT) against the cached validators of the models, and a batch of
+documents validated one by one against validate_many.
+Usage (from repository root):
+    python -m tools.benchmark_validation --repeat 20000
+"""
+import argparse
+import time
+from jsonschema import validate
+from fitnessbuddy.models import Exercise, Measurements, Stats, User
+
+DOCS = {
+    Exercise: {"name": "run", "date": "2023-01-01T12:00:00", "duration": 30, "user_id": 1},
+    Measurements: {"date": "2023-01-01T12:00:00", "weight": 80, "calories_in": 2500,
+                   "calories_out": 2300, "user_id": 1},
+    Stats: {"date": "2023-01-01T12:00:00", "total_exercises": 3, "daily_exercises": 0.5,
+            "daily_calories_in": 2500, "daily_calories_out": 2300, "user_id": 1},
+    User: {"name": "bench", "email": "bench@email.com", "age": 30,
+           "user_creation_date": "2023-01-01T12:00:00"},
+}
+
+def per_call(run, repeat):
+    """
+    Returns average time of run in microseconds
+    """
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - begin) / repeat * 1e6
+
+def main():
+    """
+    Run the benchmark and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=20000, help="validations per model")
+    parser.add_argument("--batch", type=int, default=1000, help="documents per batch")
+    args = parser.parse_args()
+
+    print(f"{'model':<14}{'validate (us)':>16}{'cached (us)':>14}")
+    for model, doc in DOCS.items():
+        before = per_call(lambda: validate(doc, model.json_schema()), args.repeat)
+        after = per_call(lambda: model.validate(doc), args.repeat)
+        print(f"{model.__name__:<14}{before:>16.1f}{after:>14.1f}")
+
+    batch = [dict(DOCS[Measurements]) for _ in range(args.batch)]
+    one_by_one = per_call(lambda: [validate(doc, Measurements.json_schema()) for doc in batch],
+                          10)
+    many = per_call(lambda: Measurements.validate_many(batch), 10)
+    print(f"{args.batch} measurements: {one_by_one / 1000:.1f} ms one by one, "
+          f"{many / 1000:.1f} ms with validate_many")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import datetime
 import os
 import json
-from fitnessbuddy.models import Exercise, User, Measurements
+from fitnessbuddy.models import Exercise, User, Measurements, UserAggregate
 
 def populate_database(db, app):
     """
@@ -29,6 +29,9 @@ def populate_database(db, app):
                     meas.get("date"),"%d/%m/%y %H:%M:%S"), user_id=meas.get("user_id"))
                 db.session.add(entry)
             db.session.commit()
+            for user in User.query.all():
+                UserAggregate.for_user(user, lock=True)
+            db.session.commit()
 
             return True
 
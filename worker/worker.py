@@ -4,25 +4,52 @@ https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/exercise-4-implementi
 """
 import os
 import sys
+import argparse
+import functools
+import threading
 from random import randint
 import time
 import json
 import ssl
 from datetime import datetime
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import pika
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 context = ssl.create_default_context()
 context.check_hostname = False
 context.verify_mode = ssl.CERT_NONE
 
 API_SERVER = "http://localhost:5000"
+CACHE_SIZE = 1024
+AGGREGATE_FIELDS = ("exercise_count", "measurement_count", "calories_in_sum",
+                    "calories_out_sum", "watermark")
+#stats notifications are routed by user, listeners bind to their own user's key
+NOTIFICATIONS_EXCHANGE = "user-notifications"
+
+#connect and read timeouts of API requests, in seconds
+HTTP_TIMEOUT = (3.05, 10)
+#connections kept open to the API, at least one per concurrent handler
+HTTP_POOL_SIZE = 10
 
 CHANNEL = None
+SLEEP = False
 USR = ""
 PWD = ""
 
+def notification_key(user_id):
+    """
+    Routing key of a user's stats notifications
+    """
+    return f"user.{user_id}.stats"
+
 def log_error(message):
     """
     Logs errors
@@ -36,60 +63,360 @@ def log_error(message):
         })
     )
 
-def handle_task(channel, method, properties, body):
+class AggregateCache:
     """
-    Handles task by parsing message and sends the response back
-    to given url.
+    Bounded LRU cache of per-user partial aggregates (counts and calorie sums
+    together with the watermark of the last change merged into them). Safe to share
+    between pool threads: get returns a copy and put never replaces a newer aggregate.
+    Keyed by user id, which the API never gives to another user after a deletion
+    (the same goes for GenerationTracker).
     """
-    print("\nHandling task")
-    #wait a few seconds just for fun
-    time.sleep(randint(2,4))
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Returns a copy of the cached aggregate of a user or None
+        """
+        with self._lock:
+            partial = self._items.get(user_id)
+            if partial is None:
+                return None
+            self._items.move_to_end(user_id)
+            return dict(partial)
+
+    def put(self, user_id, partial):
+        """
+        Stores the aggregate of a user, evicting the least recently used one if full
+        """
+        with self._lock:
+            cached = self._items.get(user_id)
+            if cached is None or cached["watermark"] <= partial["watermark"]:
+                self._items[user_id] = partial
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+CACHE = AggregateCache()
 
+class GenerationTracker:
+    """
+    Bounded record of the latest stats generation received per user. The API bumps
+    a user's generation for every task it sends, so a task older than one already
+    received is superseded by it and can be dropped.
+    """
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def see(self, user_id, generation):
+        """
+        Records the generation of a received task. Returns False if the task is
+        superseded by one received before it.
+        """
+        if generation is None:
+            return True
+        with self._lock:
+            latest = self._items.get(user_id, 0)
+            self._items[user_id] = max(latest, generation)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+            return generation >= latest
+
+GENERATIONS = GenerationTracker()
+
+def task_generation(body):
+    """
+    Returns the user id and stats generation of a task, or None if it can't be read
+    """
     try:
         task = json.loads(body)
+        return task["user"]["id"], task.get("generation")
+    except (KeyError, TypeError, json.JSONDecodeError):
+        return None
+
+_SESSION = None
+_SESSION_PID = None
+_SESSION_LOCK = threading.Lock()
+
+def make_session(pool_size):
+    """
+    Creates a session whose keep-alive connections to the API are reused between
+    tasks. Failed connections are retried with exponential backoff, and so are
+    GETs answered with 502-504. POSTs aren't retried once sent since stats would
+    be stored twice.
+    """
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session():
+    """
+    Returns the session of this process, shared by its pool threads. Processes of a
+    process pool each create their own since connections can't be shared over fork.
+    """
+    global _SESSION, _SESSION_PID  # noqa: W0603
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION_PID != os.getpid():
+            _SESSION = make_session(HTTP_POOL_SIZE)
+            _SESSION_PID = os.getpid()
+        return _SESSION
+
+def resync_aggregate(href):
+    """
+    Fetches the user's running totals from the API to start over from
+    """
+    resp = get_session().get(href, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    aggregate = resp.json()["aggregate"]
+    return {key: aggregate[key] for key in AGGREGATE_FIELDS}
+
+def merge_changes(partial, changes):
+    """
+    Merges journal changes newer than the aggregate's watermark into it
+    """
+    for change in sorted(changes, key=lambda change: change["seq"]):
+        if change["seq"] <= partial["watermark"]:
+            continue
+        sign = change["sign"]
+        if change["kind"] == "exercise":
+            partial["exercise_count"] += sign
+        else:
+            partial["measurement_count"] += sign
+            partial["calories_in_sum"] += sign * (change["calories_in"] or 0)
+            partial["calories_out_sum"] += sign * (change["calories_out"] or 0)
+        partial["watermark"] = change["seq"]
+    return partial
+
+def update_aggregate(task):
+    """
+    Brings the cached aggregate of the task's user up to date with the changes in the
+    task. Falls back to a full resync if the cache has no aggregate for the user or it
+    is older than the changes the task starts from.
+    """
+    user_id = task["user"]["id"]
+    partial = CACHE.get(user_id)
+    if partial is None or task["base"] is None or partial["watermark"] < task["base"]:
+        print(f"Resyncing aggregate of user {user_id}")
+        partial = resync_aggregate(
+            API_SERVER + task["@controls"]["fitnessbuddy:stats-aggregate"]["href"])
+    merge_changes(partial, task["changes"])
+    CACHE.put(user_id, partial)
+    return partial
+
+def compute_aggregate_stats(partial, user):
+    """
+    Computes the same averages as compute_stats from a partial aggregate
+    """
+    difference = datetime.today() - datetime.fromisoformat(user["user_creation_date"])
+    count = partial["measurement_count"]
+    try:
+        avg_exercise = partial["exercise_count"] / difference.days
+    except ZeroDivisionError:
+        avg_exercise = 0
+    avg_calories_in = partial["calories_in_sum"] / count if count else 0
+    avg_calories_out = partial["calories_out_sum"] / count if count else 0
+    return round(avg_exercise, 2), round(avg_calories_in, 2), round(avg_calories_out, 2)
+
+def compute_batch_stats(users):
+    """
+    Computes the same averages as compute_stats for many users at once from the
+    columns of a stats export. Returns a (daily_exercises, daily_calories_in,
+    daily_calories_out) tuple per user.
+    """
+    if np is None:
+        rows = zip(users["exercise_count"], users["measurement_count"], users["calories_in_sum"],
+                   users["calories_out_sum"])
+        return [compute_aggregate_stats(dict(zip(AGGREGATE_FIELDS, row)),
+                                        {"user_creation_date": created})
+                for row, created in zip(rows, users["user_creation_date"])]
+    today = datetime.today()
+    days = np.fromiter(((today - datetime.fromisoformat(created)).days
+                        for created in users["user_creation_date"]),
+                       dtype=np.float64, count=len(users["user_creation_date"]))
+    exercises = np.asarray(users["exercise_count"], dtype=np.float64)
+    counts = np.asarray(users["measurement_count"], dtype=np.float64)
+    columns = []
+    #divisions by zero are masked out by where
+    with np.errstate(divide="ignore", invalid="ignore"):
+        columns.append(np.where(days != 0, exercises / days, 0))
+        for key in ("calories_in_sum", "calories_out_sum"):
+            sums = np.asarray(users[key], dtype=np.float64)
+            columns.append(np.where(counts != 0, sums / counts, 0))
+    rows = zip(*(column.tolist() for column in columns))
+    #rounded like compute_stats, numpy rounds some halves differently
+    return [tuple(round(value, 2) for value in row) for row in rows]
+
+def process_batch(task):
+    """
+    Computes the stats of every user of a batch task in one pass and posts them back
+    in one request. Returns (stats list, error).
+    """
+    href = API_SERVER + task["@controls"]["fitnessbuddy:stats-export"]["href"]
+    resp = get_session().get(href, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    users = resp.json()["users"]
+    date = datetime.isoformat(datetime.now())
+    results = []
+    for index, row in enumerate(compute_batch_stats(users)):
+        new_stats = {
+            "date": date,
+            "user_id": users["id"][index],
+            "total_exercises": users["exercise_count"][index],
+            "daily_exercises": row[0],
+            "daily_calories_in": row[1],
+            "daily_calories_out": row[2]
+        }
+        if users["watermark"][index] is not None:
+            new_stats["watermark"] = users["watermark"][index]
+        results.append(new_stats)
+    if not results:
+        return results, None
+    href = API_SERVER + task["@controls"]["fitnessbuddy:add-stats-bulk"]["href"]
+    print(f"Sending stats of {len(results)} users to: {href}")
+    resp = get_session().post(href, json=results, timeout=HTTP_TIMEOUT)
+    if not resp.ok:
+        return results, f"Unable to send results: {resp.status_code}"
+    return results, None
+
+def process_task(body, sleep=False):
+    """
+    Computes new stats for a task and sends them back to the url given in the task.
+    Safe to run on a pool thread or process: it doesn't touch the channel. Returns
+    (new_stats, error) where either may be None, new_stats is a list for batch tasks.
+    """
+    if sleep:
+        #wait a few seconds just for fun
+        time.sleep(randint(2,4))
+
+    try:
+        task = json.loads(body)
+        if task.get("kind") == "batch":
+            return process_batch(task)
         href = API_SERVER + task["@controls"]["fitnessbuddy:add-stats"]["href"]
         print("Body: \n", task, "\n")
-        daily_exercise, avg_calories_in, avg_calories_out = compute_stats(task)
+        partial = update_aggregate(task)
+        daily_exercise, avg_calories_in, avg_calories_out = compute_aggregate_stats(
+            partial, task["user"])
         #calculate new stats
         new_stats = {
             "date": datetime.isoformat(datetime.now()),
             "user_id": task["user"]["id"],
-            "total_exercises": len(task["exercises"]),
+            "total_exercises": partial["exercise_count"],
             "daily_exercises": daily_exercise,
             "daily_calories_in": avg_calories_in,
-            "daily_calories_out": avg_calories_out
+            "daily_calories_out": avg_calories_out,
+            "watermark": partial["watermark"]
         }
+        if task.get("generation") is not None:
+            new_stats["generation"] = task["generation"]
         #send post request to url given in controls
-        with requests.Session() as session:
-            print(f"Sending post request to: {href}")
-            resp = session.post(
-                href,
-                json=new_stats
-            )
-            if resp.status_code != 204:
-                # log error 
-                log_error("Unable to send result")
+        print(f"Sending post request to: {href}")
+        resp = get_session().post(href, json=new_stats, timeout=HTTP_TIMEOUT)
+        if not resp.ok:
+            return new_stats, f"Unable to send result: {resp.status_code}"
+        return new_stats, None
 
+    except (KeyError, json.JSONDecodeError, requests.RequestException) as error:
+        print("ERROR:", error)
+        return None, None
+
+def finish_task(channel, delivery_tag, new_stats, error):
+    """
+    Publishes the outcome of a task and acknowledges it. Must run on the
+    connection's thread.
+    """
+    if error:
+        log_error(error)
+    #batch tasks give the stats of many users
+    if isinstance(new_stats, dict):
+        new_stats = [new_stats]
+    for stats in new_stats or []:
         channel.basic_publish(
-            exchange="notifications",
-            routing_key="",
-            body=json.dumps(new_stats)
+            exchange=NOTIFICATIONS_EXCHANGE,
+            routing_key=notification_key(stats["user_id"]),
+            body=json.dumps(stats)
         )
-        
-    except (KeyError, json.JSONDecodeError) as error:
-        print("ERROR:", error)
+    # acknowledge the task regardless of outcome
+    print("Task handled")
+    channel.basic_ack(delivery_tag=delivery_tag)
 
-    finally:
-        # acknowledge the task regardless of outcome
-        print("Task handled")
-        channel.basic_ack(delivery_tag=method.delivery_tag)
+def handle_task(channel, method, properties, body):
+    """
+    Handles task by parsing message and sends the response back
+    to given url.
+    """
+    print("\nHandling task")
+    key = task_generation(body)
+    if key is not None and not GENERATIONS.see(*key):
+        print("Dropping superseded task")
+        finish_task(channel, method.delivery_tag, None, None)
+        return
+    new_stats, error = process_task(body, SLEEP)
+    finish_task(channel, method.delivery_tag, new_stats, error)
+
+def make_pool_handler(connection, executor):
+    """
+    Creates a message callback that hands tasks over to a thread or process pool.
+    Results are marshalled back to the connection thread for publishing and acking.
+    A task that hasn't started yet is cancelled when a newer generation of the same
+    user's stats arrives.
+    """
+    #latest queued future per user, only used on the connection thread
+    queued = {}
+
+    def complete(channel, delivery_tag, user_id, future, new_stats, error):
+        if queued.get(user_id) is future:
+            del queued[user_id]
+        finish_task(channel, delivery_tag, new_stats, error)
+
+    def on_done(channel, delivery_tag, user_id, future):
+        if future.cancelled():
+            print("Dropped superseded task")
+            new_stats, error = None, None
+        else:
+            try:
+                new_stats, error = future.result()
+            except Exception as exc:  # noqa: W0703
+                new_stats, error = None, f"Task failed: {exc}"
+        connection.add_callback_threadsafe(functools.partial(
+            complete, channel, delivery_tag, user_id, future, new_stats, error))
+
+    def handle_pooled_task(channel, method, properties, body):
+        print("\nHandling task on pool")
+        key = task_generation(body)
+        if key is not None and not GENERATIONS.see(*key):
+            print("Dropping superseded task")
+            finish_task(channel, method.delivery_tag, None, None)
+            return
+        future = executor.submit(process_task, body, SLEEP)
+        user_id = None
+        if key is not None and key[1] is not None:
+            user_id = key[0]
+            previous = queued.get(user_id)
+            if previous is not None:
+                previous.cancel()
+            queued[user_id] = future
+        future.add_done_callback(
+            functools.partial(on_done, channel, method.delivery_tag, user_id))
+
+    return handle_pooled_task
 
 def compute_stats(body):
     """
-    Computes daily averages.
+    Computes daily averages from a full history task body (missing calories count
+    as 0). Tasks are handled from running totals, see compute_aggregate_stats, this
+    is the reference they are checked against.
     Returns average number of daily exercises, calories_in, and calories_out
     """
-    measurement_date_counts = OrderedDict()
     sum_of_calories_in = 0
     sum_of_calories_out = 0
 
@@ -97,16 +424,10 @@ def compute_stats(body):
     current_date = datetime.today()
     difference = current_date - creaton_date
 
-    for i in range(len(body["measurements"])):
-        try:
-            in_date_format_measurement = datetime.fromisoformat(body["measurements"][i]["date"])
-            measurement_date_counts[in_date_format_measurement.date()] += 1
-        except KeyError:
-            measurement_date_counts[in_date_format_measurement.date()] = 1
-        
-        sum_of_calories_in += body["measurements"][i]["calories_in"]
-        sum_of_calories_out += body["measurements"][i]["calories_out"]
-    
+    for measurement in body["measurements"]:
+        sum_of_calories_in += measurement["calories_in"] or 0
+        sum_of_calories_out += measurement["calories_out"] or 0
+
     length = len(body["exercises"])
 
     try:
@@ -121,14 +442,34 @@ def compute_stats(body):
         avg_calories_out = sum_of_calories_out / len(body["measurements"])
     except ZeroDivisionError:
         avg_calories_out = 0
-    
+
     return round(avg_exercise, 2), round(avg_calories_in, 2), round(avg_calories_out, 2)
 
-def main():
+def parse_args(argv=None):
+    """
+    Parses worker command line options
+    """
+    parser = argparse.ArgumentParser(description="Stats worker")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of concurrent task handlers")
+    parser.add_argument("--pool", choices=["thread", "process"], default="thread",
+                        help="run handlers on a thread or a process pool")
+    parser.add_argument("--prefetch", type=int, default=None,
+                        help="unacked messages per consumer (default: 2 * workers)")
+    parser.add_argument("--sleep", action="store_true",
+                        help="wait a few seconds before handling each task")
+    args = parser.parse_args(argv)
+    if args.prefetch is None:
+        args.prefetch = 2 * args.workers
+    return args
+
+def main(args):
     """
     Consumes stats queue
     """
-    global CHANNEL  # noqa: W0603
+    global CHANNEL, SLEEP, HTTP_POOL_SIZE  # noqa: W0603
+    SLEEP = args.sleep
+    HTTP_POOL_SIZE = max(HTTP_POOL_SIZE, args.workers)
     connection = pika.BlockingConnection(
             pika.ConnectionParameters(
                 host="193.167.189.95",
@@ -140,8 +481,8 @@ def main():
         )
     CHANNEL = connection.channel()
     CHANNEL.exchange_declare(
-        exchange="notifications",
-        exchange_type="fanout"
+        exchange=NOTIFICATIONS_EXCHANGE,
+        exchange_type="topic"
     )
     CHANNEL.exchange_declare(
         exchange="logs",
@@ -151,10 +492,25 @@ def main():
     CHANNEL.queue_delete(queue='stats')
     #make new one
     CHANNEL.queue_declare(queue="stats")
-    CHANNEL.basic_consume(queue="stats", on_message_callback=handle_task)
-    print("Service started")
-    CHANNEL.start_consuming()
-    
+    CHANNEL.basic_qos(prefetch_count=args.prefetch)
+    if args.workers > 1:
+        if args.pool == "process":
+            executor = ProcessPoolExecutor(max_workers=args.workers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=args.workers)
+        callback = make_pool_handler(connection, executor)
+    else:
+        executor = None
+        callback = handle_task
+    CHANNEL.basic_consume(queue="stats", on_message_callback=callback)
+    print(f"Service started with {args.workers} {args.pool} worker(s), "
+          f"prefetch {args.prefetch}")
+    try:
+        CHANNEL.start_consuming()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
 if __name__ == "__main__":
     #get credentials from \client directory
     cwd = os.getcwd()
@@ -166,7 +522,7 @@ if __name__ == "__main__":
         PWD = cred.get("password")
 
     try:
-        main()
+        main(parse_args())
     except KeyboardInterrupt:
         try:
             sys.exit(0)